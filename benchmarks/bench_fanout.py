@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Measures the CPU cost of broadcasting one message against the
+number of connected clients, comparing the encode-once path used by
+BroadcastServerFactory.broadcast with framing the message separately
+for every client (sendMessage per client), and with clients which
+opted into batching (one frame per batch of messages). The encode-once
+path is also timed with broadcasts logged at INFO (to /dev/null, through
+the background log writer, limited to ``--log-rate`` records a second),
+to measure what logging costs fanout.
+
+Clients are real BroadcastServerProtocol instances, opened with a
+WebSocket handshake over a transport that discards what is written, so
+only the server-side CPU cost is measured.
+
+usage: python benchmarks/bench_fanout.py [--clients 1,10,100,1000]
+                                         [--messages N] [--log-rate N]
+                                         [--json]
+"""
+
+import os
+import sys
+import time
+import logging
+from json import dumps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet.address import IPv4Address
+
+import wikimon.monitor_websocket as MW
+from wikimon import logs
+
+
+CHANNEL = 'en.wikipedia'
+HANDSHAKE = ('GET /en/ HTTP/1.1\r\n'
+             'Host: localhost:9000\r\n'
+             'Upgrade: websocket\r\n'
+             'Connection: Upgrade\r\n'
+             'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+             'Sec-WebSocket-Version: 13\r\n\r\n')
+SAMPLE_MSG = {'action': 'edit',
+              'change_size': -12,
+              'flags': None,
+              'geo_ip': {'city': 'Salisbury',
+                         'country_name': 'United States',
+                         'latitude': 38.3761,
+                         'longitude': -75.6086,
+                         'region_name': 'Maryland'},
+              'hashtags': [],
+              'is_anon': True,
+              'is_bot': False,
+              'is_minor': False,
+              'is_new': False,
+              'is_unpatrolled': False,
+              'mentions': [],
+              'ns': 'Main',
+              'page_title': 'Evanescence (Evanescence album)',
+              'parent_rev_id': '775894800',
+              'rev_id': '774995266',
+              'summary': '/* Credits and personnel */ "Personnel" is enough',
+              'url': 'https://en.wikipedia.org/w/index.php?diff=775894800'
+                     '&oldid=774995266',
+              'user': '71.200.123.192'}
+
+
+class NullTransport(object):
+    disconnecting = False
+
+    def __init__(self, port):
+        self.peer = IPv4Address('TCP', '127.0.0.1', port)
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def setTcpNoDelay(self, enabled):
+        pass
+
+    def getPeer(self):
+        return self.peer
+
+    def getHost(self):
+        return IPv4Address('TCP', '127.0.0.1', 9000)
+
+    def loseConnection(self):
+        pass
+
+    abortConnection = loseConnection
+
+
+def make_factory():
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=[CHANNEL])
+    factory.protocol = MW.BroadcastServerProtocol
+    return factory
+
+
+def connect_clients(factory, count, handshake=HANDSHAKE):
+    clients = []
+    for i in xrange(count):
+        transport = NullTransport(10000 + i)
+        proto = factory.buildProtocol(transport.peer)
+        proto.makeConnection(transport)
+        proto.dataReceived(handshake)
+        clients.append(proto)
+    return clients
+
+
+def cpu_per_message(func, messages):
+    start = time.clock()
+    for _ in xrange(messages):
+        func()
+    return (time.clock() - start) / messages
+
+
+def bench(client_count, messages):
+    factory = make_factory()
+    clients = connect_clients(factory, client_count)
+    assert len(factory.clients[CHANNEL]) == client_count
+    batch_factory = make_factory()
+    connect_clients(batch_factory, client_count,
+                    HANDSHAKE.replace('/en/', '/en/?batch=true'))
+    batch_size = batch_factory.batch_size
+
+    def per_client():
+        msg = dumps(SAMPLE_MSG, sort_keys=True)
+        for c in clients:
+            c.sendMessage(msg)
+
+    def encode_once():
+        factory.broadcast(dumps(SAMPLE_MSG, sort_keys=True), CHANNEL)
+
+    def logged():
+        MW.bcast_log.setLevel(logging.INFO)
+        try:
+            return cpu_per_message(encode_once, messages)
+        finally:
+            MW.bcast_log.setLevel(logging.WARN)
+
+    def batched():
+        for _ in xrange(batch_size):  # the last one flushes the batch
+            batch_factory.broadcast(dumps(SAMPLE_MSG, sort_keys=True),
+                                    CHANNEL)
+
+    batches = max(1, messages // batch_size)
+    return {'clients': client_count,
+            'messages': messages,
+            'batch_size': batch_size,
+            'per_client_us': cpu_per_message(per_client, messages) * 1e6,
+            'encode_once_us': cpu_per_message(encode_once, messages) * 1e6,
+            'logged_us': logged() * 1e6,
+            'batched_us': (cpu_per_message(batched, batches) * 1e6
+                           / batch_size)}
+
+
+def main():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description=__doc__.splitlines()[0])
+    prs.add_argument('--clients', default='1,10,100,1000,5000')
+    prs.add_argument('--messages', default=None, type=int,
+                     help='messages per run (default: scaled to clients)')
+    prs.add_argument('--log-rate', default=logs.DEFAULT_RATE, type=int,
+                     help='most broadcasts logged a second, when timing'
+                     ' with logging (0 for no limit)')
+    prs.add_argument('--json', action='store_true',
+                     help='emit one JSON object per line')
+    args = prs.parse_args()
+
+    logs.configure(logging.WARN, os.devnull, args.log_rate or None)
+    MW.bcast_log.setLevel(logging.WARN)
+    MW.mon_log.setLevel(logging.WARN)
+    results = []
+    for count in [int(c) for c in args.clients.split(',')]:
+        messages = args.messages or max(20, 100000 // count)
+        results.append(bench(count, messages))
+
+    if args.json:
+        for res in results:
+            print dumps(res, sort_keys=True)
+        return
+    print '%8s %16s %16s %8s %16s %16s' % ('clients', 'per-client us',
+                                           'encode-once us', 'speedup',
+                                           'batched us', 'logged us')
+    for res in results:
+        print '%8d %16.1f %16.1f %7.2fx %16.1f %16.1f' % (
+            res['clients'], res['per_client_us'], res['encode_once_us'],
+            res['per_client_us'] / res['encode_once_us'], res['batched_us'],
+            res['logged_us'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+"""End-to-end load test: feeds a BroadcastServerFactory from a local
+IRC server and measures delivery to many real WebSocket clients.
+
+For each client count, the server under test is started in its own
+process: an IRC monitor (parsing, geolocation, serialization) and the
+WebSocket broadcaster, as run by monitor_websocket.py. This process
+plays the IRC server, sending a synthetic feed built from the corpus
+(at ``--rate`` lines per second) or a recording made with
+``monitor_websocket.py --record`` (at ``--speed``), and opens the
+clients once the monitor has joined.
+
+Every line gets a unique revision ID, so latency is measured from the
+moment the line is written to the monitor to its arrival at a client,
+on a sample of the clients (``--sample``). Reported for each client
+count: latency percentiles, lines/s ingested and messages/s
+delivered, undelivered messages, and the server process' CPU use and
+peak RSS (from /proc). The clients are spread over
+``--client-processes`` processes of their own; the CPU use of those
+and of this process is reported too, as on few cores they compete
+with the server.
+
+usage: python benchmarks/bench_load.py [--clients 100,1000,5000]
+                                       [--messages N] [--rate N|max]
+                                       [--recording PATH] [--speed N|max]
+                                       [--geoip-db PATH] [--loglevel LEVEL]
+                                       [--json]
+"""
+
+import os
+import re
+import math
+import sys
+import logging
+import resource
+from json import dumps, loads
+from functools import partial
+from multiprocessing import cpu_count
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import reactor
+from twisted.internet.defer import (Deferred, gatherResults, inlineCallbacks,
+                                    returnValue)
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.stdio import StandardIO
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.protocols.basic import LineReceiver
+from autobahn.websocket import (WebSocketClientFactory,
+                                WebSocketClientProtocol,
+                                connectWS)
+
+from wikimon.feedlog import monotonic, get_log_paths, read_feed_log
+from wikimon.replay import ReplayServerFactory
+from bench_parsers import DEFAULT_CORPUS
+
+
+CHANNEL = 'en.wikipedia'
+CHANNEL_PATH = '/en/'
+CONNECT_BATCH = 200
+CONNECT_TIMEOUT = 30
+DELIVERED_INTERVAL = 0.2
+PERCENTILES = (50, 90, 99, 99.9)
+_REV_ID_RE = re.compile(r'(diff|oldid)=\d+')
+_SENT_REV_ID_RE = re.compile(r'oldid=(\d+)')
+_REV_ID_MARK = '"rev_id": "'
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def iter_unique_lines(lines):
+    """Yields (channel, line) for the edits among (channel, line)
+    pairs, with a unique revision ID set in each line's diff URL.
+    """
+    rev_id = 0
+    for channel, line in lines:
+        if 'oldid=' not in line:
+            continue  # log actions have no revision to track
+        rev_id += 1
+        yield channel, _REV_ID_RE.sub(r'\1=%d' % rev_id, line)
+
+
+def get_synthetic_records(corpus_path, messages, rate):
+    with open(corpus_path, 'rb') as f:
+        lines = [line.rstrip('\n') for line in f if line.strip()]
+    delay = 1.0 / rate if rate else 0.0
+
+    def cycle():
+        while True:
+            for line in lines:
+                yield CHANNEL, line
+
+    def get_records():
+        unique = iter_unique_lines(cycle())
+        for _ in xrange(messages):
+            yield delay, CHANNEL, next(unique)[1]
+
+    return get_records
+
+
+def get_recorded_records(path, messages=None):
+    paths = get_log_paths(path)
+    if not paths:
+        raise SystemExit('no recording at %r' % path)
+
+    def get_records():
+        # every wiki in the recording is sent to the one served channel
+        records = read_feed_log(paths)
+        delays = []
+
+        def lines():
+            for delay, channel, msg in records:
+                delays.append(delay)
+                yield channel, msg
+
+        count = 0
+        for _, line in iter_unique_lines(lines()):
+            yield sum(delays), CHANNEL, line
+            del delays[:]
+            count += 1
+            if messages and count >= messages:
+                return
+
+    return get_records
+
+
+class LoadFeedFactory(ReplayServerFactory):
+    """A replay server which notes when each line was sent, and waits
+    for :meth:`begin` rather than the monitor's JOIN to start.
+    """
+    def __init__(self, records, speed):
+        ReplayServerFactory.__init__(self, records, speed)
+        self.joined = Deferred()
+        self.done = Deferred()
+        self.sent_at = {}
+
+    def start(self):
+        if not self.joined.called:
+            self.joined.callback(None)
+
+    def begin(self):
+        ReplayServerFactory.start(self)
+        return self.done
+
+    def send(self, channel, msg):
+        self.sent_at[_SENT_REV_ID_RE.search(msg).group(1)] = monotonic()
+        ReplayServerFactory.send(self, channel, msg)
+
+    def finish(self):
+        ReplayServerFactory.finish(self)
+        self.done.callback(self.sent)
+
+
+class LoadClientProtocol(WebSocketClientProtocol):
+    sampled = False
+
+    def onOpen(self):
+        self.factory.opened.append(self)
+        self.sampled = len(self.factory.opened) <= self.factory.sample
+
+    def onMessage(self, msg, binary):
+        factory = self.factory
+        factory.delivered += 1
+        if not self.sampled:
+            return
+        now = monotonic()
+        start = msg.find(_REV_ID_MARK)
+        if start >= 0:
+            start += len(_REV_ID_MARK)
+            factory.receipts.append((msg[start:msg.find('"', start)], now))
+
+
+class LoadClientFactory(WebSocketClientFactory):
+    protocol = LoadClientProtocol
+
+    def __init__(self, url, sample):
+        WebSocketClientFactory.__init__(self, url)
+        # autobahn validates UTF-8 in pure Python, byte by byte, which
+        # would make the clients rather than the server the bottleneck
+        self.setProtocolOptions(utf8validateIncoming=False)
+        self.sample = sample
+        self.opened = []
+        self.failed = 0
+        self.delivered = 0
+        self.receipts = []  # (rev_id, monotonic time) on sampled clients
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed += 1
+
+
+class ClientControl(LineReceiver):
+    """A client process' side of the control channel on stdio: reports
+    the open connections, then deliveries as they come in, and on
+    "report" the sampled receipt times.
+    """
+    delimiter = '\n'
+
+    def __init__(self, factory, count):
+        self.factory = factory
+        self.count = count
+
+    @inlineCallbacks
+    def connectionMade(self):
+        yield connect_clients(self.factory, self.count)
+        self.sendLine('open %d %d' % (len(self.factory.opened),
+                                      self.factory.failed))
+        LoopingCall(self.send_delivered).start(DELIVERED_INTERVAL)
+
+    def send_delivered(self):
+        self.sendLine('delivered %d' % self.factory.delivered)
+
+    def lineReceived(self, line):
+        if line.strip() != 'report':
+            return
+        self.sendLine('report ' + dumps({'delivered': self.factory.delivered,
+                                         'receipts': self.factory.receipts}))
+        for client in self.factory.opened:
+            client.transport.loseConnection()
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+
+class ControlledProcess(ProcessProtocol):
+    def __init__(self):
+        self.ended = Deferred()
+        self.buf = ''
+
+    def outReceived(self, data):
+        self.buf += data
+        while '\n' in self.buf:
+            line, self.buf = self.buf.split('\n', 1)
+            kind, _, rest = line.partition(' ')
+            self.lineReceived(kind, rest)
+
+    def lineReceived(self, kind, rest):
+        pass
+
+    def errReceived(self, data):
+        sys.stderr.write(data)
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+class ServerProcess(ControlledProcess):
+    def __init__(self):
+        ControlledProcess.__init__(self)
+        self.ready = Deferred()
+
+    def lineReceived(self, kind, rest):
+        if kind == 'ready':
+            self.ready.callback(int(rest))
+
+    def processEnded(self, reason):
+        if not self.ready.called:
+            self.ready.errback(reason)
+        ControlledProcess.processEnded(self, reason)
+
+
+class ClientProcess(ControlledProcess):
+    def __init__(self):
+        ControlledProcess.__init__(self)
+        self.opened = Deferred()
+        self.report = Deferred()
+        self.delivered = 0
+
+    def lineReceived(self, kind, rest):
+        if kind == 'open':
+            self.opened.callback(int(rest.split()[0]))
+        elif kind == 'delivered':
+            self.delivered = int(rest)
+        elif kind == 'report':
+            self.report.callback(loads(rest))
+
+    def processEnded(self, reason):
+        for d in (self.opened, self.report):
+            if not d.called:
+                d.errback(reason)
+        ControlledProcess.processEnded(self, reason)
+
+
+def spawn(proto, *args):
+    cmd = [sys.executable, os.path.abspath(__file__)] + list(args)
+    return reactor.spawnProcess(proto, sys.executable, cmd, env=os.environ)
+
+
+def get_process_cpu(pid):
+    """Returns the user plus system CPU seconds used by *pid*."""
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rpartition(')')[2].split()
+    # utime and stime, fields 14 and 15 of stat(5)
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+
+
+def get_process_rss(pid):
+    """Returns the resident set size of *pid* in MiB."""
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return None
+
+
+def get_percentiles(values, percentiles=PERCENTILES):
+    """Nearest-rank percentiles of *values*, keyed like ``'p99.9'``."""
+    if not values:
+        return dict([('p%s' % p, None) for p in percentiles])
+    values = sorted(values)
+    res = {}
+    for p in percentiles:
+        rank = int(math.ceil(p / 100.0 * len(values)))
+        res['p%s' % p] = values[min(max(rank, 1), len(values)) - 1]
+    return res
+
+
+@inlineCallbacks
+def wait_until(predicate, timeout, interval=0.05):
+    deadline = monotonic() + timeout
+    while not predicate():
+        if monotonic() > deadline:
+            returnValue(False)
+        yield deferLater(reactor, interval, lambda: None)
+    returnValue(True)
+
+
+@inlineCallbacks
+def connect_clients(factory, count):
+    for start in xrange(0, count, CONNECT_BATCH):
+        for _ in xrange(min(CONNECT_BATCH, count - start)):
+            connectWS(factory, timeout=CONNECT_TIMEOUT)
+        target = min(start + CONNECT_BATCH, count)
+        yield wait_until(lambda: (len(factory.opened) + factory.failed
+                                  >= target), CONNECT_TIMEOUT)
+
+
+def split_evenly(total, parts):
+    return [total // parts + (1 if i < total % parts else 0)
+            for i in xrange(parts)]
+
+
+@inlineCallbacks
+def run_level(args, records, speed, client_count):
+    feed = LoadFeedFactory(records, speed)
+    irc_port = reactor.listenTCP(0, feed, interface='127.0.0.1')
+    server = ServerProcess()
+    server_args = ['--serve', '--irc-port', str(irc_port.getHost().port),
+                   '--geo-threads', str(args.geo_threads),
+                   '--loglevel', args.loglevel, '--log-file', args.log_file,
+                   '--log-rate', str(args.log_rate)]
+    if args.geoip_db:
+        server_args += ['--geoip-db', args.geoip_db]
+    server_proc = spawn(server, *server_args)
+    ws_port = yield server.ready
+    yield feed.joined
+
+    procs = min(args.client_processes, client_count)
+    clients = []
+    for count, sample in zip(split_evenly(client_count, procs),
+                             split_evenly(args.sample, procs)):
+        client = ClientProcess()
+        client.proc = spawn(client, '--client-process',
+                            '--ws-port', str(ws_port),
+                            '--clients', str(count), '--sample', str(sample))
+        clients.append(client)
+    connected = sum((yield gatherResults([c.opened for c in clients])))
+
+    pid = server_proc.pid
+    driver_pids = [os.getpid()] + [c.proc.pid for c in clients]
+    rss = {'idle': get_process_rss(pid), 'peak': 0}
+
+    def sample_rss():
+        rss['peak'] = max(rss['peak'], get_process_rss(pid))
+
+    def get_delivered():
+        return sum([c.delivered for c in clients])
+
+    rss_sampler = LoopingCall(sample_rss)
+    rss_sampler.start(0.25)
+    start_cpu = get_process_cpu(pid)
+    start_driver_cpu = sum(map(get_process_cpu, driver_pids))
+    start = monotonic()
+    sent = yield feed.begin()
+    feed_duration = monotonic() - start
+    expected = sent * connected
+    last = [-1, None]
+
+    def drained():
+        delivered = get_delivered()
+        if delivered >= expected:
+            return True
+        if delivered == last[0]:
+            return monotonic() - last[1] > args.drain_timeout
+        last[:] = [delivered, monotonic()]
+        return False
+
+    complete = yield wait_until(drained, args.drain_timeout * 10)
+    wall = monotonic() - start
+    cpu = get_process_cpu(pid) - start_cpu
+    driver_cpu = sum(map(get_process_cpu, driver_pids)) - start_driver_cpu
+    # a run which timed out ended at its last delivery
+    duration = wall
+    if not complete or get_delivered() < expected:
+        duration = last[1] - start
+    rss_sampler.stop()
+    sample_rss()
+
+    for client in clients:
+        client.proc.write('report\n')
+    reports = yield gatherResults([c.report for c in clients])
+    server_proc.signalProcess('TERM')
+    yield gatherResults([p.ended for p in [server] + clients])
+    yield irc_port.stopListening()
+
+    sent_at = feed.sent_at
+    latencies = [(t - sent_at[rev_id]) * 1000
+                 for report in reports
+                 for rev_id, t in report['receipts'] if rev_id in sent_at]
+    delivered = sum([r['delivered'] for r in reports])
+    res = {'clients': client_count,
+           'connected': connected,
+           'client_processes': procs,
+           'sampled_clients': min(args.sample, connected),
+           'messages': sent,
+           'feed_duration': feed_duration,
+           'duration': duration,
+           'ingest_per_sec': sent / feed_duration if feed_duration else None,
+           'delivered': delivered,
+           'undelivered': expected - delivered,
+           'deliveries_per_sec': delivered / duration,
+           'latency_ms': get_percentiles(latencies),
+           'server_cpu_sec': cpu,
+           'server_cpu_percent': 100 * cpu / wall,
+           'server_rss_idle_mb': rss['idle'],
+           'server_rss_peak_mb': rss['peak'],
+           'driver_cpu_percent': 100 * driver_cpu / wall}
+    if latencies:
+        res['latency_ms']['mean'] = sum(latencies) / len(latencies)
+        res['latency_ms']['max'] = max(latencies)
+    returnValue(res)
+
+
+@inlineCallbacks
+def run(args, records, speed, client_counts, results):
+    try:
+        for count in client_counts:
+            res = yield run_level(args, records, speed, count)
+            results.append(res)
+            if args.json:
+                print dumps(res, sort_keys=True)
+                sys.stdout.flush()
+    finally:
+        reactor.stop()
+
+
+def run_clients(args):
+    """Runs one client process: *args.clients* WebSocket clients,
+    controlled over stdio by the load driver.
+    """
+    raise_fd_limit()
+    url = 'ws://127.0.0.1:%d%s' % (args.ws_port, CHANNEL_PATH)
+    factory = LoadClientFactory(url, args.sample)
+    StandardIO(ClientControl(factory, int(args.clients)))
+    reactor.run()
+
+
+class NullGeoIPDatabase(object):
+    def lookup(self, ip):
+        return None
+
+
+class NullGeoIPMonitor(object):
+    geoip_db = NullGeoIPDatabase()
+    cache = None
+
+
+def serve(args):
+    """Runs the server under test: a monitor connected to the load
+    driver's IRC server, and a broadcaster on a free local port.
+    """
+    import wikimon.monitor_websocket as MW
+    from wikimon import monitor_geolite2, geocache, pipeline
+    from wikimon.parsers import DEFAULT_NS_MAP
+
+    from wikimon import logs
+
+    raise_fd_limit()
+    logs.configure(logging.WARN, args.log_file, args.log_rate or None)
+    MW.bcast_log.setLevel(getattr(logging, args.loglevel.upper()))
+    # periodic stats, and the lost IRC connection at the end of a run
+    MW.mon_log.disabled = MW.irc_log.disabled = True
+
+    factory = MW.BroadcastServerFactory('ws://127.0.0.1', channels=[CHANNEL])
+    factory.protocol = MW.BroadcastServerProtocol
+    if args.geoip_db:
+        geo_monitor = monitor_geolite2.MonitorGeoLite2(args.geoip_db,
+                                                       geocache.GeoCache())
+        geo_monitor.update()
+    else:
+        geo_monitor = NullGeoIPMonitor()
+    geo_stage = None
+    if args.geo_threads > 0:
+        geo_stage = pipeline.GeolocationStage(
+            geo_monitor, MW.geolocate_anonymous_user,
+            partial(MW.publish, factory), threads=args.geo_threads)
+    monitor = MW.MonitorFactory(geo_monitor, [CHANNEL], factory,
+                                {CHANNEL: DEFAULT_NS_MAP}, geo_stage)
+    reactor.connectTCP('127.0.0.1', args.irc_port, monitor)
+    port = reactor.listenTCP(0, factory, backlog=1024, interface='127.0.0.1')
+    ws_port = port.getHost().port
+    # clients' Host headers are checked against the URL's port
+    factory.setSessionParameters('ws://127.0.0.1:%d' % ws_port)
+    print 'ready %d' % ws_port
+    sys.stdout.flush()
+    reactor.run()
+
+
+def get_argparser():
+    from argparse import ArgumentParser, SUPPRESS
+    prs = ArgumentParser(description=__doc__.splitlines()[0])
+    prs.add_argument('--clients', default='100,1000,5000',
+                     help='comma-separated client counts, one run each')
+    prs.add_argument('--messages', default=2000, type=int,
+                     help='feed lines per run (with --recording, at most)')
+    prs.add_argument('--rate', default='200',
+                     help='synthetic feed lines per second, or "max"')
+    prs.add_argument('--corpus', default=DEFAULT_CORPUS,
+                     help='raw feed lines for the synthetic feed')
+    prs.add_argument('--recording', default=None,
+                     help='replay this feed recording instead')
+    prs.add_argument('--speed', default='1',
+                     help='with --recording, a multiple of the recorded'
+                     ' pace, or "max"')
+    prs.add_argument('--sample', default=100, type=int,
+                     help='clients to measure latency on')
+    prs.add_argument('--drain-timeout', default=5.0, type=float,
+                     help='seconds without deliveries before a run ends')
+    prs.add_argument('--geoip-db', default=None,
+                     help='geolocate with this GeoLite2 database (default:'
+                     ' lookups find nothing)')
+    prs.add_argument('--geo-threads', default=4, type=int)
+    prs.add_argument('--loglevel', default='WARN',
+                     help='level the server logs broadcasts at, e.g. INFO'
+                     ' to measure the cost of logging')
+    prs.add_argument('--log-file', default=os.devnull,
+                     help='where the server logs to')
+    prs.add_argument('--log-rate', default=10, type=int,
+                     help='most broadcasts the server logs a second (0 for'
+                     ' no limit)')
+    prs.add_argument('--client-processes', default=cpu_count(), type=int,
+                     help='processes to run the clients in (default: one'
+                     ' per core)')
+    prs.add_argument('--json', action='store_true',
+                     help='emit one JSON object per line')
+    prs.add_argument('--serve', action='store_true', help=SUPPRESS)
+    prs.add_argument('--irc-port', default=None, type=int, help=SUPPRESS)
+    prs.add_argument('--client-process', action='store_true', help=SUPPRESS)
+    prs.add_argument('--ws-port', default=None, type=int, help=SUPPRESS)
+    return prs
+
+
+def main():
+    args = get_argparser().parse_args()
+    if args.serve:
+        return serve(args)
+    if args.client_process:
+        return run_clients(args)
+
+    raise_fd_limit()
+    if args.recording:
+        records = get_recorded_records(args.recording, args.messages)
+        speed = None if args.speed == 'max' else float(args.speed)
+    else:
+        rate = None if args.rate == 'max' else float(args.rate)
+        records = get_synthetic_records(args.corpus, args.messages, rate)
+        speed = 1.0 if rate else None
+    client_counts = [int(c) for c in args.clients.split(',')]
+    results = []
+    reactor.callWhenRunning(run, args, records, speed, client_counts,
+                            results)
+    reactor.run()
+
+    if args.json:
+        return
+    print '%8s %9s %9s %9s %9s %9s %7s %7s %8s' % (
+        'clients', 'lines/s', 'msgs/s', 'p50 ms', 'p99 ms', 'lost',
+        'cpu %', 'rss MB', 'driver %')
+    for res in results:
+        lat = res['latency_ms']
+        print '%8d %9.0f %9.0f %9s %9s %9d %7.1f %7.1f %8.1f' % (
+            res['clients'], res['ingest_per_sec'], res['deliveries_per_sec'],
+            '%.2f' % lat['p50'] if lat['p50'] is not None else '-',
+            '%.2f' % lat['p99'] if lat['p99'] is not None else '-',
+            res['undelivered'], res['server_cpu_percent'],
+            res['server_rss_peak_mb'], res['driver_cpu_percent'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Measures IRC line parsing throughput, comparing parse_irc_message
+with the original parse_irc_message_re over a corpus of recent
+changes feed lines.
+
+Colors are stripped and lines decoded ahead of time, so only parsing
+is measured. The lines on which the two parsers disagree are counted
+as mismatches. The corpus is generated, as the feed isn't reachable
+everywhere; ``--recording`` reads the lines of a feed recording made
+with ``monitor_websocket.py --record`` instead.
+
+usage: python benchmarks/bench_parsers.py [--corpus PATH]
+                                          [--recording PATH]
+                                          [--repeat N] [--json]
+"""
+
+import os
+import sys
+import time
+from json import dumps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wikimon.parsers import (parse_irc_message, parse_irc_message_re,
+                             strip_colors)
+from wikimon.feedlog import get_log_paths, read_feed_log
+
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'corpus', 'rc_feed.txt')
+
+
+def load_corpus(path=DEFAULT_CORPUS):
+    with open(path, 'rb') as f:
+        return [strip_colors(line.rstrip('\n')).decode('utf-8')
+                for line in f if line.strip()]
+
+
+def load_recording(path):
+    lines = []
+    for _, _, msg in read_feed_log(get_log_paths(path)):
+        try:
+            lines.append(strip_colors(msg).decode('utf-8'))
+        except UnicodeError:
+            pass  # dropped by the monitor too
+    return lines
+
+
+def parse_both(line):
+    results = []
+    for parse in (parse_irc_message_re, parse_irc_message):
+        try:
+            results.append(parse(line))
+        except KeyError:
+            results.append(KeyError)
+    return results
+
+
+def count_mismatches(lines):
+    count = 0
+    for line in lines:
+        original, fast = parse_both(line)
+        if original != fast:
+            count += 1
+    return count
+
+
+def lines_per_sec(func, lines, repeat):
+    """Best of *repeat* passes over *lines*, as with timeit."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.clock()
+        for line in lines:
+            try:
+                func(line)
+            except KeyError:
+                pass  # not an edit line
+        duration = time.clock() - start
+        best = duration if best is None else min(best, duration)
+    return len(lines) / best
+
+
+def main():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description=__doc__.splitlines()[0])
+    prs.add_argument('--corpus', default=DEFAULT_CORPUS)
+    prs.add_argument('--recording', default=None,
+                     help='parse the lines of this feed recording instead')
+    prs.add_argument('--repeat', default=20, type=int)
+    prs.add_argument('--json', action='store_true',
+                     help='emit the results as a JSON object')
+    args = prs.parse_args()
+
+    if args.recording:
+        lines = load_recording(args.recording)
+    else:
+        lines = load_corpus(args.corpus)
+    res = {'lines': len(lines),
+           'repeat': args.repeat,
+           'mismatches': count_mismatches(lines),
+           'original_lps': lines_per_sec(parse_irc_message_re, lines,
+                                         args.repeat),
+           'fast_lps': lines_per_sec(parse_irc_message, lines,
+                                     args.repeat)}
+    if args.json:
+        print dumps(res, sort_keys=True)
+        return
+    print '%d lines, best of %d, %d mismatches' % (
+        res['lines'], res['repeat'], res['mismatches'])
+    print '%-10s %10.0f lines/s' % ('original', res['original_lps'])
+    print '%-10s %10.0f lines/s (%.2fx)' % (
+        'fast', res['fast_lps'], res['fast_lps'] / res['original_lps'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Measures bulk parsing throughput, from raw feed lines to NDJSON, in
+lines per second and lines per second per core, for parse_irc_stream
+in this process and for parse_irc_bulk over several processes.
+
+usage: python benchmarks/bench_stream.py [--corpus PATH] [--copies N]
+                                         [--processes 1,2,4] [--json]
+"""
+
+import os
+import sys
+import time
+from json import dumps
+from multiprocessing import cpu_count
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wikimon.parsers import parse_irc_stream, write_ndjson
+from wikimon.backfill import parse_irc_bulk
+from bench_parsers import DEFAULT_CORPUS
+
+
+class NullFile(object):
+    def write(self, data):
+        pass
+
+
+def bench_stream(lines):
+    start = time.time()
+    write_ndjson(parse_irc_stream(lines), NullFile())
+    duration = time.time() - start
+    return {'mode': 'stream', 'processes': 1,
+            'lines_per_sec': len(lines) / duration,
+            'lines_per_sec_per_core': len(lines) / duration}
+
+
+def bench_bulk(lines, processes):
+    stats = parse_irc_bulk(lines, NullFile(), processes=processes)
+    rate = stats['lines'] / stats['duration']
+    return {'mode': 'bulk', 'processes': processes,
+            'lines_per_sec': rate,
+            'lines_per_sec_per_core': rate / min(processes, cpu_count())}
+
+
+def main():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description=__doc__.splitlines()[0])
+    prs.add_argument('--corpus', default=DEFAULT_CORPUS)
+    prs.add_argument('--copies', default=50, type=int,
+                     help='times to repeat the corpus')
+    prs.add_argument('--processes', default='1,2,4')
+    prs.add_argument('--json', action='store_true',
+                     help='emit one JSON object per line')
+    args = prs.parse_args()
+
+    with open(args.corpus, 'rb') as f:
+        lines = f.readlines() * args.copies
+    results = [bench_stream(lines)]
+    for processes in [int(p) for p in args.processes.split(',')]:
+        results.append(bench_bulk(lines, processes))
+
+    if args.json:
+        for res in results:
+            res.update(lines=len(lines), cores=cpu_count())
+            print dumps(res, sort_keys=True)
+        return
+    print '%d lines, %d cores' % (len(lines), cpu_count())
+    print '%-8s %9s %14s %18s' % ('mode', 'processes', 'lines/s',
+                                   'lines/s/core')
+    for res in results:
+        print '%-8s %9d %14.0f %18.0f' % (
+            res['mode'], res['processes'], res['lines_per_sec'],
+            res['lines_per_sec_per_core'])
+
+
+if __name__ == '__main__':
+    main()
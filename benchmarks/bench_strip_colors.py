@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Measures IRC color stripping throughput over the feed corpus,
+comparing parsers.strip_colors with the parseFormattedText tree walk
+it replaced.
+
+usage: python benchmarks/bench_strip_colors.py [--corpus PATH]
+                                               [--repeat N] [--json]
+"""
+
+import os
+import sys
+from json import dumps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.words.protocols import irc
+
+from wikimon.parsers import strip_colors
+from bench_parsers import DEFAULT_CORPUS, lines_per_sec
+
+
+def strip_colors_tree(msg):
+    def _extract(formatted):
+        if not hasattr(formatted, 'children'):
+            return formatted
+        return ''.join(map(_extract, formatted.children))
+
+    return _extract(irc.parseFormattedText(msg))
+
+
+def main():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description=__doc__.splitlines()[0])
+    prs.add_argument('--corpus', default=DEFAULT_CORPUS)
+    prs.add_argument('--repeat', default=10, type=int)
+    prs.add_argument('--json', action='store_true',
+                     help='emit the results as a JSON object')
+    args = prs.parse_args()
+
+    with open(args.corpus, 'rb') as f:
+        lines = [line.rstrip('\n') for line in f if line.strip()]
+    mismatches = sum([strip_colors(line) != strip_colors_tree(line)
+                      for line in lines])
+    res = {'lines': len(lines),
+           'repeat': args.repeat,
+           'mismatches': mismatches,
+           'tree_lps': lines_per_sec(strip_colors_tree, lines, args.repeat),
+           'fast_lps': lines_per_sec(strip_colors, lines, args.repeat)}
+    if args.json:
+        print dumps(res, sort_keys=True)
+        return
+    print '%d lines, best of %d, %d mismatches' % (
+        res['lines'], res['repeat'], res['mismatches'])
+    print '%-10s %10.0f lines/s' % ('tree', res['tree_lps'])
+    print '%-10s %10.0f lines/s (%.2fx)' % (
+        'fast', res['fast_lps'], res['fast_lps'] / res['tree_lps'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""An on-disk archive of every broadcast message, and queries over it::
+
+    python wikimon/monitor_websocket.py --archive-dir archive --http-port 9001
+    curl 'localhost:9001/archive/en/?hashtag=1lib1ref&since=1492000000'
+
+Messages are appended from a background thread, so the reactor only
+queues them. Each wiki gets an hourly segment,
+``<dir>/<channel>/<YYYY-MM-DDTHH>.ndjson.gz``, of records like
+``{"ts": 1492000000.123, "msg": {...}}``. Records are gzipped in blocks
+of up to ``block_size`` (or ``flush_interval`` seconds' worth), each a
+gzip member of its own, so a segment is still a valid gzip file, but a
+single block can be read without inflating the ones before it.
+
+Each segment has a sidecar index, ``<YYYY-MM-DDTHH>.idx``, with a line
+of JSON per block: its offset and length, its first and last
+timestamps, and hashes of the hashtags, users and page titles in it.
+Queries read the indexes of the hours asked for, and only inflate the
+blocks which overlap the time range and may hold the key. Segments
+older than ``max_hours`` are deleted as new ones are started.
+"""
+
+import os
+import json
+import time
+import zlib
+import logging
+import calendar
+import threading
+from Queue import Queue, Empty, Full
+
+from twisted.internet.threads import deferToThread
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+import metrics
+
+
+archive_log = logging.getLogger('archive_log')
+
+DEFAULT_MAX_HOURS = 7 * 24
+DEFAULT_BLOCK_SIZE = 512
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_QUEUE_SIZE = 100000
+DEFAULT_QUERY_HOURS = 24
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+SEGMENT_EXT = '.ndjson.gz'
+INDEX_EXT = '.idx'
+HOUR_FORMAT = '%Y-%m-%dT%H'
+KEY_KINDS = ('hashtag', 'user', 'title')
+_STOP = object()
+
+
+def get_hour(ts):
+    return int(ts // 3600) * 3600
+
+
+def get_segment_name(hour):
+    """
+    >>> get_segment_name(1492000000)
+    '2017-04-12T12'
+    """
+    return time.strftime(HOUR_FORMAT, time.gmtime(hour))
+
+
+def parse_segment_name(name):
+    return calendar.timegm(time.strptime(name, HOUR_FORMAT))
+
+
+def hash_key(kind, value):
+    """Hashes a ``(kind, value)`` key for the index. Hashtags are
+    matched without regard to case.
+    """
+    if kind == 'hashtag':
+        value = value.lower()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return zlib.crc32('%s:%s' % (kind[0], value)) & 0xffffffff
+
+
+def get_keys(msg_dict):
+    """Returns the ``(kind, value)`` keys *msg_dict* is indexed by."""
+    keys = [('hashtag', tag) for tag in msg_dict.get('hashtags') or ()]
+    if msg_dict.get('user'):
+        keys.append(('user', msg_dict['user']))
+    if msg_dict.get('page_title'):
+        keys.append(('title', msg_dict['page_title']))
+    return keys
+
+
+def match_key(msg_dict, kind, value):
+    if kind == 'hashtag':
+        value = value.lower()
+        return any([tag.lower() == value
+                    for tag in msg_dict.get('hashtags') or ()])
+    if kind == 'user':
+        return msg_dict.get('user') == value
+    return msg_dict.get('page_title') == value
+
+
+class _Block(object):
+    def __init__(self, hour):
+        self.hour = hour
+        self.lines = []
+        self.keys = set()
+        self.start = self.end = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add(self, ts, msg, msg_dict):
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        self.lines.append('{"ts": %.3f, "msg": %s}\n' % (ts, msg))
+        if self.start is None:
+            self.start = ts
+        self.end = ts
+        if msg_dict is not None:
+            for kind, value in get_keys(msg_dict):
+                self.keys.add(hash_key(kind, value))
+
+    def compress(self, level=6):
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)  # gzip
+        return (compressor.compress(''.join(self.lines))
+                + compressor.flush())
+
+
+class Segment(object):
+    """An hour of one wiki's archive, open for appending."""
+    def __init__(self, dir_path, hour):
+        self.hour = hour
+        base = os.path.join(dir_path, get_segment_name(hour))
+        self.path = base + SEGMENT_EXT
+        self.index_path = base + INDEX_EXT
+        # on restart, drop whatever was written past the last block
+        # which made it into the index
+        entries, index_end = read_index(self.index_path)
+        end = 0
+        if entries:
+            end = entries[-1]['offset'] + entries[-1]['length']
+        self.file = open(self.path, 'ab')
+        self.file.truncate(end)
+        self.file.seek(end)
+        # likewise for a partial index line, which the next entry would
+        # otherwise be appended to
+        self.index_file = open(self.index_path, 'ab')
+        self.index_file.truncate(index_end)
+        self.index_file.seek(index_end)
+
+    def append(self, block):
+        data = block.compress()
+        offset = self.file.tell()
+        self.file.write(data)
+        self.file.flush()
+        entry = {'offset': offset, 'length': len(data), 'count': len(block),
+                 'start': block.start, 'end': block.end,
+                 'keys': sorted(block.keys)}
+        self.index_file.write(json.dumps(entry) + '\n')
+        self.index_file.flush()
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+
+def read_index(index_path):
+    """Returns the entries of a segment's index, skipping a trailing
+    line still being written, and the length in bytes of the lines
+    read.
+    """
+    try:
+        f = open(index_path, 'rb')
+    except IOError:
+        return [], 0
+    entries = []
+    length = 0
+    with f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+            length += len(line)
+    return entries, length
+
+
+def get_segment_hours(dir_path):
+    try:
+        names = os.listdir(dir_path)
+    except OSError:
+        return []
+    hours = []
+    for name in names:
+        if not name.endswith(SEGMENT_EXT):
+            continue
+        try:
+            hours.append(parse_segment_name(name[:-len(SEGMENT_EXT)]))
+        except ValueError:
+            continue
+    return sorted(hours)
+
+
+class ArchiveWriter(object):
+    """Stands in for the broadcaster: queues each message for the
+    archive on the way through to *broadcaster* (which may be None),
+    and writes them out in a thread of its own.
+    """
+    def __init__(self, path, broadcaster=None, max_hours=DEFAULT_MAX_HOURS,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 queue_size=DEFAULT_QUEUE_SIZE, _time=time.time):
+        self.path = path
+        self.broadcaster = broadcaster
+        self.max_hours = max_hours
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.queue = Queue(queue_size)
+        self._time = _time
+        self._blocks = {}  # channel -> _Block
+        self._segments = {}  # channel -> Segment
+        self._thread = None
+        self.dropped = 0
+
+    def broadcast(self, msg, channel, msg_dict=None):
+        self.add(msg, channel, msg_dict)
+        if self.broadcaster is not None:
+            self.broadcaster.broadcast(msg, channel, msg_dict)
+
+    def add(self, msg, channel, msg_dict=None):
+        try:
+            self.queue.put_nowait((self._time(), channel, msg, msg_dict))
+        except Full:
+            # the disk can't keep up; the stream comes first
+            self.dropped += 1
+            metrics.ARCHIVE_DROPPED.inc()
+            return
+        metrics.ARCHIVED_MESSAGES.inc()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='archive')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Writes out everything queued, and closes the archive."""
+        self.queue.put(_STOP)
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                item = None
+            if item is _STOP:
+                self.flush_all()
+                self.close()
+                return
+            try:
+                if item is not None:
+                    self.write(*item)
+                if time.time() >= deadline:
+                    self.flush_all()
+                    deadline = time.time() + self.flush_interval
+            except (IOError, OSError) as e:
+                archive_log.error('could not write to archive %r: %s',
+                                  self.path, e)
+
+    def write(self, ts, channel, msg, msg_dict=None):
+        hour = get_hour(ts)
+        block = self._blocks.get(channel)
+        if block is not None and block.hour != hour:
+            self.flush(channel)
+            block = None
+        if block is None:
+            block = self._blocks[channel] = _Block(hour)
+        block.add(ts, msg, msg_dict)
+        if len(block) >= self.block_size:
+            self.flush(channel)
+
+    def flush(self, channel):
+        block = self._blocks.pop(channel, None)
+        if not block:
+            return
+        self._get_segment(channel, block.hour).append(block)
+
+    def flush_all(self):
+        for channel in self._blocks.keys():
+            self.flush(channel)
+
+    def _get_segment(self, channel, hour):
+        segment = self._segments.get(channel)
+        if segment is not None and segment.hour == hour:
+            return segment
+        if segment is not None:
+            segment.close()
+        dir_path = os.path.join(self.path, channel)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        segment = self._segments[channel] = Segment(dir_path, hour)
+        archive_log.info('started archive segment %s', segment.path)
+        self.prune(dir_path, hour - self.max_hours * 3600)
+        return segment
+
+    def prune(self, dir_path, oldest):
+        for hour in get_segment_hours(dir_path):
+            if hour >= oldest:
+                break
+            base = os.path.join(dir_path, get_segment_name(hour))
+            for path in (base + SEGMENT_EXT, base + INDEX_EXT):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            archive_log.info('deleted archive segment %s', base)
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+
+
+class ArchiveReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.blocks_read = 0
+
+    def query(self, channel, since, until, kind=None, value=None,
+              limit=DEFAULT_LIMIT):
+        """Returns up to *limit* records archived for *channel* between
+        *since* and *until* (in seconds since the epoch), oldest first,
+        and whether there were more. With a *kind* of key
+        (see :data:`KEY_KINDS`), only those with *value* are returned.
+        """
+        dir_path = os.path.join(self.path, channel)
+        key_hash = None
+        if kind is not None:
+            key_hash = hash_key(kind, value)
+        res = []
+        for hour in get_segment_hours(dir_path):
+            if hour + 3600 <= since or hour > until:
+                continue
+            base = os.path.join(dir_path, get_segment_name(hour))
+            entries, _ = read_index(base + INDEX_EXT)
+            entries = [e for e in entries
+                       if e['end'] >= since and e['start'] <= until
+                       and (key_hash is None or key_hash in e['keys'])]
+            if not entries:
+                continue
+            with open(base + SEGMENT_EXT, 'rb') as f:
+                for entry in entries:
+                    for record in self._read_block(f, entry):
+                        if not since <= record['ts'] <= until:
+                            continue
+                        if kind is not None and not match_key(
+                                record['msg'], kind, value):
+                            continue
+                        if len(res) >= limit:
+                            return res, True
+                        res.append(record)
+        return res, False
+
+    def _read_block(self, f, entry):
+        self.blocks_read += 1
+        f.seek(entry['offset'])
+        data = zlib.decompress(f.read(entry['length']), 16 + zlib.MAX_WBITS)
+        return [json.loads(line) for line in data.splitlines()]
+
+
+def _get_query_float(params, name, default):
+    values = params.get(name)
+    if not values:
+        return default
+    try:
+        return float(values[-1])
+    except ValueError:
+        raise ValueError('expected a number for %r, not %r'
+                         % (name, values[-1]))
+
+
+def get_query(params, now):
+    """Picks an archive query out of parsed URL query parameters, as
+    keyword arguments for :meth:`ArchiveReader.query`. Raises
+    ValueError on invalid values.
+    """
+    until = _get_query_float(params, 'until', now)
+    since = _get_query_float(params, 'since',
+                             until - DEFAULT_QUERY_HOURS * 3600)
+    if since > until:
+        raise ValueError('expected since to be before until')
+    limit = int(_get_query_float(params, 'limit', DEFAULT_LIMIT))
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError('expected a limit from 1 to %d' % MAX_LIMIT)
+    query = {'since': since, 'until': until, 'limit': limit}
+    found = [kind for kind in KEY_KINDS if params.get(kind)]
+    if len(found) > 1:
+        raise ValueError('expected one of %s, not %s'
+                         % (', '.join(KEY_KINDS), ', '.join(found)))
+    if found:
+        value = params[found[0]][-1]
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        query['kind'], query['value'] = found[0], value
+    return query
+
+
+class ArchiveResource(Resource):
+    """Queries the archive at *path* for the wikis broadcast by
+    *factory*, off the reactor thread.
+    """
+    isLeaf = True
+
+    def __init__(self, factory, path, _defer=deferToThread,
+                 _time=time.time):
+        Resource.__init__(self)
+        self.factory = factory
+        self.reader = ArchiveReader(path)
+        self._defer = _defer
+        self._time = _time
+
+    def _error(self, request, code, message):
+        request.setResponseCode(code)
+        return json.dumps({'error': message})
+
+    def render_GET(self, request):
+        path = '/' + '/'.join(request.postpath)
+        channel = self.factory.get_path_channel(path)
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        if channel not in self.factory.channels:
+            return self._error(request, 404,
+                               'no wiki is broadcast on %s' % path)
+        try:
+            query = get_query(request.args, self._time())
+        except ValueError as ve:
+            return self._error(request, 400, str(ve))
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d = self._defer(self.reader.query, channel, **query)
+        d.addCallbacks(self._respond, self._fail,
+                       callbackArgs=(request, finished),
+                       errbackArgs=(request, finished))
+        return NOT_DONE_YET
+
+    def _respond(self, result, request, finished):
+        if finished:
+            return  # gone
+        records, truncated = result
+        request.write(json.dumps({'messages': records,
+                                  'truncated': truncated}))
+        request.finish()
+
+    def _fail(self, failure, request, finished):
+        archive_log.error('archive query failed: %s', failure.value)
+        if finished:
+            return
+        request.setResponseCode(500)
+        request.write(json.dumps({'error': 'archive query failed'}))
+        request.finish()
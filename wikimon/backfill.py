@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Bulk parsing of archived IRC feed logs into newline-delimited JSON.
+
+Lines are read in chunks, and each chunk is parsed and serialized in a
+worker process, so the parent only reads and writes. Output is in input
+order::
+
+    python wikimon/backfill.py feed.log.gz -o feed.ndjson --processes 4
+
+Input files may be gzipped, and ``-`` reads stdin or writes stdout.
+"""
+
+import sys
+import gzip
+import time
+import json
+from cStringIO import StringIO
+from itertools import islice
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from parsers import parse_irc_stream, write_ndjson, DEFAULT_NS_MAP
+
+
+DEFAULT_CHUNK_SIZE = 5000
+# chunks in flight per process; Pool.imap would read the whole input
+MAX_PENDING_PER_PROCESS = 2
+
+_worker_ns_map = DEFAULT_NS_MAP
+
+
+def _init_worker(ns_map):
+    global _worker_ns_map
+    _worker_ns_map = ns_map
+
+
+def _parse_chunk(lines):
+    out = StringIO()
+    count = write_ndjson(parse_irc_stream(lines, _worker_ns_map), out)
+    return count, out.getvalue()
+
+
+def iter_chunks(lines, chunk_size=DEFAULT_CHUNK_SIZE):
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_irc_bulk(lines, out_file, ns_map=DEFAULT_NS_MAP, processes=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parses raw feed *lines* in *processes* worker processes (one per
+    core by default; 1 parses in this process), writing NDJSON to
+    *out_file* in input order. Returns a dict of line and record
+    counts, and the time taken.
+    """
+    start = time.time()
+    processes = processes or cpu_count()
+    stats = {'lines': 0, 'records': 0, 'processes': processes}
+
+    def write(result):
+        count, data = result
+        out_file.write(data)
+        stats['records'] += count
+
+    chunks = iter_chunks(lines, chunk_size)
+    if processes == 1:
+        _init_worker(ns_map)
+        for chunk in chunks:
+            stats['lines'] += len(chunk)
+            write(_parse_chunk(chunk))
+        stats['duration'] = time.time() - start
+        return stats
+
+    pool = Pool(processes, _init_worker, (ns_map,))
+    pending = deque()
+    try:
+        for chunk in chunks:
+            stats['lines'] += len(chunk)
+            pending.append(pool.apply_async(_parse_chunk, (chunk,)))
+            if len(pending) >= processes * MAX_PENDING_PER_PROCESS:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+    stats['duration'] = time.time() - start
+    return stats
+
+
+def open_log(path, mode='rb'):
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def get_argparser():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description='parse archived IRC feed logs into'
+                         ' newline-delimited JSON')
+    prs.add_argument('paths', nargs='+', help='feed logs, one raw line per'
+                     ' line (.gz is decompressed)')
+    prs.add_argument('-o', '--output', default='-')
+    prs.add_argument('--processes', default=None, type=int,
+                     help='worker processes (default: one per core)')
+    prs.add_argument('--chunk-size', default=DEFAULT_CHUNK_SIZE, type=int)
+    prs.add_argument('--ns-map', default=None,
+                     help='JSON file mapping the wiki\'s namespace names to'
+                     ' canonical ones (default: English Wikipedia\'s)')
+    return prs
+
+
+def main():
+    args = get_argparser().parse_args()
+    ns_map = DEFAULT_NS_MAP
+    if args.ns_map:
+        with open(args.ns_map) as f:
+            ns_map = json.load(f)
+
+    def iter_lines():
+        for path in args.paths:
+            f = open_log(path)
+            try:
+                for line in f:
+                    yield line
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+
+    out_file = open_log(args.output, 'wb')
+    try:
+        stats = parse_irc_bulk(iter_lines(), out_file, ns_map,
+                               processes=args.processes,
+                               chunk_size=args.chunk_size)
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+    rate = stats['lines'] / stats['duration'] if stats['duration'] else 0
+    sys.stderr.write('%d lines, %d records in %.1fs: %.0f lines/s,'
+                     ' %.0f lines/s/process\n'
+                     % (stats['lines'], stats['records'], stats['duration'],
+                        rate, rate / stats['processes']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""The permessage-deflate WebSocket extension (RFC 7692), which
+autobahn 0.5.14 predates.
+
+wikimon always negotiates it without context takeover in either
+direction, so every message is compressed on its own: the compressed
+frame for a message is the same for all clients, and is built once and
+written to all of them, like uncompressed frames are.
+"""
+
+import zlib
+
+from autobahn.websocket import PreparedMessage
+
+
+EXTENSION = 'permessage-deflate'
+RESPONSE = ('permessage-deflate; server_no_context_takeover;'
+            ' client_no_context_takeover')
+DEFAULT_LEVEL = 6
+# below this, the frame header and deflate block overhead eat into the
+# savings, and compression isn't worth the time
+DEFAULT_MIN_SIZE = 128
+# client messages are small JSON requests; don't inflate past this
+MAX_INFLATED_SIZE = 64 * 1024
+RSV1 = 0x4
+_TAIL = '\x00\x00\xff\xff'
+_WBITS = 15
+_OFFER_PARAMS = ('server_no_context_takeover', 'client_no_context_takeover',
+                 'server_max_window_bits', 'client_max_window_bits')
+
+
+def _parse_offer(offer):
+    parts = [p.strip() for p in offer.split(';')]
+    params = {}
+    for part in parts[1:]:
+        name, _, value = part.partition('=')
+        name, value = name.strip(), value.strip().strip('"')
+        if name in params:
+            raise ValueError('duplicate parameter %r' % name)
+        params[name] = value
+    return parts[0], params
+
+
+def negotiate(offers):
+    """Returns the ``Sec-WebSocket-Extensions`` response accepting the
+    first permessage-deflate offer among *offers* (as sent by the
+    client, one per list item) which wikimon can accept, or None.
+
+    >>> negotiate(['permessage-deflate; client_max_window_bits']) == RESPONSE
+    True
+    >>> negotiate(['x-webkit-deflate-frame']) is None
+    True
+    """
+    for offer in offers:
+        try:
+            name, params = _parse_offer(offer)
+        except ValueError:
+            continue
+        if name != EXTENSION:
+            continue
+        if any([p not in _OFFER_PARAMS for p in params]):
+            continue
+        # frames are shared, so they can't be compressed for a smaller
+        # window just for this client
+        if params.get('server_max_window_bits', str(_WBITS)) != str(_WBITS):
+            continue
+        return RESPONSE
+    return None
+
+
+def compress(payload, level=DEFAULT_LEVEL):
+    """Deflates *payload* as a message of its own, without the empty
+    block trailer, as permessage-deflate frames carry it.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -_WBITS)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-len(_TAIL)]
+
+
+def decompress(data, max_size=MAX_INFLATED_SIZE):
+    """Inflates a message from a client, raising ValueError if it is
+    invalid or larger than *max_size*.
+    """
+    decompressor = zlib.decompressobj(-_WBITS)
+    try:
+        payload = decompressor.decompress(data + _TAIL, max_size)
+    except zlib.error as ze:
+        raise ValueError('invalid compressed message: %s' % ze)
+    if decompressor.unconsumed_tail:
+        raise ValueError('compressed message exceeds %d bytes' % max_size)
+    return payload
+
+
+def prepare_compressed(payload, binary=False):
+    """Frames the already compressed *payload*, with the RSV1 bit that
+    marks it compressed. Like :meth:`prepareMessage`, for servers.
+    """
+    prepared = PreparedMessage(payload, binary, False)
+    frame = prepared.payloadHybi
+    prepared.payloadHybi = chr(ord(frame[0]) | (RSV1 << 4)) + frame[1:]
+    return prepared
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Ingest from Wikimedia's EventStreams service, as an alternative to
+the IRC feed: the ``recentchange`` stream carries every wiki's changes,
+as structured JSON, over a single Server-Sent Events connection::
+
+    python wikimon/monitor_websocket.py --ingest eventstreams --lang en,de
+
+Events for wikis which aren't monitored are dropped as they arrive,
+before they are decoded. The client reconnects when the stream ends,
+fails, or sends nothing for :data:`DEFAULT_READ_TIMEOUT` seconds, and
+resumes after the last event it got (with ``Last-Event-ID``). HTTPS
+streams need pyOpenSSL.
+
+Run as a script, this module is a local stand-in for EventStreams,
+which serves recentchange events from a file of JSON lines::
+
+    python wikimon/eventstreams.py events.ndjson --port 8092 --rate 50
+    python wikimon/monitor_websocket.py --ingest eventstreams \\
+        --stream-url http://localhost:8092/v2/stream/recentchange
+"""
+
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import LoopingCall
+from twisted.protocols.policies import TimeoutMixin
+from twisted.web.client import Agent
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+
+stream_log = logging.getLogger('stream_log')
+
+DEFAULT_STREAM_URL = 'https://stream.wikimedia.org/v2/stream/recentchange'
+STREAM_PATH = '/v2/stream/recentchange'
+USER_AGENT = 'wikimon (wikimon@hatnote.com)'
+MIN_RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 60.0
+# the recentchange stream is never quiet for this long
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_PORT = 8092
+DEFAULT_RATE = 10.0
+
+
+class EventSourceProtocol(Protocol, TimeoutMixin):
+    """Parses a ``text/event-stream`` body, calling *on_event* with the
+    data and ID of each message event. The connection is closed if
+    nothing is received for *read_timeout* seconds.
+    """
+    def __init__(self, on_event, on_done=None, read_timeout=None):
+        self.on_event = on_event
+        self.on_done = on_done
+        self.read_timeout = read_timeout
+        self._buffer = ''
+        self._data = []
+        self._event_type = None
+        self._event_id = None
+
+    def connectionMade(self):
+        self.setTimeout(self.read_timeout)
+
+    def timeoutConnection(self):
+        stream_log.error('nothing received for %ss', self.read_timeout)
+        self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self.lineReceived(line.rstrip('\r'))
+
+    def lineReceived(self, line):
+        if not line:
+            if self._data:
+                if self._event_type in (None, 'message'):
+                    self.on_event('\n'.join(self._data), self._event_id)
+                self._data = []
+            self._event_type = None
+            return
+        if line.startswith(':'):
+            return  # a comment
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            self._data.append(value)
+        elif field == 'event':
+            self._event_type = value
+        elif field == 'id':
+            self._event_id = value
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        if self.on_done is not None:
+            self.on_done(reason)
+
+
+class EventStreamClient(object):
+    """Reads the event stream at *url*, calling *on_event* with the
+    data of each event, and reconnects (with backoff) whenever the
+    stream ends or fails.
+    """
+    def __init__(self, url, on_event, agent=None,
+                 read_timeout=DEFAULT_READ_TIMEOUT, _reactor=reactor):
+        self.url = url
+        self.on_event = on_event
+        self.read_timeout = read_timeout
+        self.reactor = _reactor
+        self.agent = agent or Agent(_reactor)
+        self.last_event_id = None
+        self.delay = MIN_RECONNECT_DELAY
+        self.event_count = 0
+        self.connect_count = 0
+
+    def start(self):
+        self.connect()
+
+    def connect(self):
+        headers = {'Accept': ['text/event-stream'],
+                   'User-Agent': [USER_AGENT]}
+        if self.last_event_id is not None:
+            headers['Last-Event-ID'] = [self.last_event_id]
+        stream_log.info('connecting to %s', self.url)
+        d = self.agent.request('GET', self.url, Headers(headers))
+        d.addCallbacks(self._on_response, self._on_failure)
+        return d
+
+    def _on_response(self, response):
+        if response.code != 200:
+            stream_log.error('%s answered %d %s', self.url, response.code,
+                             response.phrase)
+            self.reconnect()
+            return
+        self.connect_count += 1
+        stream_log.info('connected to %s', self.url)
+        protocol = EventSourceProtocol(self._on_event, self._on_done,
+                                       self.read_timeout)
+        protocol.callLater = self.reactor.callLater
+        response.deliverBody(protocol)
+
+    def _on_event(self, data, event_id):
+        self.delay = MIN_RECONNECT_DELAY
+        self.event_count += 1
+        if event_id is not None:
+            self.last_event_id = event_id
+        self.on_event(data)
+
+    def _on_done(self, reason):
+        stream_log.error('lost %s: %s', self.url, reason.getErrorMessage())
+        self.reconnect()
+
+    def _on_failure(self, failure):
+        stream_log.error('failed to connect to %s: %s', self.url,
+                         failure.getErrorMessage())
+        self.reconnect()
+
+    def reconnect(self):
+        self.reactor.callLater(self.delay, self.connect)
+        self.delay = min(self.delay * 2, MAX_RECONNECT_DELAY)
+
+
+# the stand-in server
+
+class StandInStreamResource(Resource):
+    """Sends the same events, at *rate* per second, to every connected
+    client. *records* is a callable returning an iterable of serialized
+    events; each is given its index as ID, and clients sending a
+    ``Last-Event-ID`` get the events after it first.
+    """
+    isLeaf = True
+
+    def __init__(self, records, rate=DEFAULT_RATE, _reactor=reactor):
+        Resource.__init__(self)
+        self.records = list(records())
+        self.rate = rate
+        self.reactor = _reactor
+        self.clients = set()
+        self.sent = 0
+        self._call = None
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/event-stream; charset=utf-8')
+        request.setHeader('Cache-Control', 'no-cache')
+        last_event_id = request.getHeader('last-event-id')
+        if last_event_id is not None:
+            try:
+                first = int(last_event_id) + 1
+            except ValueError:
+                first = self.sent
+            for i in range(first, self.sent):
+                request.write(self.format_event(i))
+        self.clients.add(request)
+        request.notifyFinish().addBoth(
+            lambda _: self.clients.discard(request))
+        if self._call is None:
+            self._call = LoopingCall(self.send_next)
+            self._call.clock = self.reactor
+            self._call.start(1.0 / self.rate)
+        return NOT_DONE_YET
+
+    def format_event(self, index):
+        return 'event: message\nid: %d\ndata: %s\n\n' % (
+            index, self.records[index])
+
+    def send_next(self):
+        if self.sent >= len(self.records):
+            stream_log.info('sent all %d events', self.sent)
+            self._call.stop()
+            return
+        event = self.format_event(self.sent)
+        for request in self.clients:
+            request.write(event)
+        self.sent += 1
+
+
+def get_stand_in_site(records, rate=DEFAULT_RATE):
+    root = Resource()
+    parent = root
+    for segment in STREAM_PATH.strip('/').split('/')[:-1]:
+        child = Resource()
+        parent.putChild(segment, child)
+        parent = child
+    parent.putChild(STREAM_PATH.rpartition('/')[2],
+                    StandInStreamResource(records, rate))
+    return Site(root)
+
+
+def read_events(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def get_argparser():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description='serve recentchange events from a'
+                         ' file, as EventStreams does')
+    prs.add_argument('path', help='a file of recentchange events, one JSON'
+                     ' object per line')
+    prs.add_argument('--port', default=DEFAULT_PORT, type=int)
+    prs.add_argument('--interface', default='127.0.0.1')
+    prs.add_argument('--rate', default=DEFAULT_RATE, type=float,
+                     help='events per second')
+    return prs
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s\t%(name)s\t %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = get_argparser().parse_args()
+    site = get_stand_in_site(lambda: read_events(args.path), args.rate)
+    reactor.listenTCP(args.port, site, interface=args.interface)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Recording the raw IRC feed, and reading recordings back.
+
+Each record is one line of tab-separated text::
+
+    <monotonic milliseconds>\t<channel>\t<raw IRC message>
+
+The message is the PRIVMSG text exactly as received, color codes and
+all, so a recording can be replayed (see :mod:`replay`) through the
+whole pipeline. Files rotate at a fixed size, as with Twisted's
+LogFile: ``feed.log`` is the current file, ``feed.log.1`` the most
+recently rotated one, and so on.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+
+from twisted.python.logfile import LogFile
+
+
+DEFAULT_ROTATE_LENGTH = 64 * 1024 * 1024
+DEFAULT_MAX_FILES = 10
+_CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_monotonic():
+    try:
+        from time import monotonic  # python 3.3+
+        return monotonic
+    except ImportError:
+        pass
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time  # not linux, close enough for recording
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)):
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic
+
+
+monotonic = _get_monotonic()
+
+
+class FeedRecorder(object):
+    def __init__(self, path, rotate_length=DEFAULT_ROTATE_LENGTH,
+                 max_files=DEFAULT_MAX_FILES, _clock=monotonic):
+        path = os.path.abspath(path)
+        self.log_file = LogFile(os.path.basename(path), os.path.dirname(path),
+                                rotateLength=rotate_length,
+                                maxRotatedFiles=max_files)
+        self._clock = _clock
+        self.count = 0
+
+    def record(self, channel, msg):
+        self.log_file.write('%d\t%s\t%s\n'
+                            % (self._clock() * 1000, channel, msg))
+        self.count += 1
+
+    def flush(self):
+        self.log_file.flush()
+
+    def close(self):
+        self.log_file.close()
+
+
+def get_log_paths(path):
+    """Returns the paths of a recording's files, oldest first."""
+    dirname, basename = os.path.split(os.path.abspath(path))
+    rotated = []
+    for name in os.listdir(dirname or '.'):
+        prefix, _, suffix = name.rpartition('.')
+        if prefix == basename and suffix.isdigit():
+            rotated.append(int(suffix))
+    paths = ['%s.%d' % (path, i) for i in sorted(rotated, reverse=True)]
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read_feed_log(paths):
+    """Yields (seconds since the previous record, channel, message) for
+    each record in the files at *paths*, in order. Negative gaps, as
+    across a reboot, are treated as none.
+    """
+    last = None
+    for path in paths:
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    stamp, channel, msg = line.rstrip('\r\n').split('\t', 2)
+                    stamp = int(stamp)
+                except ValueError:
+                    continue  # e.g., cut off by a crash
+                delay = 0.0 if last is None else max(0, stamp - last) / 1000.0
+                last = stamp
+                yield delay, channel, msg
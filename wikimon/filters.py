@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Server-side subscription filters.
+
+Clients describe the slice of the stream they want with a small spec,
+either in the connection URL's query string::
+
+    ws://wikimon.hatnote.com/en/?ns=Main&is_bot=false&min_change_size=100
+
+or by sending a JSON message over the socket::
+
+    {"filter": {"ns": ["Main", "Talk"], "is_anon": true}}
+
+Specs are normalized into a hashable key, so clients asking for the
+same thing share a single :class:`MessageFilter` (and filter group on
+the broadcast factory), and each message is checked once per distinct
+filter instead of once per client.
+"""
+
+BOOL_FIELDS = ('is_anon', 'is_bot', 'is_minor', 'is_new', 'is_unpatrolled')
+LIST_FIELDS = ('ns', 'action', 'entity_type')
+INT_FIELDS = ('min_change_size',)
+FILTER_FIELDS = BOOL_FIELDS + LIST_FIELDS + INT_FIELDS
+
+_TRUE_STRS = ('true', '1', 'yes')
+_FALSE_STRS = ('false', '0', 'no')
+
+
+def _to_bool(name, value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, basestring):
+        if value.lower() in _TRUE_STRS:
+            return True
+        if value.lower() in _FALSE_STRS:
+            return False
+    raise ValueError('expected true or false for %r, not %r' % (name, value))
+
+
+def _to_list(name, value):
+    if isinstance(value, basestring):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple)):
+        raise ValueError('expected a list for %r, not %r' % (name, value))
+    return tuple(sorted(set([unicode(v).strip() for v in value])))
+
+
+def _to_int(name, value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('expected an integer for %r, not %r' % (name, value))
+
+
+def get_filter_key(spec):
+    """Normalizes a filter spec (a dict) into a hashable key, raising a
+    ValueError for unknown fields or bad values. An empty spec means
+    "everything", and has a key of None.
+
+    >>> get_filter_key({'is_bot': 'false', 'ns': 'Talk,Main'})
+    (('is_bot', False), ('ns', (u'Main', u'Talk')))
+    """
+    if not spec:
+        return None
+    if not isinstance(spec, dict):
+        raise ValueError('expected filter to be an object, not %r' % (spec,))
+    items = []
+    for name, value in spec.items():
+        if name in BOOL_FIELDS:
+            value = _to_bool(name, value)
+        elif name in LIST_FIELDS:
+            value = _to_list(name, value)
+        elif name in INT_FIELDS:
+            value = _to_int(name, value)
+        else:
+            raise ValueError('unknown filter field: %r' % (name,))
+        items.append((str(name), value))
+    return tuple(sorted(items)) or None
+
+
+def get_query_filter_spec(params):
+    """Picks the filter fields out of parsed URL query parameters
+    (a dict of lists, as provided by autobahn), ignoring the rest.
+    """
+    spec = {}
+    for name in FILTER_FIELDS:
+        values = params.get(name)
+        if not values:
+            continue
+        if name in LIST_FIELDS:
+            spec[name] = ','.join(values)
+        else:
+            spec[name] = values[-1]
+    return spec
+
+
+class MessageFilter(object):
+    def __init__(self, key):
+        self.key = key
+        self.checks = []
+        for name, value in key or ():
+            if name in BOOL_FIELDS:
+                self.checks.append(self._make_bool_check(name, value))
+            elif name in LIST_FIELDS:
+                self.checks.append(self._make_list_check(name, value))
+            elif name == 'min_change_size':
+                self.checks.append(self._make_size_check(value))
+
+    @staticmethod
+    def _make_bool_check(name, value):
+        return lambda msg: bool(msg.get(name)) is value
+
+    @staticmethod
+    def _make_list_check(name, value):
+        values = frozenset(value)
+        return lambda msg: msg.get(name) in values
+
+    @staticmethod
+    def _make_size_check(value):
+        def check(msg):
+            change_size = msg.get('change_size')
+            return change_size is not None and abs(change_size) > value
+        return check
+
+    def match(self, msg_dict):
+        for check in self.checks:
+            if not check(msg_dict):
+                return False
+        return True
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.key)
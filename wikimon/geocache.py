@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""A bounded LRU cache with per-entry expiry, for geolocation results.
+
+Anonymous editors tend to come in bursts from the same address, so
+caching the (small) geolocation dict by IP saves most of the GeoLite2
+lookups. IPv6 editors frequently hop between addresses within their
+/64, so optionally the cache can be keyed by that prefix instead.
+
+Hits, misses, evictions and the cache's size are also recorded in
+:mod:`metrics`, to size it by.
+"""
+
+import time
+import socket
+from itertools import islice
+from collections import OrderedDict
+
+import metrics
+
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL = 3600
+
+
+def get_ipv6_prefix(ip, prefix_bytes=8):
+    """Returns a key for the /64 (by default) of an IPv6 address, or
+    None if *ip* is not IPv6.
+
+    >>> get_ipv6_prefix('2001:558:6033:77:453b:b384:fef:e2d9')
+    '2001:558:6033:77::/64'
+    >>> get_ipv6_prefix('192.168.1.1') is None
+    True
+    """
+    if ':' not in ip:
+        return None
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except (socket.error, UnicodeError):
+        return None
+    packed = packed[:prefix_bytes] + '\x00' * (16 - prefix_bytes)
+    return '%s/%d' % (socket.inet_ntop(socket.AF_INET6, packed),
+                      prefix_bytes * 8)
+
+
+class GeoCache(object):
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL,
+                 ipv6_prefix=False, _time=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.ipv6_prefix = ipv6_prefix
+        self._time = _time
+        self._entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.evictions = self.expirations = self.invalidations = 0
+
+    def get_key(self, ip):
+        if self.ipv6_prefix:
+            return get_ipv6_prefix(ip) or ip
+        return ip
+
+    def get(self, ip):
+        key = self.get_key(ip)
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            metrics.GEO_CACHE_MISSES.inc()
+            return None
+        if expires < self._time():
+            self.expirations += 1
+            self.misses += 1
+            metrics.GEO_CACHE_MISSES.inc()
+            metrics.GEO_CACHE_SIZE.set(len(self._entries))
+            return None
+        self._entries[key] = (expires, value)  # most recently used
+        self.hits += 1
+        metrics.GEO_CACHE_HITS.inc()
+        return value
+
+    def set(self, ip, value):
+        key = self.get_key(ip)
+        self._entries.pop(key, None)
+        self._entries[key] = (self._time() + self.ttl, value)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            metrics.GEO_CACHE_EVICTIONS.inc()
+        metrics.GEO_CACHE_SIZE.set(len(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        self.invalidations += 1
+        metrics.GEO_CACHE_SIZE.set(0)
+
+    def get_recent_keys(self, count):
+        """Returns up to *count* keys, most recently used first."""
+        return list(islice(reversed(self._entries), count))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations}
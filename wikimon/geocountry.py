@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""A compact, country-only geolocation database.
+
+Most dashboards only use ``country_name``, but every lookup in the
+GeoLite2 City database walks its search tree and decodes a full
+record. This module flattens the City database's tree into sorted
+arrays of range starts (IPv4 addresses and IPv6 /64 prefixes) mapped
+to small country IDs, written to a file that is memory-mapped, and so
+shared between processes through the page cache. A lookup is a binary
+search over that file.
+
+:class:`CountryDatabase` quacks like a ``geoip`` database, so it plugs
+into :class:`~monitor_geolite2.MonitorGeoLite2` and
+``geolocate_anonymous_user`` unchanged (only ``country_name`` gets
+filled in). Tables are built next to the City database on first use
+(and again when it is updated), or ahead of time with::
+
+    python wikimon/geocountry.py geodb/GeoLite2-City.mmdb
+"""
+
+import os
+import mmap
+import json
+import time
+import struct
+import datetime
+
+import geoip
+
+
+MAGIC = 'WKMNGEO1'
+HEADER = struct.Struct('<8sIIIQ')  # magic, n4, n6, names length, epoch
+TABLE_SUFFIX = '.countries'
+UNKNOWN_ID = 0
+MAX_COUNTRIES = 0xFFFF
+
+_V4_STRUCT = struct.Struct('<I')
+_V6_STRUCT = struct.Struct('<Q')
+_ID_STRUCT = struct.Struct('<H')
+_V4_MAPPED_PREFIX = '\x00' * 10 + '\xff\xff'
+_6TO4_PREFIX = '\x20\x02'  # 2002::/16, an IPv4 address in the next 32 bits
+
+
+def get_table_path(mmdb_path):
+    return mmdb_path + TABLE_SUFFIX
+
+
+def _iter_leaves(db, start_node, bits, stop_node=None):
+    """Yields (range start, record) for the leaves of the subtree at
+    *start_node*, in address order, treating the first *bits* bits of
+    the address as significant. *stop_node* is not descended into, and
+    is yielded as if it were a leaf.
+    """
+    stack = [(start_node, 0, 0)]
+    nodes = db.nodes
+    parse_node = db._parse_node
+    while stack:
+        node, depth, prefix = stack.pop()
+        if node >= nodes or node == stop_node:
+            yield prefix << (bits - depth), node
+            continue
+        if depth == bits:
+            # finer than we keep (IPv6 beyond /64), use the first leaf
+            while node < nodes:
+                node = parse_node(node, 0)
+            yield prefix << (bits - depth), node
+            continue
+        stack.append((parse_node(node, 1), depth + 1, (prefix << 1) | 1))
+        stack.append((parse_node(node, 0), depth + 1, prefix << 1))
+
+
+def _get_country(record):
+    country = record.get('country') if isinstance(record, dict) else None
+    if not country:
+        return None
+    return (country.get('iso_code'), country.get('names') or {})
+
+
+def build_ranges(db, start_node, bits, get_country_id, skip_node=None):
+    starts, ids = [], []
+    offset_ids = {}
+    last_id = None
+    for start, record in _iter_leaves(db, start_node, bits, skip_node):
+        if record <= db.nodes:
+            country_id = UNKNOWN_ID
+        else:
+            offset = record - db.nodes + db.db_size
+            try:
+                country_id = offset_ids[offset]
+            except KeyError:
+                country = _get_country(db._reader.read(offset)[0])
+                country_id = get_country_id(country)
+                offset_ids[offset] = country_id
+        if country_id != last_id:
+            starts.append(start)
+            ids.append(country_id)
+            last_id = country_id
+    return starts, ids
+
+
+def _write_packed(f, code, values, chunk_size=65536):
+    for i in xrange(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        f.write(struct.pack('<%d%s' % (len(chunk), code), *chunk))
+
+
+def build_table(mmdb_path, table_path=None):
+    """Flattens the GeoLite2 database at *mmdb_path* into a country
+    table, written atomically to *table_path*.
+    """
+    table_path = table_path or get_table_path(mmdb_path)
+    db = geoip.open_database(mmdb_path)
+    countries = [None]  # UNKNOWN_ID
+    country_ids = {}
+
+    def get_country_id(country):
+        if country is None:
+            return UNKNOWN_ID
+        key = (country[0], tuple(sorted(country[1].items())))
+        try:
+            return country_ids[key]
+        except KeyError:
+            if len(countries) > MAX_COUNTRIES:
+                raise ValueError('too many distinct countries')
+            country_ids[key] = len(countries)
+            countries.append([country[0], country[1]])
+            return country_ids[key]
+
+    try:
+        v4_start = db._find_start_node(32)
+        v4_starts, v4_ids = build_ranges(db, v4_start, 32, get_country_id)
+        v6_starts, v6_ids = [], []
+        if db.is_ipv6:
+            # IPv4 is mapped into the IPv6 tree (also under 2002::/16),
+            # those addresses are looked up in the IPv4 table instead
+            # (see CountryDatabase.lookup)
+            v6_starts, v6_ids = build_ranges(db, 0, 64, get_country_id,
+                                             skip_node=v4_start)
+        build_epoch = db.get_metadata()['build_epoch']
+    finally:
+        db.close()
+
+    names = json.dumps(countries)
+    tmp_path = '%s.tmp%d' % (table_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(v4_starts), len(v6_starts),
+                            len(names), build_epoch))
+        _write_packed(f, 'I', v4_starts)
+        _write_packed(f, 'H', v4_ids)
+        _write_packed(f, 'Q', v6_starts)
+        _write_packed(f, 'H', v6_ids)
+        f.write(names)
+    os.rename(tmp_path, table_path)
+    return table_path
+
+
+class CountryInfo(object):
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def get_info_dict(self):
+        return self._data
+
+
+class CountryDatabase(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.v4_count, self.v6_count,
+         names_len, self.build_epoch) = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            self._buf.close()
+            raise ValueError('not a country table: %r' % filename)
+        self.v4_starts = HEADER.size
+        self.v4_ids = self.v4_starts + 4 * self.v4_count
+        self.v6_starts = self.v4_ids + 2 * self.v4_count
+        self.v6_ids = self.v6_starts + 8 * self.v6_count
+        names_start = self.v6_ids + 2 * self.v6_count
+        countries = json.loads(self._buf[names_start:names_start + names_len])
+        # results are prebuilt and shared, a lookup allocates nothing
+        self._results = [None] + [
+            CountryInfo({'country': {'iso_code': iso_code, 'names': names}})
+            for iso_code, names in countries[1:]]
+        self.closed = False
+
+    def _search(self, key, count, starts, ids, start_struct):
+        unpack_from = start_struct.unpack_from
+        size = start_struct.size
+        buf = self._buf
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < unpack_from(buf, starts + mid * size)[0]:
+                hi = mid
+            else:
+                lo = mid + 1
+        if not lo:
+            return None
+        country_id = _ID_STRUCT.unpack_from(buf, ids + (lo - 1) * 2)[0]
+        return self._results[country_id]
+
+    def lookup(self, ip_addr):
+        packed = geoip.pack_ip(ip_addr)
+        if len(packed) == 16:
+            if packed[:12] == _V4_MAPPED_PREFIX:
+                packed = packed[12:]
+            elif packed[:2] == _6TO4_PREFIX:
+                packed = packed[2:6]
+        if len(packed) == 4:
+            return self._search(struct.unpack('>I', packed)[0],
+                                self.v4_count, self.v4_starts, self.v4_ids,
+                                _V4_STRUCT)
+        return self._search(struct.unpack('>Q', packed[:8])[0],
+                            self.v6_count, self.v6_starts, self.v6_ids,
+                            _V6_STRUCT)
+
+    def get_metadata(self):
+        return {'node_count': self.v4_count + self.v6_count,
+                'build_epoch': self.build_epoch,
+                'database_type': 'wikimon-country'}
+
+    def get_info(self):
+        return geoip.DatabaseInfo(
+            filename=self.filename,
+            date=datetime.datetime.utcfromtimestamp(self.build_epoch),
+            internal_name='wikimon-country',
+            provider='maxmind')
+
+    def close(self):
+        self.closed = True
+        self._buf.close()
+
+
+def get_build_epoch(mmdb_path):
+    db = geoip.open_database(mmdb_path)
+    try:
+        return db.get_metadata()['build_epoch']
+    finally:
+        db.close()
+
+
+def open_database(mmdb_path):
+    """Opens the country table for the GeoLite2 database at
+    *mmdb_path*, (re)building it first if it is missing or was built
+    from another release of the database. Has the same signature as
+    ``geoip.open_database``.
+    """
+    # releases are told apart by their build epoch, not by file times,
+    # which the update script keeps from upstream
+    table_path = get_table_path(mmdb_path)
+    build_epoch = get_build_epoch(mmdb_path)
+    try:
+        db = CountryDatabase(table_path)
+    except (IOError, ValueError, struct.error):
+        db = None
+    if db is not None and db.build_epoch == build_epoch:
+        return db
+    if db is not None:
+        db.close()
+    build_table(mmdb_path, table_path)
+    return CountryDatabase(table_path)
+
+
+def main():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description='build a country table from a'
+                         ' GeoLite2 City or Country database')
+    prs.add_argument('mmdb_path')
+    prs.add_argument('table_path', nargs='?', default=None)
+    args = prs.parse_args()
+    start = time.time()
+    path = build_table(args.mmdb_path, args.table_path)
+    db = CountryDatabase(path)
+    print ('wrote %s (%d IPv4 ranges, %d IPv6 ranges) in %.1fs'
+           % (path, db.v4_count, db.v6_count, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""A bounded buffer of recently broadcast messages, for replaying to
+clients as they (re)connect::
+
+    ws://wikimon.hatnote.com/en/?replay=50
+    ws://wikimon.hatnote.com/en/?since_rev_id=775894650
+    ws://wikimon.hatnote.com/en/?since=1492000000
+
+Messages are kept serialized, as broadcast, so appending one is only a
+deque append and a length check. Their ``rev_id`` is taken from the
+message dict when the broadcaster has it, or else deserialized the
+first time a client resumes from a ``rev_id``, and kept.
+"""
+
+import time
+from json import loads
+from collections import deque
+
+
+DEFAULT_SIZE = 1000
+DEFAULT_BYTES = 4 * 1024 * 1024
+REPLAY_PARAMS = ('replay', 'since_rev_id', 'since')
+_UNPARSED = object()
+
+
+def _to_number(name, value, type_):
+    try:
+        number = type_(value)
+    except (TypeError, ValueError):
+        raise ValueError('expected a number for %r, not %r' % (name, value))
+    if number < 0:
+        raise ValueError('expected a positive number for %r' % name)
+    return number
+
+
+def get_query_replay(params):
+    """Picks the replay request, if any, out of parsed URL query
+    parameters, as a ``(param, value)`` pair for :meth:`History.get`.
+    Raises ValueError on invalid values or several requests.
+    """
+    found = [name for name in REPLAY_PARAMS if params.get(name)]
+    if not found:
+        return None
+    if len(found) > 1:
+        raise ValueError('expected one of %s, not %s'
+                         % (', '.join(REPLAY_PARAMS), ', '.join(found)))
+    name = found[0]
+    value = params[name][-1]
+    if name == 'since':
+        return name, _to_number(name, value, float)
+    return name, _to_number(name, value, int)
+
+
+def get_initial_seq(_time=time.time):
+    """Returns the sequence number to count broadcast messages from:
+    the time in milliseconds, so that cursors keep increasing across
+    restarts, at up to a thousand messages a second.
+    """
+    return int(_time() * 1000)
+
+
+def _to_rev_id(msg_dict):
+    try:
+        return int(msg_dict.get('rev_id'))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class History(object):
+    def __init__(self, size=DEFAULT_SIZE, max_bytes=DEFAULT_BYTES,
+                 _time=time.time):
+        self.size = size
+        self.max_bytes = max_bytes
+        self._time = _time
+        # [timestamp, msg, rev_id, seq], oldest first
+        self._entries = deque()
+        self.byte_count = 0
+        # the sequence number of the newest message, which is also the
+        # cursor after it
+        self.seq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, msg, msg_dict=None, seq=None):
+        """Appends *msg*, numbered *seq*, or else one more than the
+        last one.
+        """
+        rev_id = _UNPARSED
+        if msg_dict is not None:
+            rev_id = _to_rev_id(msg_dict)
+        if seq is None:
+            seq = self.seq + 1
+        self.seq = seq
+        entries = self._entries
+        entries.append([self._time(), msg, rev_id, seq])
+        self.byte_count += len(msg)
+        while len(entries) > self.size or self.byte_count > self.max_bytes:
+            self.byte_count -= len(entries.popleft()[1])
+
+    def last(self, count):
+        """Returns the last *count* messages, oldest first."""
+        if count <= 0:
+            return []
+        entries = list(self._entries)[-count:]
+        return [entry[1] for entry in entries]
+
+    def after(self, cursor):
+        """Returns the messages numbered after *cursor*, or as many of
+        them as are still buffered.
+        """
+        res = []
+        for entry in reversed(self._entries):
+            if entry[3] <= cursor:
+                break
+            res.append(entry[1])
+        res.reverse()
+        return res
+
+    def since(self, timestamp):
+        """Returns the messages broadcast after *timestamp*, in seconds
+        since the epoch.
+        """
+        res = []
+        for ts, msg, _, _ in reversed(self._entries):
+            if ts <= timestamp:
+                break
+            res.append(msg)
+        res.reverse()
+        return res
+
+    def since_rev_id(self, rev_id):
+        """Returns the messages after the one with *rev_id*. If that is
+        no longer buffered (or was never broadcast), the messages from
+        the first with a greater ``rev_id`` are returned instead.
+        """
+        newer = 0
+        for i, entry in enumerate(reversed(self._entries)):
+            msg_rev_id = entry[2]
+            if msg_rev_id is _UNPARSED:
+                try:
+                    msg_rev_id = _to_rev_id(loads(entry[1]))
+                except ValueError:
+                    msg_rev_id = None
+                entry[2] = msg_rev_id
+            if msg_rev_id is None:
+                continue
+            if msg_rev_id == rev_id:
+                return self.last(i)
+            if msg_rev_id > rev_id:
+                newer = i + 1
+        return self.last(newer)
+
+    def get(self, param, value):
+        """Returns the messages a :func:`get_query_replay` request asks
+        for, or those after a cursor with ``'after'``.
+        """
+        if param == 'replay':
+            return self.last(value)
+        if param == 'since':
+            return self.since(value)
+        if param == 'after':
+            return self.after(value)
+        return self.since_rev_id(value)
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""The broadcast stream over plain HTTP, for consumers behind proxies
+which handle WebSockets badly::
+
+    python wikimon/monitor_websocket.py --http-port 9001
+    curl -N localhost:9001/stream/en/?is_bot=false
+    curl 'localhost:9001/poll/en/?cursor=1234&timeout=25'
+
+``/stream/<wiki>/`` is a Server-Sent Events (``text/event-stream``)
+stream, with each message's ``rev_id`` as its event ID, so that
+reconnecting ``EventSource`` clients resume where they left off.
+``/poll/<wiki>/`` answers with ``{"cursor": N, "messages": [...]}`` as
+soon as there are messages after *cursor*, or after *timeout* seconds;
+clients pass the returned cursor back with their next request. Cursors
+are numbered by the ingest process (see :mod:`workers`), so they hold
+whichever worker answers the next request.
+``/stats/<wiki>/`` answers with the wiki's latest statistics summary
+(see :mod:`stats`), which is also streamed on ``/stream/<wiki>/stats/``,
+and ``/archive/<wiki>/`` queries the archive (see :mod:`archive`).
+
+``/stream/`` takes the same query parameters as WebSocket clients
+(filters, ``batch`` and replay); ``/poll/`` takes the filters, with
+*cursor* in place of replay, and answers with every message past it
+at once, so it rejects ``batch`` and replay parameters. Their clients
+join the broadcast factory's filter groups next to the WebSocket ones:
+messages are filtered once per group, framed once per transport, and
+skipped for clients which are no longer connected, whatever the
+transport. Clients which stop reading are disconnected once
+:data:`MAX_PENDING_BYTES` pile up past their full transport buffer,
+and counted as dropped frames.
+"""
+
+from json import dumps, loads
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from autobahn.websocket import WebSocketProtocol
+
+from filters import get_filter_key, get_query_filter_spec, _to_bool
+import history
+import archive
+
+
+# stand-in wire formats, under which messages are framed for these
+# transports by BroadcastServerFactory.prepare
+EVENT_STREAM = 'text/event-stream'
+LONG_POLL = 'application/json'
+FORMATS = (EVENT_STREAM, LONG_POLL)
+KEEPALIVE_INTERVAL = 15
+# bytes written past a full transport buffer before a client is dropped;
+# enough for a replay of the whole default history
+MAX_PENDING_BYTES = 2 * history.DEFAULT_BYTES
+DEFAULT_POLL_TIMEOUT = 25
+# the cursor replays, and each answer is a batch already
+POLL_REJECTED_PARAMS = ('batch',) + history.REPLAY_PARAMS
+MAX_POLL_TIMEOUT = 60
+STATE_OPEN = WebSocketProtocol.STATE_OPEN
+STATE_CLOSING = WebSocketProtocol.STATE_CLOSING
+STATE_CLOSED = WebSocketProtocol.STATE_CLOSED
+
+
+class PreparedPayload(object):
+    __slots__ = ('data', 'saved')
+
+    def __init__(self, data):
+        self.data = data
+        self.saved = 0
+
+
+def prepare(msg, msg_dict, wire_format):
+    """Frames *msg* for one of the HTTP transports. Events are given
+    the ``rev_id`` of the message (from *msg_dict*, or loaded from
+    *msg* if None) as their ID, if it has one.
+    """
+    if isinstance(msg, unicode):
+        msg = msg.encode('utf-8')
+    if wire_format == LONG_POLL:
+        return PreparedPayload(msg)
+    if msg_dict is None:
+        if msg.startswith('['):
+            return PreparedPayload('data: %s\n\n' % msg)  # a batch
+        msg_dict = loads(msg)
+    rev_id = history._to_rev_id(msg_dict)
+    if rev_id is None:
+        return PreparedPayload('data: %s\n\n' % msg)
+    return PreparedPayload('id: %d\ndata: %s\n\n' % (rev_id, msg))
+
+
+def _get_query_int(params, name, default):
+    values = params.get(name)
+    if not values:
+        return default
+    try:
+        return int(values[-1])
+    except ValueError:
+        raise ValueError('expected a number for %r, not %r'
+                         % (name, values[-1]))
+
+
+class HTTPClient(object):
+    """Quacks enough like a :class:`BroadcastServerProtocol` to be
+    registered with the broadcast factory.
+
+    It is also its request's producer: while the transport's buffer is
+    full, the bytes written to it are counted, and a client more than
+    *max_pending* bytes behind is disconnected. Until it is
+    unregistered, the factory counts its messages as dropped.
+    """
+    wire_format = None
+    deflate = False
+    batch = False
+    filter_key = None
+    answered = False
+
+    def __init__(self, factory, request, channel, _reactor=reactor,
+                 max_pending=MAX_PENDING_BYTES):
+        self.factory = factory
+        self.request = request
+        self.channel = channel
+        self.reactor = _reactor
+        self.max_pending = max_pending
+        self.state = STATE_OPEN
+        self.done = False
+        self.paused = False
+        self.pending = 0
+        self.peerstr = '%s (%s)' % (request.getClientIP(), self.wire_format)
+        request.registerProducer(self, True)
+        request.notifyFinish().addBoth(self._finished)
+
+    def _finished(self, _):
+        self.state = STATE_CLOSED
+        self.done = True
+        self.factory.unregister(self)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.pending = 0
+
+    def stopProducing(self):
+        pass  # the request finishes, see _finished
+
+    def write(self, data):
+        if self.state != STATE_OPEN:
+            return
+        self.request.write(data)
+        if not self.paused:
+            return
+        self.pending += len(data)
+        if self.pending > self.max_pending:
+            # EventSource clients reconnect, and resume from the history
+            self.state = STATE_CLOSING
+            self.request.transport.abortConnection()
+
+    def finish(self, data=''):
+        if self.state != STATE_OPEN:
+            return
+        if data:
+            self.write(data)
+        self.state = STATE_CLOSED
+        # this may be called while the factory iterates over the
+        # client's group, so leave unregistering to _finished, later
+        self.reactor.callLater(0, self._finish_request)
+
+    def _finish_request(self):
+        if not self.done:
+            self.request.unregisterProducer()
+            self.request.finish()
+
+
+class EventStreamClient(HTTPClient):
+    wire_format = EVENT_STREAM
+    transport_name = 'sse'
+
+    def sendPreparedMessage(self, prepared):
+        self.write(prepared.data)
+
+
+class LongPollClient(HTTPClient):
+    wire_format = LONG_POLL
+    transport_name = 'long_poll'
+
+    def __init__(self, factory, request, channel, channel_history, cursor,
+                 _reactor=reactor):
+        HTTPClient.__init__(self, factory, request, channel, _reactor)
+        self.history = channel_history
+        self.cursor = cursor
+
+    def sendPreparedMessage(self, prepared):
+        # with several workers, the cursor may come from one which got
+        # this message before this one did
+        if self.history.seq <= self.cursor:
+            return
+        self.respond([prepared.data])
+
+    def respond(self, msgs):
+        self.answered = True
+        # messages are already serialized; only the envelope is built
+        self.finish('{"cursor": %d, "messages": [%s]}'
+                    % (max(self.cursor, self.history.seq), ','.join(msgs)))
+
+
+class _StreamResource(Resource):
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def _error(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return dumps({'error': message})
+
+    def render_GET(self, request):
+        path = '/' + '/'.join(request.postpath)
+        channel = self.factory.get_path_channel(path)
+        if channel is None:
+            return self._error(request, 404,
+                               'no wiki is broadcast on %s' % path)
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        request.setHeader('Cache-Control', 'no-cache')
+        try:
+            filter_key = get_filter_key(get_query_filter_spec(request.args))
+            return self.render_stream(request, channel, filter_key)
+        except ValueError as ve:
+            return self._error(request, 400, str(ve))
+
+    def render_stream(self, request, channel, filter_key):
+        raise NotImplementedError()
+
+
+class EventStreamResource(_StreamResource):
+    def __init__(self, factory):
+        _StreamResource.__init__(self, factory)
+        self.clients = set()
+
+    def render_stream(self, request, channel, filter_key):
+        batch = request.args.get('batch')
+        batch = _to_bool('batch', batch[-1]) if batch else False
+        replay = history.get_query_replay(request.args)
+        last_event_id = request.getHeader('last-event-id')
+        if replay is None and last_event_id:
+            try:
+                replay = ('since_rev_id', int(last_event_id))
+            except ValueError:
+                pass  # not an ID we sent
+        client = EventStreamClient(self.factory, request, channel)
+        client.filter_key = filter_key
+        client.batch = batch
+        request.setHeader('Content-Type', 'text/event-stream; charset=utf-8')
+        # nginx would otherwise buffer the stream
+        request.setHeader('X-Accel-Buffering', 'no')
+        client.write(':ok\n\n')
+        if replay is not None:
+            self.factory.replay(client, *replay)
+        self.factory.register(client)
+        self.clients.add(client)
+        request.notifyFinish().addBoth(lambda _: self.clients.discard(client))
+        return NOT_DONE_YET
+
+    def keepalive(self):
+        # comments, which keep idle proxies from closing the stream
+        for client in list(self.clients):
+            client.write(':\n\n')
+
+
+class LongPollResource(_StreamResource):
+    def __init__(self, factory, _reactor=reactor):
+        _StreamResource.__init__(self, factory)
+        self.reactor = _reactor
+
+    def render_stream(self, request, channel, filter_key):
+        channel_history = self.factory.histories.get(channel)
+        if channel_history is None:
+            return self._error(request, 501, 'long-polling needs the server'
+                               ' to keep recent messages (--history-size)')
+        rejected = [name for name in POLL_REJECTED_PARAMS
+                    if name in request.args]
+        if rejected:
+            raise ValueError('long-polling takes a cursor, not %s'
+                             % ', '.join(rejected))
+        cursor = _get_query_int(request.args, 'cursor', channel_history.seq)
+        timeout = _get_query_int(request.args, 'timeout',
+                                 DEFAULT_POLL_TIMEOUT)
+        timeout = max(0, min(timeout, MAX_POLL_TIMEOUT))
+        request.setHeader('Content-Type', 'application/json')
+        client = LongPollClient(self.factory, request, channel,
+                                channel_history, cursor, self.reactor)
+        client.filter_key = filter_key
+        msgs = self.factory.get_recent(channel, filter_key, 'after', cursor)
+        if msgs or not timeout:
+            client.respond(msgs)
+            return NOT_DONE_YET
+        self.factory.register(client)
+        call = self.reactor.callLater(timeout, client.respond, [])
+        request.notifyFinish().addBoth(
+            lambda _: call.cancel() if call.active() else None)
+        return NOT_DONE_YET
+
+
+class StatsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def render_GET(self, request):
+        path = '/' + '/'.join(request.postpath)
+        channel = self.factory.get_path_channel(path)
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('Access-Control-Allow-Origin', '*')
+        if channel not in self.factory.channels:
+            request.setResponseCode(404)
+            return dumps({'error': 'no wiki is broadcast on %s' % path})
+        snapshot = self.factory.get_snapshot(channel)
+        if snapshot is None:
+            # disabled, or not summarized yet
+            request.setResponseCode(503)
+            return dumps({'error': 'no statistics for %s yet' % channel})
+        request.setHeader('Cache-Control', 'no-cache')
+        if isinstance(snapshot, unicode):
+            snapshot = snapshot.encode('utf-8')
+        return snapshot
+
+
+def get_site(factory, archive_path=None):
+    """Returns a site serving *factory*'s stream over HTTP, keeping its
+    event streams alive while the reactor runs, and the archive at
+    *archive_path*, if any.
+    """
+    root = Resource()
+    events = EventStreamResource(factory)
+    root.putChild('stream', events)
+    root.putChild('poll', LongPollResource(factory))
+    root.putChild('stats', StatsResource(factory))
+    if archive_path is not None:
+        root.putChild('archive', archive.ArchiveResource(factory,
+                                                         archive_path))
+    LoopingCall(events.keepalive).start(KEEPALIVE_INTERVAL, now=False)
+    site = Site(root)
+    site.noisy = False
+    return site
+
+
+def listen_http(factory, port, interface='', archive_path=None):
+    return reactor.listenTCP(port, get_site(factory, archive_path),
+                             interface=interface)
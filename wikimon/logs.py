@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Logging, kept off the broadcast path.
+
+:func:`configure` sets up the root logger once, at startup, rather than
+at import time: records are handed to a queue, and formatted and
+written to stderr (or ``--log-file``) by a background thread, so a slow
+disk or terminal never holds up fanout. When the queue is full, records
+are dropped and counted, as the stream comes first.
+
+Events which happen for every message or client are logged through a
+:class:`SampledLog`, which decides whether to log before anything is
+formatted: only one in *every* events, and at most *per_second* of
+those a second, are logged, with a count of the ones left out.
+"""
+
+import sys
+import time
+import atexit
+import logging
+import threading
+from Queue import Queue, Full
+
+from twisted.python.log import PythonLoggingObserver
+
+import metrics
+
+
+FORMAT = '%(asctime)s\t%(name)s\t %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_RATE = 10
+_STOP = None
+_writer = None
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on *queue* as they are, for a :class:`LogWriter`
+    to format and write. Callers' arguments are formatted later, on the
+    writer's thread, so shouldn't change once logged.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def handle(self, record):
+        # the queue does its own locking
+        if self.filter(record):
+            self.emit(record)
+            return True
+        return False
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            metrics.LOG_DROPPED.inc()
+
+
+class LogWriter(object):
+    """Passes the records queued by a :class:`QueueHandler` on to
+    *handlers*, in a thread of its own.
+    """
+    def __init__(self, handlers, queue_size=DEFAULT_QUEUE_SIZE):
+        self.handlers = list(handlers)
+        self.queue = Queue(queue_size)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='log writer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Writes out every queued record, then stops the thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self._thread.join()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.flush()
+
+
+class SampledLog(object):
+    """Logs to *logger* at *level* for events which happen too often
+    to log each time. Arguments are only formatted for the events which
+    are logged.
+    """
+    per_second = DEFAULT_RATE  # set by configure, for all of them
+
+    def __init__(self, logger, level=logging.INFO, every=1,
+                 per_second=None, _time=time.time):
+        self.logger = logger
+        self.level = level
+        self.every = every
+        if per_second is not None:
+            self.per_second = per_second
+        self._time = _time
+        self.count = 0
+        self.suppressed = 0
+        self._second = 0
+        self._logged = 0
+
+    def log(self, msg, *args):
+        """Logs *msg*, if this event is sampled, its level is enabled,
+        and the rate limit allows. Returns whether it was logged.
+        """
+        self.count += 1
+        if self.every > 1 and self.count % self.every:
+            return False
+        if not self.logger.isEnabledFor(self.level):
+            return False
+        if self.per_second:
+            second = int(self._time())
+            if second != self._second:
+                self._second = second
+                self._logged = 0
+            if self._logged >= self.per_second:
+                self.suppressed += 1
+                return False
+            self._logged += 1
+        if self.suppressed:
+            msg += ' (%d similar suppressed)'
+            args += (self.suppressed,)
+            self.suppressed = 0
+        self.logger.log(self.level, msg, *args)
+        return True
+
+
+def configure(level=logging.INFO, path=None, rate=DEFAULT_RATE,
+              queue_size=DEFAULT_QUEUE_SIZE):
+    """Sends every log record (Twisted's too) at *level* and up to
+    *path*, or stderr, from a background thread, and limits each
+    :class:`SampledLog` to *rate* records a second (None for no
+    limit). Only the first call sets anything up; it returns the
+    :class:`LogWriter`.
+    """
+    global _writer
+    SampledLog.per_second = rate
+    if _writer is not None:
+        return _writer
+    if path:
+        handler = logging.FileHandler(path)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    _writer = LogWriter([handler], queue_size).start()
+    atexit.register(_writer.stop)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(_writer.queue))
+    root.setLevel(level)
+    PythonLoggingObserver().start()
+    return _writer
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""Counters, gauges and latency histograms for the message pipeline,
+served over HTTP in the Prometheus text format::
+
+    python wikimon/monitor_websocket.py --metrics-port 9100
+    curl localhost:9100/metrics
+
+Recording a value is a few attribute lookups and an addition (plus a
+bisect for histograms), cheap enough to do for every message. Metrics
+are process-wide, in :data:`REGISTRY`; the ones the pipeline records
+are defined at the bottom of this module.
+"""
+
+import time
+from bisect import bisect_left
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from 10 microseconds up
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005,
+                   0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# seconds, for slow operations like loading a database
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+
+timer = time.time
+
+
+def _format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, _escape(value))
+                              for name, value in pairs])
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n').encode('utf-8'))
+
+
+class _CounterValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+
+class _GaugeValue(_CounterValue):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue(object):
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name):
+        res, total = [], 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            res.append((name + '_bucket', (('le', bound),), total))
+        res.append((name + '_sum', (), self.sum))
+        res.append((name + '_count', (), total))
+        return res
+
+
+class _Metric(object):
+    """A metric family: one value per combination of label values,
+    got with :meth:`labels`. Without label names, the metric's own
+    methods (inc, observe, etc.) record to its single value.
+    """
+    kind = None
+
+    def __init__(self, name, doc, label_names=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(label_names)
+        self._values = {}
+        if not self.label_names:
+            self._default = self.labels()
+
+    def _new_value(self):
+        raise NotImplementedError()
+
+    def labels(self, *label_values):
+        try:
+            return self._values[label_values]
+        except KeyError:
+            if len(label_values) != len(self.label_names):
+                raise ValueError('expected labels %r, not %r'
+                                 % (self.label_names, label_values))
+            value = self._values[label_values] = self._new_value()
+            return value
+
+    def clear(self):
+        """Drops the values of every combination of labels."""
+        self._values.clear()
+        if not self.label_names:
+            self._default = self.labels()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for label_values, value in sorted(self._values.items()):
+            for name, extra, sample in value.samples(self.name):
+                labels = _format_labels(self.label_names, label_values,
+                                        [(k, _format_value(v))
+                                         for k, v in extra])
+                lines.append('%s%s %s' % (name, labels,
+                                          _format_value(sample)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def dec(self, amount=1):
+        self._default.value -= amount
+
+    def set(self, value):
+        self._default.value = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, doc, label_names)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        if any([m.name == metric.name for m in self.metrics]):
+            raise ValueError('duplicate metric %r' % metric.name)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *a, **kw):
+        return self.register(Counter(*a, **kw))
+
+    def gauge(self, *a, **kw):
+        return self.register(Gauge(*a, **kw))
+
+    def histogram(self, *a, **kw):
+        return self.register(Histogram(*a, **kw))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', CONTENT_TYPE)
+        return self.registry.render()
+
+
+def listen_metrics(port, interface='', registry=None):
+    """Serves *registry* (by default :data:`REGISTRY`) on every path of
+    an HTTP server on *port*.
+    """
+    site = Site(MetricsResource(registry or REGISTRY))
+    site.noisy = False
+    return reactor.listenTCP(port, site, interface=interface)
+
+
+REGISTRY = Registry()
+
+STAGES = ('receive', 'strip_colors', 'parse', 'geo', 'json', 'fanout',
+          'batch_fanout', 'encode', 'deflate')
+STAGE_SECONDS = REGISTRY.histogram(
+    'wikimon_stage_seconds', 'Time spent on one message (or batch) in'
+    ' each stage of the pipeline.', ['stage'])
+RECEIVE_SECONDS, STRIP_COLORS_SECONDS, PARSE_SECONDS, GEO_SECONDS, \
+    JSON_SECONDS, FANOUT_SECONDS, BATCH_FANOUT_SECONDS, ENCODE_SECONDS, \
+    DEFLATE_SECONDS = [STAGE_SECONDS.labels(stage) for stage in STAGES]
+
+IRC_MESSAGES = REGISTRY.counter(
+    'wikimon_irc_messages_total', 'Messages received from IRC.', ['channel'])
+STREAM_EVENTS = REGISTRY.counter(
+    'wikimon_stream_events_total', 'Events received from EventStreams for'
+    ' the monitored wikis.', ['channel'])
+BROADCAST_MESSAGES = REGISTRY.counter(
+    'wikimon_broadcast_messages_total', 'Messages broadcast to clients.',
+    ['channel'])
+SENT_FRAMES = REGISTRY.counter(
+    'wikimon_sent_frames_total', 'Frames written to clients.')
+BATCHES = REGISTRY.counter(
+    'wikimon_batches_total', 'Batches of messages sent to batching'
+    ' clients.')
+DROPPED_FRAMES = REGISTRY.counter(
+    'wikimon_dropped_frames_total', 'Frames not sent, as the client was no'
+    ' longer open or could not keep up.')
+REPLAYED_MESSAGES = REGISTRY.counter(
+    'wikimon_replayed_messages_total', 'Recent messages (or batches of them)'
+    ' replayed to clients on connect.')
+ARCHIVED_MESSAGES = REGISTRY.counter(
+    'wikimon_archived_messages_total', 'Messages queued for the archive.')
+ARCHIVE_DROPPED = REGISTRY.counter(
+    'wikimon_archive_dropped_total', 'Messages not archived, as the archive'
+    ' queue was full.')
+LOG_DROPPED = REGISTRY.counter(
+    'wikimon_log_dropped_total', 'Log records not written, as the log queue'
+    ' was full.')
+DEFLATE_SAVED_BYTES = REGISTRY.counter(
+    'wikimon_deflate_saved_bytes_total', 'Bytes not written to clients'
+    ' thanks to permessage-deflate compression.')
+GEO_TIMEOUTS = REGISTRY.counter(
+    'wikimon_geo_timeouts_total', 'Messages sent without geolocation, as the'
+    ' lookup took too long.')
+GEO_CACHE_HITS = REGISTRY.counter(
+    'wikimon_geo_cache_hits_total', 'Geolocation lookups answered from the'
+    ' cache.')
+GEO_CACHE_MISSES = REGISTRY.counter(
+    'wikimon_geo_cache_misses_total', 'Geolocation lookups not in the cache,'
+    ' or expired.')
+GEO_CACHE_EVICTIONS = REGISTRY.counter(
+    'wikimon_geo_cache_evictions_total', 'Geolocation results evicted from'
+    ' the full cache.')
+GEO_CACHE_SIZE = REGISTRY.gauge(
+    'wikimon_geo_cache_size', 'Geolocation results in the cache.')
+GEOIP_RELOADS = REGISTRY.counter(
+    'wikimon_geoip_reloads_total', 'GeoLite2 databases swapped in after'
+    ' the first.')
+GEOIP_FAILED_RELOADS = REGISTRY.counter(
+    'wikimon_geoip_failed_reloads_total', 'GeoLite2 databases which failed'
+    ' to load or validate.')
+GEOIP_LOAD_SECONDS = REGISTRY.histogram(
+    'wikimon_geoip_load_seconds', 'Time spent opening, validating and'
+    ' warming up a GeoLite2 database.', buckets=SLOW_BUCKETS)
+GEOIP_INFO = REGISTRY.gauge(
+    'wikimon_geoip_info', 'The GeoLite2 database in use, always 1.',
+    ['md5', 'build_epoch'])
+TRANSPORTS = ('websocket', 'sse', 'long_poll')
+CLIENTS = REGISTRY.gauge(
+    'wikimon_clients', 'Connected clients, by transport: WebSocket,'
+    ' Server-Sent Events or a waiting long-poll.', ['transport'])
+CONNECTS = REGISTRY.counter(
+    'wikimon_client_connects_total', 'Clients connected, by transport.',
+    ['transport'])
+DISCONNECTS = REGISTRY.counter(
+    'wikimon_client_disconnects_total', 'Clients disconnected, by'
+    ' transport.', ['transport'])
+for transport in TRANSPORTS:
+    for metric in (CLIENTS, CONNECTS, DISCONNECTS):
+        metric.labels(transport)
+START_TIME = REGISTRY.gauge(
+    'wikimon_start_time_seconds', 'When the process started, in seconds'
+    ' since the epoch.')
+START_TIME.set(time.time())
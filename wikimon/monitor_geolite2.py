@@ -1,34 +1,83 @@
 import time
-from twisted.python import log, filepath
+import hashlib
+from twisted.python import filepath
+from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
 from twisted.internet.task import LoopingCall
 import geoip
-
-observer = log.PythonLoggingObserver()
-observer.start()
+import metrics
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None  # not on linux
 
 import logging
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s\t%(name)s\t %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger(__name__)
 
 
 DEFAULT_INTERVAL = 30
+# wait for writes to a changed file to settle before reloading it
+SETTLE_DELAY = 2.0
+WARM_SAMPLE_SIZE = 500
+# a handful of addresses which resolve in any sane City/Country db
+VALIDATION_IPS = ['8.8.8.8', '128.59.0.1', '2001:4860:4860::8888']
+
+
+class InvalidDatabase(ValueError):
+    pass
+
+
+def get_md5(path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def validate_database(geoip_db):
+    """Raises InvalidDatabase unless *geoip_db* looks like a complete
+    GeoLite2 database. Truncated files generally fail to open at all
+    (the metadata is at the end), this catches the rest.
+    """
+    md = geoip_db.get_metadata()
+    if not md.get('node_count') or 'build_epoch' not in md:
+        raise InvalidDatabase('incomplete metadata: %r' % (md,))
+    found = 0
+    for ip in VALIDATION_IPS:
+        try:
+            if geoip_db.lookup(ip):
+                found += 1
+        except Exception as e:
+            raise InvalidDatabase('lookup of %r failed: %r' % (ip, e))
+    if not found:
+        raise InvalidDatabase('no validation IPs found')
 
 
 class MonitorGeoLite2(object):
     geoip_db = None
 
-    def __init__(self, path):
+    def __init__(self, path, cache=None, open_database=geoip.open_database):
         self.last_modified = time.time()
         self.fp = filepath.FilePath(path)
+        self.cache = cache
+        self.open_database = open_database
+        self.notifier = None
+        self._settle_call = None
+        self.reload_count = 0
+        self.failed_reload_count = 0
+        self.load_duration = None
+        self.md5 = None
+        self.build_date = None
+        self.build_epoch = None
 
     def log_error(self, failure):
+        self.failed_reload_count += 1
+        metrics.GEOIP_FAILED_RELOADS.inc()
         logger.error(str(failure))
 
-    def load_if_new(self, force=False):
+    def load_if_new(self, force=False, warm_ips=()):
         self.fp.restat()
         modified = self.fp.getModificationTime()
         if not force and modified <= self.last_modified:
@@ -36,25 +85,131 @@ class MonitorGeoLite2(object):
         logger.info('%r modified: %s > %s', self.fp,
                     modified, self.last_modified)
         self.last_modified = modified
-        return geoip.open_database(self.fp.realpath().path)
+        return self.load(warm_ips)
+
+    def load(self, warm_ips=()):
+        """Opens, validates and warms up the database. Runs in a thread
+        (except at startup); returns the new database and its info for
+        :meth:`store` to swap in on the reactor thread.
+        """
+        start = time.time()
+        path = self.fp.realpath().path
+        new_geoip_db = self.open_database(path)
+        try:
+            validate_database(new_geoip_db)
+            self.warm(new_geoip_db, warm_ips)
+            info = {'md5': get_md5(path),
+                    'build_date': new_geoip_db.get_info().date,
+                    'build_epoch':
+                    new_geoip_db.get_metadata()['build_epoch']}
+        except Exception:
+            new_geoip_db.close()
+            raise
+        info['load_duration'] = time.time() - start
+        return new_geoip_db, info
+
+    def get_warm_ips(self):
+        if self.cache is None:
+            return []
+        # cache keys may be IPv6 /64 prefixes; the network address works
+        return [key.partition('/')[0]
+                for key in self.cache.get_recent_keys(WARM_SAMPLE_SIZE)]
 
-    def store(self, new_geoip_db):
+    def warm(self, geoip_db, warm_ips):
+        """Looks up a sample of recently seen IPs, so the first lookups
+        after the swap do not all hit cold pages.
+        """
+        for ip in warm_ips:
+            try:
+                geoip_db.lookup(ip)
+            except Exception:
+                pass
+
+    def store(self, new_geoip_db, info=None):
         if new_geoip_db:
+            is_reload = self.geoip_db is not None
             # atomic
             self.geoip_db = new_geoip_db
-            logger.info('swapped geoips')
+            if self.cache is not None:
+                # results from the old database are stale now
+                self.cache.clear()
+            if is_reload:
+                self.reload_count += 1
+                metrics.GEOIP_RELOADS.inc()
+            if info:
+                self.md5 = info['md5']
+                self.build_date = info['build_date']
+                self.build_epoch = info.get('build_epoch')
+                self.load_duration = info['load_duration']
+                metrics.GEOIP_LOAD_SECONDS.observe(self.load_duration)
+                metrics.GEOIP_INFO.clear()
+                metrics.GEOIP_INFO.labels(self.md5, self.build_epoch).set(1)
+            logger.info('swapped geoips: %r', self.get_stats())
+
+    def _store_loaded(self, loaded):
+        if loaded:
+            self.store(*loaded)
 
     def update(self):
-        self.store(self.load_if_new(True))
+        self._store_loaded(self.load_if_new(True))
 
     def check_and_update(self):
-        d = deferToThread(self.load_if_new)
-        d.addCallbacks(self.store, self.log_error)
+        # sample the cache here, as it is only touched on this thread
+        d = deferToThread(self.load_if_new, False, self.get_warm_ips())
+        d.addCallbacks(self._store_loaded, self.log_error)
         return d
 
+    def watch(self):
+        """Reloads on inotify events for the database file, returning
+        False if inotify is not available.
+        """
+        if inotify is None:
+            return False
+        try:
+            notifier = inotify.INotify()
+        except inotify.INotifyError:
+            return False
+        notifier.startReading()
+        # watch the directory, as update_geodb.sh moves the new file in
+        mask = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+                | inotify.IN_CREATE)
+        notifier.watch(self.fp.realpath().parent(), mask=mask,
+                       callbacks=[self._on_change])
+        self.notifier = notifier
+        return True
+
+    def _on_change(self, ignored, changed_fp, mask):
+        if changed_fp.basename() != self.fp.realpath().basename():
+            return
+        if self._settle_call is not None and self._settle_call.active():
+            self._settle_call.reset(SETTLE_DELAY)
+            return
+        self._settle_call = reactor.callLater(SETTLE_DELAY,
+                                              self.check_and_update)
+
+    def log_stats(self):
+        logger.info('geoip stats: %r', self.get_stats())
+
+    def get_stats(self):
+        stats = {'reload_count': self.reload_count,
+                 'failed_reload_count': self.failed_reload_count,
+                 'load_duration': self.load_duration,
+                 'md5': self.md5,
+                 'build_epoch': self.build_epoch,
+                 'build_date': (self.build_date.isoformat()
+                                if self.build_date else None),
+                 'watching': self.notifier is not None}
+        if self.cache is not None:
+            stats['cache'] = self.cache.get_stats()
+        return stats
+
 
-def begin(path, interval):
-    monitor = MonitorGeoLite2(path)
+def begin(path, interval, cache=None, open_database=geoip.open_database):
+    monitor = MonitorGeoLite2(path, cache, open_database)
     monitor.update()
-    LoopingCall(monitor.check_and_update).start(interval)
+    if not monitor.watch():
+        logger.info('inotify unavailable, polling %r every %ss',
+                    path, interval)
+        LoopingCall(monitor.check_and_update).start(interval)
+    LoopingCall(monitor.log_stats).start(interval, now=False)
     return monitor
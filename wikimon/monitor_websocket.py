@@ -1,75 +1,160 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
-from json import dumps
+from json import dumps, loads
+from functools import partial
 from os.path import dirname, abspath
 
 from twisted.words.protocols import irc
 from twisted.internet import reactor, protocol
 from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
 from autobahn.websocket import (WebSocketServerFactory,
                                 WebSocketServerProtocol,
+                                WebSocketProtocol,
+                                HttpException,
                                 listenWS)
+from autobahn import httpstatus
 
-import wapiti
-from parsers import parse_irc_message
+import geoip
+from parsers import (parse_irc_message, parse_recentchange,
+                     get_recentchange_channel, peek_recentchange_channel,
+                     strip_colors, DEFAULT_NS_MAP,
+                     add_entity_fields, WIKIDATA_LANG, WIKIDATA_CHANNEL)
 import monitor_geolite2
+import geocountry
+import workers
+import geocache
+import pipeline
+import feedlog
+import metrics
+import wire
+import deflate
+import history
+import httpstream
+import nsmaps
+import eventstreams
+import stats
+import archive
+import logs
+from metrics import timer
+from filters import (MessageFilter, get_filter_key, get_query_filter_spec,
+                     _to_bool)
 
 
 DEBUG = False
 DEFAULT_GEOIP_DB = dirname(dirname(abspath(__file__))) + '/geodb/GeoLite2-City.mmdb'
 
 import logging
-from twisted.python.log import PythonLoggingObserver
-observer = PythonLoggingObserver()
-observer.start()
-
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s\t%(name)s\t %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
 bcast_log = logging.getLogger('bcast_log')
 mon_log = logging.getLogger('mon_log')
 irc_log = logging.getLogger('irc_log')
-api_log = logging.getLogger('api_log')
+# per-message and per-client events, logged a few times a second at most
+# one per kind of event, so that each counts only its own suppressed lines
+broadcast_sample = logs.SampledLog(bcast_log)
+register_sample = logs.SampledLog(bcast_log)
+unregister_sample = logs.SampledLog(bcast_log)
+filter_sample = logs.SampledLog(bcast_log)
+batch_sample = logs.SampledLog(bcast_log)
+replay_sample = logs.SampledLog(bcast_log)
+bad_irc_sample = logs.SampledLog(bcast_log, logging.WARNING)
+bad_event_sample = logs.SampledLog(bcast_log, logging.WARNING)
 LAST_FORCED_LOG = 0
 FORCE_LOG_THRESH = 120
 
 DEFAULT_LANG = 'en'
 DEFAULT_PROJECT = 'wikipedia'
 DEFAULT_BCAST_PORT = 9000
-IRC_SERVER_HOST = 'irc.wikimedia.org'
-IRC_SERVER_PORT = 6667
+# e.g., IRC_SERVER_HOST=localhost to use a local replay server
+IRC_SERVER_HOST = os.getenv('IRC_SERVER_HOST', 'irc.wikimedia.org')
+IRC_SERVER_PORT = int(os.getenv('IRC_SERVER_PORT', 6667))
+RECORD_FLUSH_INTERVAL = 1.0
+DEFAULT_PATH = '/'
+INGESTS = ('irc', 'eventstreams')
+DEFAULT_INGEST = 'irc'
+# what opens the GeoLite2 database for each --geo-precision
+GEO_PRECISIONS = {'city': geoip.open_database,
+                  'country': geocountry.open_database}
+DEFAULT_GEO_PRECISION = 'city'
+STATE_OPEN = WebSocketProtocol.STATE_OPEN
+# clients which opt into batching get a JSON array of the messages
+# from each window of this many seconds, or of this many messages
+DEFAULT_BATCH_WINDOW = 0.1
+DEFAULT_BATCH_SIZE = 100
+# what autobahn, which knows no extensions, calls a compressed frame
+RSV_VIOLATION = 'RSV != 0 and no extension negotiated'
 
 
-def strip_colors(msg):
-    def _extract(formatted):
-        if not hasattr(formatted, 'children'):
-            return formatted
-        return ''.join(map(_extract, formatted.children))
+def get_channel(lang, project=DEFAULT_PROJECT):
+    """Returns the IRC channel of *lang*'s *project*, or Wikidata's,
+    whatever the project.
 
-    return _extract(irc.parseFormattedText(msg))
+    >>> get_channel('en', 'wiktionary')
+    'en.wiktionary'
+    >>> get_channel('wikidata', 'wiktionary')
+    'wikidata.wikipedia'
+    """
+    if lang == WIKIDATA_LANG:
+        return WIKIDATA_CHANNEL
+    return '%s.%s' % (lang, project)
 
 
-def geolocate_anonymous_user(geoip_db, ip, lang='en'):
-    geo_loc = {}
+def get_channel_path(channel):
+    """Returns the WebSocket path clients connect on to receive
+    messages for *channel*. Wikipedias keep their historical short
+    paths:
+
+    >>> get_channel_path('en.wikipedia')
+    '/en/'
+    >>> get_channel_path('en.wiktionary')
+    '/en.wiktionary/'
+    """
+    if channel == WIKIDATA_CHANNEL:
+        return '/%s/' % WIKIDATA_LANG
+    lang, _, project = channel.partition('.')
+    if project == DEFAULT_PROJECT:
+        return '/%s/' % lang
+    return '/%s/' % channel
+
 
+_INFO_TO_GEOLOC = {}
+
+
+def get_info_to_geoloc(lang):
+    try:
+        return _INFO_TO_GEOLOC[lang]
+    except KeyError:
+        pass
     localized = ['names', lang]
     info_to_geoloc = {'country_name': ['country'] + localized,
                       'latitude': ['location', 'latitude'],
                       'longitude': ['location', 'longitude'],
                       'region_name': ['subdivisions', 0] + localized,
                       'city': ['city'] + localized}
+    _INFO_TO_GEOLOC[lang] = info_to_geoloc.items()
+    return _INFO_TO_GEOLOC[lang]
+
+
+def geolocate_anonymous_user(geoip_db, ip, lang='en'):
+    """Returns the location of *ip*, empty if it is unknown, or None if
+    the lookup failed (e.g., while the database is being swapped), so
+    that the failure isn't cached.
+    """
+    geo_loc = {}
+
+    info_to_geoloc = get_info_to_geoloc(lang)
     try:
         result = geoip_db.lookup(ip)
         if not result:
             return geo_loc
     except Exception:
         bcast_log.exception('geoip lookup failed for %r', ip)
-        return geo_loc
+        return None
 
     info = result.get_info_dict()
 
-    for dst, src_items in info_to_geoloc.items():
+    for dst, src_items in info_to_geoloc:
         cursor = info
         for src in src_items:
             try:
@@ -88,56 +173,159 @@ class Monitor(irc.IRCClient):
     # sometimes prevents joining rooms.
 
     nickname = 'wikimon2'
-    GEO_IP_KEY = 'geo_ip'
+    GEO_IP_KEY = pipeline.GEO_IP_KEY
 
-    def __init__(self, geoip_db_monitor, bsf, ns_map, factory):
+    def __init__(self, geoip_db_monitor, bsf, ns_maps, factory,
+                 geo_stage=None, recorder=None):
         self.geoip_db_monitor = geoip_db_monitor
         self.broadcaster = bsf
-        self.ns_map = ns_map
+        self.ns_maps = ns_maps
         self.factory = factory
+        self.geo_stage = geo_stage
+        self.recorder = recorder
+        self.line_received_at = None
         irc_log.info('created IRC monitor...')
 
     def connectionMade(self):
         irc.IRCClient.connectionMade(self)
         irc_log.info('connected to IRC server...')
 
+    def lineReceived(self, line):
+        self.line_received_at = timer()
+        irc.IRCClient.lineReceived(self, line)
+
     def signedOn(self):
-        self.join(self.factory.channel)
-        irc_log.info('joined %s ...', self.factory.channel)
+        for channel in self.factory.channels:
+            self.join(channel)
+            irc_log.info('joined %s ...', channel)
 
     def privmsg(self, user, channel, msg):
+        start = timer()
+        if self.line_received_at is not None:
+            metrics.RECEIVE_SECONDS.observe(start - self.line_received_at)
+        channel = channel.lstrip('#')
+        metrics.IRC_MESSAGES.labels(channel).inc()
+        if self.recorder is not None:
+            self.recorder.record(channel, msg)
         msg = strip_colors(msg)
+        stripped = timer()
+        metrics.STRIP_COLORS_SECONDS.observe(stripped - start)
 
         try:
             msg = msg.decode('utf-8')
         except UnicodeError as ue:
-            bcast_log.warn('UnicodeError: %r on IRC message %r', ue, msg)
+            bad_irc_sample.log('UnicodeError: %r on IRC message %r',
+                               ue, msg)
+            return
+
+        ns_map = self.ns_maps.get(channel, DEFAULT_NS_MAP)
+        msg_dict = parse_irc_message(msg, ns_map)
+        if channel == WIKIDATA_CHANNEL:
+            add_entity_fields(msg_dict)
+        parsed = timer()
+        metrics.PARSE_SECONDS.observe(parsed - stripped)
+        dispatch(msg_dict, channel, self.broadcaster, self.geoip_db_monitor,
+                 self.geo_stage, parsed)
+
+    def geolocate(self, ip):
+        return geolocate_ip(self.geoip_db_monitor, ip)
+
+
+class StreamMonitor(object):
+    """Does for EventStreams events what :class:`Monitor` does for IRC
+    messages, for the wikis in *channels*. Events for other wikis are
+    dropped before they are decoded.
+    """
+    def __init__(self, geoip_db_monitor, bsf, ns_maps, channels,
+                 geo_stage=None):
+        self.geoip_db_monitor = geoip_db_monitor
+        self.broadcaster = bsf
+        self.ns_maps = ns_maps
+        self.channels = frozenset(channels)
+        self.geo_stage = geo_stage
+
+    def event_received(self, data):
+        start = timer()
+        peeked = peek_recentchange_channel(data)
+        if peeked is not None and peeked not in self.channels:
+            return
+        try:
+            event = loads(data)
+            channel = get_recentchange_channel(event)
+        except (ValueError, AttributeError) as e:
+            bad_event_sample.log('%r on EventStreams event %r', e, data)
+            return
+        if channel not in self.channels:
             return
+        metrics.STREAM_EVENTS.labels(channel).inc()
+        ns_map = self.ns_maps.get(channel, DEFAULT_NS_MAP)
+        msg_dict = parse_recentchange(event, ns_map)
+        if msg_dict is None:
+            return
+        if channel == WIKIDATA_CHANNEL:
+            add_entity_fields(msg_dict)
+        parsed = timer()
+        metrics.PARSE_SECONDS.observe(parsed - start)
+        dispatch(msg_dict, channel, self.broadcaster, self.geoip_db_monitor,
+                 self.geo_stage, parsed)
+
+
+def dispatch(msg_dict, channel, broadcaster, geoip_db_monitor,
+             geo_stage=None, parsed=None):
+    """Geolocates (in *geo_stage*, if any) and publishes a parsed
+    message, whichever feed it came from.
+    """
+    ip = msg_dict['user'] if msg_dict.get('is_anon') else None
+    if geo_stage is not None:
+        geo_stage.submit(msg_dict, channel, ip)
+        return
+    if ip is not None:
+        msg_dict[pipeline.GEO_IP_KEY] = geolocate_ip(geoip_db_monitor, ip)
+        if parsed is not None:
+            metrics.GEO_SECONDS.observe(timer() - parsed)
+    publish(broadcaster, msg_dict, channel)
+
+
+def geolocate_ip(geoip_db_monitor, ip):
+    cache = geoip_db_monitor.cache
+    if cache is not None:
+        geo_loc = cache.get(ip)
+        if geo_loc is not None:
+            return geo_loc
+    geo_loc = geolocate_anonymous_user(geoip_db_monitor.geoip_db, ip)
+    if geo_loc is None:
+        return {}
+    if cache is not None:
+        cache.set(ip, geo_loc)
+    return geo_loc
 
-        msg_dict = parse_irc_message(msg, self.ns_map)
-        if msg_dict.get('is_anon'):
-            ip = msg_dict['user']
-            geo_loc = geolocate_anonymous_user(self.geoip_db_monitor.geoip_db,
-                                               ip)
-            msg_dict[self.GEO_IP_KEY] = geo_loc
 
-        self.broadcaster.broadcast(dumps(msg_dict, sort_keys=True))
+def publish(broadcaster, msg_dict, channel):
+    start = timer()
+    msg = dumps(msg_dict, sort_keys=True)
+    metrics.JSON_SECONDS.observe(timer() - start)
+    broadcaster.broadcast(msg, channel, msg_dict)
 
 
 class MonitorFactory(ReconnectingClientFactory):
-    def __init__(self, geoip_db_monitor, channel, bsf, ns_map):
+    def __init__(self, geoip_db_monitor, channels, bsf, ns_maps,
+                 geo_stage=None, recorder=None):
         self.geoip_db_monitor = geoip_db_monitor
-        self.channel = channel
+        self.channels = channels
         self.bsf = bsf
-        self.ns_map = ns_map
+        self.ns_maps = ns_maps
+        self.geo_stage = geo_stage
+        self.recorder = recorder
 
     def buildProtocol(self, addr):
-        irc_log.info('monitor IRC connected to %s', self.channel)
+        irc_log.info('monitor IRC connected to %s', ', '.join(self.channels))
         self.resetDelay()
-        return Monitor(self.geoip_db_monitor, self.bsf, self.ns_map, self)
+        return Monitor(self.geoip_db_monitor, self.bsf, self.ns_maps, self,
+                       self.geo_stage, self.recorder)
 
     def startConnecting(self, connector):
-        irc_log.info('monitor IRC starting connection to %s', self.channel)
+        irc_log.info('monitor IRC starting connection to %s',
+                     ', '.join(self.channels))
         protocol.startConnecting(self, connector)
 
     def clientConnectionLost(self, connector, reason):
@@ -150,87 +338,519 @@ class MonitorFactory(ReconnectingClientFactory):
                                                          reason)
 
 
+def get_query_batch(params):
+    """Whether the URL query parameters ask for batched messages, as
+    with ``?batch=true``.
+    """
+    values = params.get('batch')
+    if not values:
+        return False
+    return _to_bool('batch', values[-1])
+
+
 class BroadcastServerProtocol(WebSocketServerProtocol):
+    channel = None
+    filter_key = None
+    batch = False
+    wire_format = wire.DEFAULT_FORMAT
+    transport_name = 'websocket'
+    deflate = False
+    message_compressed = None
+    replay = None
+    answered = False
+
+    def onConnect(self, request):
+        channel = self.factory.get_path_channel(request.path)
+        if channel is None:
+            raise HttpException(httpstatus.HTTP_STATUS_CODE_NOT_FOUND[0],
+                                'no wiki is broadcast on %s' % request.path)
+        self.channel = channel
+        try:
+            self.filter_key = get_filter_key(
+                get_query_filter_spec(request.params))
+            self.batch = get_query_batch(request.params)
+            self.replay = history.get_query_replay(request.params)
+        except ValueError as ve:
+            raise HttpException(httpstatus.HTTP_STATUS_CODE_BAD_REQUEST[0],
+                                str(ve))
+        # e.g., Sec-WebSocket-Protocol: wikimon.msgpack
+        wire_format = wire.choose_format(request.protocols)
+        if wire_format is not None:
+            self.wire_format = wire_format
+        # e.g., Sec-WebSocket-Extensions: permessage-deflate
+        if self.factory.deflate_level:
+            response = deflate.negotiate(request.extensions)
+            if response is not None:
+                self.deflate = True
+                self.websocket_extensions_in_use.append(response)
+        return wire_format
+
     def onOpen(self):
+        if self.replay is not None:
+            self.factory.replay(self, *self.replay)
         self.factory.register(self)
 
+    def onMessage(self, msg, binary):
+        try:
+            request = loads(msg)
+            if not isinstance(request, dict):
+                raise ValueError('expected a JSON object')
+            if 'filter' in request:
+                filter_key = get_filter_key(request['filter'])
+                self.factory.set_filter(self, filter_key)
+            if 'batch' in request:
+                batch = _to_bool('batch', request['batch'])
+                self.factory.set_batch(self, batch)
+        except ValueError as ve:
+            self.sendMessage(dumps({'error': str(ve)}))
+
     def connectionLost(self, reason):
         WebSocketServerProtocol.connectionLost(self, reason)
         self.factory.unregister(self)
 
+    def protocolViolation(self, reason):
+        if self.deflate and reason == RSV_VIOLATION:
+            return False  # checked in onMessageFrameBegin
+        return WebSocketServerProtocol.protocolViolation(self, reason)
+
+    def onMessageBegin(self, opcode):
+        WebSocketServerProtocol.onMessageBegin(self, opcode)
+        self.message_compressed = None
+
+    def onMessageFrameBegin(self, length, reserved):
+        WebSocketServerProtocol.onMessageFrameBegin(self, length, reserved)
+        if self.message_compressed is None:
+            self.message_compressed = reserved == deflate.RSV1
+            if self.message_compressed:
+                # validated once inflated, in onMessageEnd
+                self.utf8validateIncomingCurrentMessage = False
+        elif reserved:
+            self.protocolViolation('RSV set on a continuation frame')
+        if reserved not in (0, deflate.RSV1):
+            self.protocolViolation('RSV %d set on a frame' % reserved)
+
+    def onMessageEnd(self):
+        if self.message_compressed and not self.failedByMe:
+            try:
+                payload = deflate.decompress(''.join(self.message_data))
+                if self.message_opcode == self.MESSAGE_TYPE_TEXT:
+                    payload.decode('utf-8')
+            except (ValueError, UnicodeDecodeError) as e:
+                self.invalidPayload(str(e))
+                self.message_data = None
+                return
+            self.message_data = [payload]
+        WebSocketServerProtocol.onMessageEnd(self)
+
 
 class BroadcastServerFactory(WebSocketServerFactory):
-    def __init__(self, url, geoip_db, geoip_update_interval,
-                 lang, project, *a, **kw):
+    def __init__(self, url, channels, *a, **kw):
+        self.batch_window = kw.pop('batch_window', DEFAULT_BATCH_WINDOW)
+        self.batch_size = kw.pop('batch_size', DEFAULT_BATCH_SIZE)
+        self.reactor = kw.pop('_reactor', reactor)
+        self.deflate_level = kw.pop('deflate_level', deflate.DEFAULT_LEVEL)
+        self.deflate_min_size = kw.pop('deflate_min_size',
+                                       deflate.DEFAULT_MIN_SIZE)
+        history_size = kw.pop('history_size', history.DEFAULT_SIZE)
+        history_bytes = kw.pop('history_bytes', history.DEFAULT_BYTES)
+        with_stats = kw.pop('stats', False)
         WebSocketServerFactory.__init__(self, url, *a, **kw)
-        self.clients = set()
+        self.channels = list(channels)
+        # each wiki's summaries are broadcast on a channel of their own,
+        # served on the wiki's path plus stats/
+        self.stats_channels = []
+        if with_stats:
+            self.stats_channels = [stats.get_stats_channel(c)
+                                   for c in self.channels]
+        all_channels = self.channels + self.stats_channels
+        # clients are kept per channel, so a message is only ever
+        # iterated over the clients connected on its wiki's path
+        self.clients = dict([(c, set()) for c in all_channels])
+        # and grouped by filter within each channel, so that each message
+        # is checked once per distinct filter rather than once per client
+        self.groups = dict([(c, {}) for c in all_channels])
+        # clients who asked for batches are grouped the same way, and
+        # each group's batch is framed once when its window closes
+        self.batch_groups = dict([(c, {}) for c in all_channels])
+        self.batches = {}  # (channel, filter key) -> [msg, ...]
+        self.batch_calls = {}
+        self.filters = {}
+        # the last messages on each channel, for clients to catch up on
+        self.histories = {}
+        if history_size > 0:
+            self.histories = dict([(c, history.History(history_size,
+                                                       history_bytes))
+                                   for c in self.channels])
+        # only the latest summary, as the current snapshot
+        for c in self.stats_channels:
+            self.histories[c] = history.History(1, history_bytes)
+        self.paths = dict([(get_channel_path(c), c) for c in self.channels])
+        self.paths[DEFAULT_PATH] = self.channels[0]
+        for c in self.channels:
+            self.paths[stats.get_stats_path(get_channel_path(c))] = \
+                stats.get_stats_channel(c)
         self.tickcount = 0
         self.msgcount = 0
-        self.lang = lang
-        self.project = project
         self.start_time = time.time()
+        # numbers messages for long-polling cursors, unless they come
+        # numbered from the ingest process
+        self.seq = history.get_initial_seq()
+
+    def get_path_channel(self, path):
+        if not path.endswith('/'):
+            path += '/'
+        return self.paths.get(path)
+
+    def get_snapshot(self, channel):
+        """Returns the latest statistics summary broadcast for
+        *channel*, serialized, or None.
+        """
+        channel_history = self.histories.get(stats.get_stats_channel(channel))
+        if channel_history is None:
+            return None
+        summaries = channel_history.last(1)
+        return summaries[0] if summaries else None
 
-        start_monitor(self, geoip_db, geoip_update_interval,
-                      lang, project)  # blargh
+    def get_client_count(self):
+        return sum([len(c) for c in self.clients.values()])
 
     def tick(self):
         self.tickcount += 1
-        self.broadcast("'tick %d' from server" % self.tickcount)
+        for channel in self.channels:
+            self.broadcast("'tick %d' from server" % self.tickcount, channel)
         reactor.callLater(1, self.tick)
 
     def register(self, client):
-        if client not in self.clients:
-            bcast_log.info("registered client %s", client.peerstr)
-        self.clients.add(client)
+        clients = self.clients[client.channel]
+        if client not in clients:
+            register_sample.log("registered client %s on %s",
+                                client.peerstr, client.channel)
+            metrics.CONNECTS.labels(client.transport_name).inc()
+            metrics.CLIENTS.labels(client.transport_name).inc()
+        clients.add(client)
+        self._add_to_group(client)
 
     def unregister(self, client):
         try:
-            self.clients.remove(client)
-            bcast_log.info("unregistered client %s", client.peerstr)
+            self.clients[client.channel].remove(client)
+            unregister_sample.log("unregistered client %s", client.peerstr)
         except KeyError:
             pass
+        else:
+            metrics.DISCONNECTS.labels(client.transport_name).inc()
+            metrics.CLIENTS.labels(client.transport_name).dec()
+            self._remove_from_group(client)
 
-    def broadcast(self, msg):
-        global LAST_FORCED_LOG
+    def set_filter(self, client, filter_key):
+        if filter_key == client.filter_key:
+            return
+        registered = client in self.clients.get(client.channel, ())
+        if registered:
+            self._remove_from_group(client)
+        client.filter_key = filter_key
+        if registered:
+            self._add_to_group(client)
+        filter_sample.log("client %s filter set to %r",
+                          client.peerstr, filter_key)
+
+    def set_batch(self, client, batch):
+        if batch == client.batch:
+            return
+        registered = client in self.clients.get(client.channel, ())
+        if registered:
+            self._remove_from_group(client)
+        client.batch = batch
+        if registered:
+            self._add_to_group(client)
+        batch_sample.log("client %s batching set to %r",
+                         client.peerstr, batch)
+
+    def _get_groups(self, client):
+        if client.batch:
+            return self.batch_groups[client.channel]
+        return self.groups[client.channel]
+
+    def _add_to_group(self, client):
+        key = client.filter_key
+        groups = self._get_groups(client)
+        if key not in groups:
+            groups[key] = set()
+            if key is not None and key not in self.filters:
+                self.filters[key] = MessageFilter(key)
+        groups[key].add(client)
+
+    def _remove_from_group(self, client):
+        key = client.filter_key
+        groups = self._get_groups(client)
+        group = groups.get(key)
+        if group is None:
+            return
+        group.discard(client)
+        if not group:
+            del groups[key]
+            if not any([key in g for g in self.groups.values()
+                        + self.batch_groups.values()]):
+                self.filters.pop(key, None)
+
+    def broadcast(self, msg, channel=None, msg_dict=None, seq=None):
+        """Sends the serialized *msg* to the clients on *channel* whose
+        filters it matches. Filters are evaluated against *msg_dict*,
+        which is only deserialized from *msg* if it is not passed in
+        and a filtered client is connected. *seq* is the message's
+        sequence number, if the relay numbered it.
+        """
+        start = timer()
+        if channel is None:
+            channel = self.channels[0]
         self.msgcount += 1
-        bcast_log.info("broadcasting message %r", msg)
-        for c in self.clients:
-            c.sendMessage(msg)
-            bcast_log.debug("message sent to %s", c.peerstr)
-            
+        if seq is None:
+            seq = self.seq + 1
+        self.seq = seq
+        metrics.BROADCAST_MESSAGES.labels(channel).inc()
+        channel_history = self.histories.get(channel)
+        if channel_history is not None:
+            channel_history.append(msg, msg_dict, seq)
+        # frame the message once per wire format (and compression) and
+        # write the same bytes to every client, rather than rebuilding it
+        # per connection
+        prepared = {}
+        sent = dropped = 0
+        matches = {}
+        for filter_key, clients in self.groups.get(channel, {}).items():
+            if filter_key is not None:
+                if msg_dict is None:
+                    msg_dict = loads(msg)
+                match = self.filters[filter_key].match(msg_dict)
+                matches[filter_key] = match
+                if not match:
+                    continue
+            group_sent, group_dropped = self._send(clients, prepared,
+                                                   msg, msg_dict)
+            sent += group_sent
+            dropped += group_dropped
+        for filter_key in self.batch_groups.get(channel, ()):
+            if filter_key is not None:
+                match = matches.get(filter_key)
+                if match is None:
+                    if msg_dict is None:
+                        msg_dict = loads(msg)
+                    match = self.filters[filter_key].match(msg_dict)
+                if not match:
+                    continue
+            self._add_to_batch((channel, filter_key), msg)
+        metrics.SENT_FRAMES.inc(sent)
+        if dropped:
+            metrics.DROPPED_FRAMES.inc(dropped)
+        metrics.FANOUT_SECONDS.observe(timer() - start)
+        broadcast_sample.log("broadcast message to %s (%d sent, %d dropped)"
+                             " %r", channel, sent, dropped, msg)
+        self.log_stats()
+
+    def _send(self, clients, prepared, msg, msg_dict=None):
+        """Writes *msg* to each of *clients* in its wire format, taking
+        the framed message from *prepared* (a dict of wire format and
+        compression to prepared message), and preparing it there if it
+        is missing. Returns the numbers of frames sent and dropped.
+        """
+        sent = dropped = saved = 0
+        for c in clients:
+            if c.state != STATE_OPEN:
+                # closing (or dropped as too slow), but not yet
+                # unregistered; long-poll clients are done once answered
+                if not c.answered:
+                    dropped += 1
+                continue
+            key = (c.wire_format, c.deflate)
+            prepared_msg = prepared.get(key)
+            if prepared_msg is None:
+                prepared_msg = self.prepare(msg, msg_dict, c.wire_format,
+                                            c.deflate)
+                prepared[key] = prepared_msg
+            c.sendPreparedMessage(prepared_msg)
+            sent += 1
+            saved += prepared_msg.saved
+        if saved:
+            metrics.DEFLATE_SAVED_BYTES.inc(saved)
+        return sent, dropped
+
+    def prepare(self, msg, msg_dict, wire_format, compress=False):
+        """Frames the JSON *msg*, or *msg_dict* (loaded from *msg* if
+        None) encoded in a binary *wire_format*. With *compress*, the
+        payload is deflated, unless it is under ``deflate_min_size``.
+        Clients of the HTTP transports have their own formats.
+        """
+        if wire_format in httpstream.FORMATS:
+            return httpstream.prepare(msg, msg_dict, wire_format)
+        binary = wire_format != wire.JSON
+        if binary:
+            start = timer()
+            if msg_dict is None:
+                msg_dict = loads(msg)
+            payload = wire.encode(msg_dict, wire_format)
+            metrics.ENCODE_SECONDS.observe(timer() - start)
+        else:
+            payload = msg
+        if compress and len(payload) >= self.deflate_min_size:
+            start = timer()
+            compressed = deflate.compress(payload, self.deflate_level)
+            metrics.DEFLATE_SECONDS.observe(timer() - start)
+            prepared_msg = deflate.prepare_compressed(compressed, binary)
+            prepared_msg.saved = len(payload) - len(compressed)
+        else:
+            prepared_msg = self.prepareMessage(payload, binary=binary)
+            prepared_msg.saved = 0
+        return prepared_msg
+
+    def get_recent(self, channel, filter_key, param, value):
+        """Returns the recent messages on *channel* asked for (see
+        :meth:`history.History.get`) which match *filter_key*.
+        """
+        channel_history = self.histories.get(channel)
+        if channel_history is None:
+            return []
+        msgs = channel_history.get(param, value)
+        if filter_key is not None and msgs:
+            message_filter = self.filters.get(filter_key)
+            if message_filter is None:
+                message_filter = MessageFilter(filter_key)
+            msgs = [msg for msg in msgs if message_filter.match(loads(msg))]
+        return msgs
+
+    def replay(self, client, param, value):
+        """Sends *client* the recent messages on its channel which it
+        asked for and which match its filter, as one batch if it
+        batches. Call before registering the client, so that replayed
+        and live messages stay in order.
+        """
+        msgs = self.get_recent(client.channel, client.filter_key,
+                               param, value)
+        if not msgs:
+            return
+        if client.batch:
+            msgs = ['[%s]' % ','.join(msgs)]
+        sent = 0
+        for msg in msgs:
+            sent += self._send([client], {}, msg)[0]
+        metrics.REPLAYED_MESSAGES.inc(len(msgs))
+        metrics.SENT_FRAMES.inc(sent)
+        replay_sample.log("replayed %d messages to %s", len(msgs),
+                          client.peerstr)
+
+    def _add_to_batch(self, key, msg):
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = []
+            self.batch_calls[key] = self.reactor.callLater(
+                self.batch_window, self.flush_batch, key)
+        batch.append(msg)
+        if len(batch) >= self.batch_size:
+            self.flush_batch(key)
+
+    def flush_batch(self, key):
+        """Sends the messages batched for *key*, a (channel, filter key)
+        pair, as one array, framed once per wire format for all of its
+        clients.
+        """
+        start = timer()
+        batch = self.batches.pop(key, None)
+        call = self.batch_calls.pop(key, None)
+        if call is not None and call.active():
+            call.cancel()
+        channel, filter_key = key
+        clients = self.batch_groups.get(channel, {}).get(filter_key)
+        if not batch or not clients:
+            return
+        sent, dropped = self._send(clients, {}, '[%s]' % ','.join(batch))
+        metrics.BATCHES.inc()
+        metrics.SENT_FRAMES.inc(sent)
+        if dropped:
+            metrics.DROPPED_FRAMES.inc(dropped)
+        metrics.BATCH_FANOUT_SECONDS.observe(timer() - start)
+
+    def log_stats(self):
+        global LAST_FORCED_LOG
         if time.time() - LAST_FORCED_LOG > FORCE_LOG_THRESH:
             LAST_FORCED_LOG = time.time()
-            data = {'msgs': self.msgcount, 'clients': len(self.clients), 'lang': self.lang, 'project': self.project, 'uptime_hours': (time.time() - self.start_time)/60/60}
+            clients = dict([(c, len(cs)) for c, cs in self.clients.items()])
+            data = {'msgs': self.msgcount,
+                    'clients': self.get_client_count(),
+                    'filters': len(self.filters),
+                    'channel_clients': clients,
+                    'channels': self.channels,
+                    'uptime_hours': (time.time() - self.start_time)/60/60}
             mon_log.critical(dumps(data))
 
 
-class BroadcastPreparedServerFactory(BroadcastServerFactory):
-    def broadcast(self, msg):
-        preparedMsg = self.prepareMessage(msg)
-        for c in self.clients:
-            c.sendPreparedMessage(preparedMsg)
-            bcast_log.info("prepared message sent to %s", c.peerstr)
-
-
 def start_monitor(broadcaster, geoip_db, geoip_update_interval,
-                  lang=DEFAULT_LANG, project=DEFAULT_PROJECT):
-    channel = '%s.%s' % (lang, project)
-    api_url = 'http://%s.%s.org/w/api.php' % (lang, project)
-    api_log.info('fetching namespaces from %r', api_url)
-    wc = wapiti.WapitiClient('wikimon@hatnote.com', api_url=api_url)
-    api_log.info('successfully fetched namespaces from %r', api_url)
-    page_info = wc.get_source_info()
-    ns_map = dict([(ns.title, ns.canonical)
-                   for ns in page_info[0].namespace_map if ns.title])
-    irc_log.info('connecting to %s...', channel)
+                  channels=None, geo_cache=None,
+                  geo_deadline=pipeline.DEFAULT_DEADLINE,
+                  geo_threads=pipeline.DEFAULT_THREADS,
+                  geo_precision=DEFAULT_GEO_PRECISION,
+                  irc_host=None, irc_port=None, recorder=None,
+                  ns_cache=nsmaps.DEFAULT_CACHE_PATH,
+                  ns_refresh_interval=nsmaps.DEFAULT_REFRESH_INTERVAL,
+                  ingest=DEFAULT_INGEST,
+                  stream_url=eventstreams.DEFAULT_STREAM_URL,
+                  stats_interval=0, stats_window=stats.DEFAULT_WINDOW,
+                  archive_dir=None, archive_hours=archive.DEFAULT_MAX_HOURS):
+    """Connects a single IRC monitor which joins every channel in
+    *channels* (e.g., ``['en.wikipedia', 'de.wikipedia']``) and feeds
+    *broadcaster*. The GeoIP database is loaded once and shared by all
+    channels. With *geo_threads* set to 0, geolocation runs inline on
+    the reactor thread. A *geo_precision* of ``'country'`` swaps in
+    the compact, country-only database from :mod:`geocountry`. With a
+    *recorder* (a :class:`feedlog.FeedRecorder`), the raw feed is
+    recorded as it is received. Namespace maps are loaded from the
+    *ns_cache* file, and refreshed in the background. With *ingest*
+    set to ``'eventstreams'``, changes are read from the EventStreams
+    feed at *stream_url* instead of IRC. With a *stats_interval*, a
+    summary of each wiki's last *stats_window* seconds is broadcast
+    that often, on the wiki's stats channel. With an *archive_dir*,
+    every message is archived there for *archive_hours*.
+    """
+    if not channels:
+        channels = [get_channel(DEFAULT_LANG, DEFAULT_PROJECT)]
+    ns_maps = nsmaps.begin(channels, ns_cache, ns_refresh_interval)
+    irc_log.info('connecting to %s...', ', '.join(channels))
     geoip_db_monitor = monitor_geolite2.begin(geoip_db,
-                                              geoip_update_interval)
-    f = MonitorFactory(geoip_db_monitor, channel, broadcaster, ns_map)
-    reactor.connectTCP(IRC_SERVER_HOST, IRC_SERVER_PORT, f)
+                                              geoip_update_interval,
+                                              geo_cache,
+                                              GEO_PRECISIONS[geo_precision])
+    if stats_interval > 0:
+        broadcaster = stats.StatsEngine(broadcaster, channels,
+                                        stats_interval, stats_window).start()
+    # outside the stats engine, which publishes its summaries straight
+    # to the broadcaster, so that they are not archived
+    if archive_dir is not None:
+        writer = archive.ArchiveWriter(archive_dir, broadcaster,
+                                       archive_hours).start()
+        reactor.addSystemEventTrigger('before', 'shutdown', writer.stop)
+        broadcaster = writer
+    geo_stage = None
+    if geo_threads > 0:
+        geo_stage = pipeline.GeolocationStage(
+            geoip_db_monitor, geolocate_anonymous_user,
+            partial(publish, broadcaster),
+            deadline=geo_deadline, threads=geo_threads)
+    if ingest == 'eventstreams':
+        if recorder is not None:
+            irc_log.warning('only the IRC feed can be recorded')
+        monitor = StreamMonitor(geoip_db_monitor, broadcaster, ns_maps,
+                                channels, geo_stage)
+        eventstreams.EventStreamClient(stream_url,
+                                       monitor.event_received).start()
+        return
+    f = MonitorFactory(geoip_db_monitor, channels, broadcaster, ns_maps,
+                       geo_stage, recorder)
+    if recorder is not None:
+        LoopingCall(recorder.flush).start(RECORD_FLUSH_INTERVAL, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', recorder.close)
+    reactor.connectTCP(irc_host or IRC_SERVER_HOST,
+                       irc_port or IRC_SERVER_PORT, f)
 
 
 def get_argparser():
-    from argparse import ArgumentParser
+    from argparse import ArgumentParser, SUPPRESS
     desc = "broadcast realtime edits to a Mediawiki project over websockets"
     prs = ArgumentParser(description=desc)
     prs.add_argument('--geoip_db', default=None,
@@ -240,13 +860,124 @@ def get_argparser():
                      type=int,
                      help='how often (in seconds) to check'
                      ' for updates in the GeoIP db')
+    prs.add_argument('--geo-cache-size', default=geocache.DEFAULT_SIZE,
+                     type=int,
+                     help='number of geolocated IPs to cache (0 to disable)')
+    prs.add_argument('--geo-cache-ttl', default=geocache.DEFAULT_TTL,
+                     type=int,
+                     help='seconds a cached geolocation stays valid')
+    prs.add_argument('--geo-cache-ipv6-prefix', default=False,
+                     action='store_true',
+                     help='cache IPv6 geolocations by /64 prefix')
+    prs.add_argument('--geo-threads', default=pipeline.DEFAULT_THREADS,
+                     type=int,
+                     help='threads to geolocate in, off the main loop'
+                     ' (0 to geolocate inline)')
+    prs.add_argument('--geo-deadline', default=pipeline.DEFAULT_DEADLINE,
+                     type=float,
+                     help='seconds a message may wait for geolocation'
+                     ' before being sent without it')
+    prs.add_argument('--geo-precision', default=DEFAULT_GEO_PRECISION,
+                     choices=sorted(GEO_PRECISIONS),
+                     help='"country" geolocates from a compact table built'
+                     ' from the GeoLite2 database, with only country_name')
     prs.add_argument('--project', default=DEFAULT_PROJECT)
-    prs.add_argument('--lang', default=DEFAULT_LANG)
+    prs.add_argument('--lang', default=DEFAULT_LANG,
+                     help='language to monitor, or a comma-separated list'
+                     ' of languages (e.g., en,de,ru,ja) to monitor over'
+                     ' one IRC connection, each served on /<lang>/')
     prs.add_argument('--port', default=DEFAULT_BCAST_PORT, type=int,
                      help='listen port for websocket connections')
+    prs.add_argument('--ingest', default=DEFAULT_INGEST, choices=INGESTS,
+                     help='read changes from the IRC feed, or from the'
+                     ' EventStreams recentchange feed')
+    prs.add_argument('--stream-url', default=eventstreams.DEFAULT_STREAM_URL,
+                     help='EventStreams feed to read, e.g. from'
+                     ' wikimon/eventstreams.py, with --ingest eventstreams')
+    prs.add_argument('--irc-host', default=IRC_SERVER_HOST,
+                     help='IRC server to monitor (also $IRC_SERVER_HOST),'
+                     ' e.g., localhost for wikimon/replay.py')
+    prs.add_argument('--irc-port', default=IRC_SERVER_PORT, type=int,
+                     help='also $IRC_SERVER_PORT')
+    prs.add_argument('--ns-cache', default=nsmaps.DEFAULT_CACHE_PATH,
+                     metavar='PATH',
+                     help='file the namespace maps of the monitored wikis'
+                     ' are cached in, between runs ("" to not cache)')
+    prs.add_argument('--ns-refresh-interval',
+                     default=nsmaps.DEFAULT_REFRESH_INTERVAL, type=int,
+                     help='how often (in seconds) to refetch namespace maps'
+                     ' from the wikis\' APIs')
+    prs.add_argument('--record', default=None, metavar='PATH',
+                     help='record the raw IRC feed to PATH, for replay')
+    prs.add_argument('--record-max-bytes',
+                     default=feedlog.DEFAULT_ROTATE_LENGTH, type=int,
+                     help='size at which the recording is rotated')
+    prs.add_argument('--record-files', default=feedlog.DEFAULT_MAX_FILES,
+                     type=int, help='number of rotated recordings to keep')
+    prs.add_argument('--batch-window', default=DEFAULT_BATCH_WINDOW,
+                     type=float,
+                     help='seconds of messages sent together to clients'
+                     ' which ask for batches (?batch=true)')
+    prs.add_argument('--batch-size', default=DEFAULT_BATCH_SIZE, type=int,
+                     help='most messages in a batch; a full batch is sent'
+                     ' before its window closes')
+    prs.add_argument('--deflate-level', default=deflate.DEFAULT_LEVEL,
+                     type=int,
+                     help='zlib level to compress messages at, for clients'
+                     ' which negotiate permessage-deflate (0 to disable)')
+    prs.add_argument('--deflate-min-size', default=deflate.DEFAULT_MIN_SIZE,
+                     type=int,
+                     help='messages smaller than this many bytes are sent'
+                     ' uncompressed')
+    prs.add_argument('--history-size', default=history.DEFAULT_SIZE,
+                     type=int,
+                     help='recent messages kept per wiki, for clients to'
+                     ' replay on connect (0 to disable)')
+    prs.add_argument('--history-bytes', default=history.DEFAULT_BYTES,
+                     type=int,
+                     help='most bytes of recent messages kept per wiki')
+    prs.add_argument('--stats-interval', default=stats.DEFAULT_INTERVAL,
+                     type=int,
+                     help='how often (in seconds) to broadcast each wiki\'s'
+                     ' statistics on /<lang>/stats/ (0 to disable)')
+    prs.add_argument('--stats-window', default=stats.DEFAULT_WINDOW,
+                     type=int,
+                     help='seconds of edits the statistics are over')
+    prs.add_argument('--archive-dir', default=None, metavar='PATH',
+                     help='archive every message under PATH, queryable on'
+                     ' /archive/<lang>/ with --http-port')
+    prs.add_argument('--archive-hours', default=archive.DEFAULT_MAX_HOURS,
+                     type=int,
+                     help='hours of messages to keep in the archive')
+    prs.add_argument('--http-port', default=0, type=int,
+                     help='also serve the stream over HTTP on this port, as'
+                     ' Server-Sent Events on /stream/<lang>/ and by'
+                     ' long-polling /poll/<lang>/ (0 to disable)')
+    prs.add_argument('--workers', default=0, type=int,
+                     help='number of WebSocket worker processes to fan out'
+                     ' to; 0 serves clients from the monitor process')
+    prs.add_argument('--relay-socket', default=None,
+                     help='unix socket the monitor process publishes to'
+                     ' its workers on (default: %s)'
+                     % (workers.DEFAULT_RELAY_SOCKET % DEFAULT_BCAST_PORT))
+    prs.add_argument('--worker-fd', default=None, type=int,
+                     help=SUPPRESS)
+    prs.add_argument('--worker-index', default=0, type=int,
+                     help=SUPPRESS)
+    prs.add_argument('--worker-http-fd', default=None, type=int,
+                     help=SUPPRESS)
+    prs.add_argument('--metrics-port', default=0, type=int,
+                     help='serve Prometheus metrics over HTTP on this port'
+                     ' (0 to disable); worker N serves its own on the'
+                     ' port plus N + 1')
     prs.add_argument('--debug', default=DEBUG, action='store_true')
     prs.add_argument('--loglevel', default='WARN',
                      help='e.g., DEBUG, INFO, WARN, etc.')
+    prs.add_argument('--log-file', default=None, metavar='PATH',
+                     help='write the log to PATH instead of stderr')
+    prs.add_argument('--log-rate', default=logs.DEFAULT_RATE, type=int,
+                     help='most per-message or per-client log records of'
+                     ' each kind written a second (0 for no limit)')
     return prs
 
 
@@ -259,6 +990,8 @@ def main():
         print "geoip_db not set, defaulting to %r" % DEFAULT_GEOIP_DB
         geoip_db_path = DEFAULT_GEOIP_DB
     open(geoip_db_path).close()  # basic readability check
+    logs.configure(logging.DEBUG if args.debug else logging.INFO,
+                   args.log_file, args.log_rate or None)
     try:
         bcast_log.setLevel(getattr(logging, args.loglevel.upper()))
     except:
@@ -267,17 +1000,74 @@ def main():
     if args.debug:
         bcast_log.setLevel(logging.DEBUG)
     ws_listen_addr = 'ws://localhost:%d' % (args.port,)
+    channels = [get_channel(lang.strip(), args.project)
+                for lang in args.lang.split(',') if lang.strip()]
+    geo_cache = None
+    if args.geo_cache_size > 0:
+        geo_cache = geocache.GeoCache(args.geo_cache_size, args.geo_cache_ttl,
+                                      args.geo_cache_ipv6_prefix)
+    recorder = None
+    if args.record and args.worker_fd is None:
+        recorder = feedlog.FeedRecorder(args.record, args.record_max_bytes,
+                                        args.record_files)
+    relay_path = args.relay_socket or (workers.DEFAULT_RELAY_SOCKET
+                                       % args.port)
+    if args.metrics_port:
+        metrics_port = args.metrics_port
+        if args.worker_fd is not None:
+            metrics_port += args.worker_index + 1
+        metrics.listen_metrics(metrics_port)
+    if args.workers and args.worker_fd is None:
+        # ingest process: monitor, parse and geolocate, then hand
+        # serialized messages off to the worker processes
+        publisher = workers.start_workers(args.port, args.workers,
+                                          relay_path, args.http_port)
+        start_monitor(publisher, geoip_db_path,
+                      args.geoip_update_interval, channels, geo_cache,
+                      args.geo_deadline, args.geo_threads,
+                      args.geo_precision, args.irc_host, args.irc_port,
+                      recorder, args.ns_cache or None,
+                      args.ns_refresh_interval, args.ingest,
+                      args.stream_url, args.stats_interval,
+                      args.stats_window, args.archive_dir,
+                      args.archive_hours)
+        reactor.run()
+        return
+
     ServerFactory = BroadcastServerFactory
     factory = ServerFactory(ws_listen_addr,
-                            project=args.project,
-                            lang=args.lang,
-                            geoip_db=geoip_db_path,
-                            geoip_update_interval=args.geoip_update_interval,
+                            channels=channels,
                             debug=DEBUG or args.debug,
-                            debugCodePaths=DEBUG)
+                            debugCodePaths=DEBUG,
+                            batch_window=args.batch_window,
+                            batch_size=args.batch_size,
+                            deflate_level=args.deflate_level,
+                            deflate_min_size=args.deflate_min_size,
+                            history_size=args.history_size,
+                            history_bytes=args.history_bytes,
+                            stats=args.stats_interval > 0)
     factory.protocol = BroadcastServerProtocol
     factory.setProtocolOptions(allowHixie76=True)
-    listenWS(factory)
+    if args.worker_fd is not None:
+        http_site = None
+        if args.worker_http_fd is not None:
+            http_site = httpstream.get_site(factory, args.archive_dir)
+        workers.run_worker(factory, args.worker_fd, relay_path,
+                           http_site, args.worker_http_fd)
+    else:
+        if args.http_port:
+            httpstream.listen_http(factory, args.http_port,
+                                   archive_path=args.archive_dir)
+        start_monitor(factory, geoip_db_path,
+                      args.geoip_update_interval, channels, geo_cache,
+                      args.geo_deadline, args.geo_threads,
+                      args.geo_precision, args.irc_host, args.irc_port,
+                      recorder, args.ns_cache or None,
+                      args.ns_refresh_interval, args.ingest,
+                      args.stream_url, args.stats_interval,
+                      args.stats_window, args.archive_dir,
+                      args.archive_hours)
+        listenWS(factory)
     reactor.run()
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Namespace maps (localized namespace name to canonical name) for the
+monitored wikis, kept in a JSON file between runs.
+
+At startup, the cached maps are used right away, and every wiki's map
+is refetched from its API in a thread. Fetched maps replace the old
+ones in the shared ``ns_maps`` dict the IRC monitor reads for each
+message, and are written back to the cache. Until a wiki's map is
+known, messages are parsed with :data:`parsers.DEFAULT_NS_MAP`.
+"""
+
+import os
+import json
+import logging
+from os.path import dirname, abspath
+
+from twisted.internet.threads import deferToThread
+from twisted.internet.task import LoopingCall
+
+import wapiti
+
+from parsers import get_channel_server
+
+
+api_log = logging.getLogger('api_log')
+
+DEFAULT_CACHE_PATH = dirname(dirname(abspath(__file__))) + '/ns_maps.json'
+DEFAULT_REFRESH_INTERVAL = 6 * 60 * 60
+
+
+def fetch_ns_map(channel):
+    api_url = 'http://%s/w/api.php' % (get_channel_server(channel),)
+    api_log.info('fetching namespaces from %r', api_url)
+    wc = wapiti.WapitiClient('wikimon@hatnote.com', api_url=api_url)
+    page_info = wc.get_source_info()
+    api_log.info('successfully fetched namespaces from %r', api_url)
+    return dict([(ns.title, ns.canonical)
+                 for ns in page_info[0].namespace_map if ns.title])
+
+
+def load_cache(path):
+    """Returns the cached maps, by channel, or an empty dict if the
+    cache is missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            ns_maps = json.load(f)
+    except IOError:
+        return {}
+    except ValueError as ve:
+        api_log.warning('ignoring invalid namespace cache %r: %s', path, ve)
+        return {}
+    if not isinstance(ns_maps, dict):
+        api_log.warning('ignoring invalid namespace cache %r', path)
+        return {}
+    return ns_maps
+
+
+def save_cache(path, ns_maps):
+    # write then rename, so that readers never see half a file
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(ns_maps, f, sort_keys=True, indent=2)
+    os.rename(tmp_path, path)
+
+
+class NSMapRefresher(object):
+    def __init__(self, ns_maps, channels, cache_path=None, cached=None,
+                 fetch=fetch_ns_map, _defer=deferToThread):
+        self.ns_maps = ns_maps
+        self.channels = list(channels)
+        self.cache_path = cache_path
+        # everything in the cache, including other wikis, to write back
+        self.cached = dict(cached or {})
+        self.fetch = fetch
+        self._defer = _defer
+        self.refresh_count = self.failed_refresh_count = 0
+
+    def refresh(self):
+        for channel in self.channels:
+            d = self._defer(self.fetch, channel)
+            d.addCallbacks(self.store, self.log_error,
+                           callbackArgs=(channel,), errbackArgs=(channel,))
+
+    def store(self, ns_map, channel):
+        if not ns_map:
+            api_log.warning('fetched no namespaces for %s', channel)
+            return
+        if self.ns_maps.get(channel) == ns_map:
+            return
+        # atomic, as far as the monitor is concerned
+        self.ns_maps[channel] = ns_map
+        self.refresh_count += 1
+        api_log.info('updated namespaces for %s', channel)
+        if self.cache_path is None:
+            return
+        self.cached[channel] = ns_map
+        try:
+            save_cache(self.cache_path, self.cached)
+        except (IOError, OSError) as e:
+            api_log.error('could not write namespace cache %r: %s',
+                          self.cache_path, e)
+
+    def log_error(self, failure, channel):
+        self.failed_refresh_count += 1
+        api_log.error('failed to fetch namespaces for %s: %s',
+                      channel, failure.getErrorMessage())
+
+
+def begin(channels, cache_path=DEFAULT_CACHE_PATH,
+          interval=DEFAULT_REFRESH_INTERVAL, fetch=fetch_ns_map):
+    """Returns the ``ns_maps`` dict for *channels*, filled from the
+    cache at *cache_path* (None to not cache), and starts refreshing it
+    in the background now and every *interval* seconds.
+    """
+    cached = {}
+    if cache_path is not None:
+        cached = load_cache(cache_path)
+    ns_maps = dict([(channel, cached[channel])
+                    for channel in channels if channel in cached])
+    api_log.info('loaded cached namespaces for %d of %d wikis',
+                 len(ns_maps), len(channels))
+    refresher = NSMapRefresher(ns_maps, channels, cache_path, cached, fetch)
+    LoopingCall(refresher.refresh).start(interval)
+    return ns_maps
@@ -2,6 +2,7 @@
 
 import re
 import socket
+from json import JSONEncoder
 from urlparse import parse_qsl
 
 
@@ -16,6 +17,15 @@ PARSE_EDIT_RE = re.compile(r'(\[\[(?P<page_title>.*?)\]\])'
 HASHTAG_RE = re.compile("(?:^|\s)[＃#]{1}(\w+)", re.UNICODE)
 MENTION_RE = re.compile("(?:^|\s)[＠ @]{1}([^\s#<>[\]|{}]+)", re.UNICODE)
 
+# mIRC formatting, see http://www.mirc.co.uk/help/color.txt. A color
+# code's digits are matched atomically (the lookahead and backreference
+# keep them from backtracking) and left in place at the very end of a
+# line, both as Twisted's parseFormattedText does.
+_COLOR_CODE_RE = re.compile(r'\x03(?:(?=(\d\d?))\1'
+                            r'(?:,(?:(?=(\d\d?))\2(?!\Z))?|(?!\Z)))?')
+_FORMAT_CODES = '\x02\x0f\x16\x1f'  # bold, off, reverse, underline
+_FORMAT_CODES_U = dict([(ord(c), None) for c in _FORMAT_CODES])
+
 _SECTION_TITLE_RE = re.compile("\/\*\s*(?P<section_title>.+)\s*\*\/"
                                "(?P<real_summary>.*)", re.UNICODE)
 
@@ -50,6 +60,52 @@ NON_MAIN_NS = ['Talk',
                'Media']
 DEFAULT_NS_MAP = dict([(ns, ns) for ns in NON_MAIN_NS])
 DEFAULT_NS_MAP[''] = 'Main'
+# canonical names of the namespaces EventStreams gives by number; others
+# are looked up by title prefix in the wiki's namespace map
+RC_NAMESPACES = {-2: 'Media', -1: 'Special', 0: 'Main', 1: 'Talk',
+                 2: 'User', 3: 'User talk', 4: 'Project',
+                 5: 'Project talk', 6: 'File', 7: 'File talk',
+                 8: 'MediaWiki', 9: 'MediaWiki talk', 10: 'Template',
+                 11: 'Template talk', 12: 'Help', 13: 'Help talk',
+                 14: 'Category', 15: 'Category talk'}
+_RC_TYPES = ('edit', 'new', 'log')
+
+# Wikidata is announced on IRC as #wikidata.wikipedia, but served from
+# its own domain
+WIKIDATA_LANG = 'wikidata'
+WIKIDATA_CHANNEL = 'wikidata.wikipedia'
+WIKIDATA_SERVER = 'www.wikidata.org'
+# entity IDs, e.g. [[Q42]], [[Property:P31]] or [[Lexeme:L7]]
+ENTITY_ID_RE = re.compile(r'(?:(?:Item|Property|Lexeme):)?([QPL][1-9]\d*)\Z')
+# finds a recentchange event's server_name without decoding the event;
+# quotes inside JSON strings are escaped, so only the key itself matches
+SERVER_NAME_RE = re.compile(r'"server_name"\s*:\s*"([^"\\]*)"')
+ENTITY_TYPES = {'Q': 'item', 'P': 'property', 'L': 'lexeme'}
+
+_EDIT_GROUPS = ('page_title', 'flags', 'url', 'user', 'change_size',
+                'summary')
+_IP_CHARS = frozenset('0123456789abcdefABCDEF:.')
+_NDJSON_ENCODER = JSONEncoder(sort_keys=True)
+_NDJSON_BATCH_SIZE = 1000
+# HASHTAG_RE is a bytestring pattern, so against unicode its [＃#]
+# class matches '#' and the three (latin-1 decoded) bytes of '＃'
+_HASHTAG_MARKS = ('#', '\xef', '\xbc', '\x83')
+_HASHTAG_MARKS_U = tuple([m.decode('latin-1') for m in _HASHTAG_MARKS])
+
+
+def strip_colors(msg):
+    """Removes mIRC color and formatting codes from *msg*, with the same
+    result as joining the text of Twisted's ``parseFormattedText`` tree,
+    in two passes over the string and without building the tree.
+
+    >>> strip_colors('\x0314[[\x0307Foo\x0314]]\x034 M\x0310 \x02bar\x0f')
+    '[[Foo]] M bar'
+    """
+    if '\x03' in msg:
+        msg = _COLOR_CODE_RE.sub('', msg)
+    if isinstance(msg, unicode):
+        return msg.translate(_FORMAT_CODES_U)
+    return msg.translate(None, _FORMAT_CODES)
 
 
 def is_ip(addr):
@@ -75,6 +131,16 @@ def is_ip(addr):
     return ret
 
 
+def is_anon_user(user):
+    """Equivalent to :func:`is_ip`, but rejects most usernames without
+    calling into the socket module.
+    """
+    for c in user:
+        if c not in _IP_CHARS:
+            return False
+    return bool(user) and is_ip(user)
+
+
 def parse_revs_from_url(url):
     """
     Parse and return parent_rev_id, rev_id (old, new) from a URL such as:
@@ -114,7 +180,288 @@ def parse_section_title(summary):
     return section_title, real_summary
 
 
+def _parse_query_revs(query_str):
+    # parse_qsl, minus the unquoting, for queries which need none
+    diff = oldid = None
+    for pair in query_str.split('&'):
+        name, sep, value = pair.partition('=')
+        if not sep or not value:
+            continue
+        if name == 'diff':
+            diff = value
+        elif name == 'oldid':
+            oldid = value
+    return diff, oldid
+
+
 def parse_irc_message(message, ns_map=DEFAULT_NS_MAP):
+    """Parses a line from the IRC recent changes feed into a message
+    dict, with the same output as :func:`parse_irc_message_re`. The
+    line is still split by PARSE_EDIT_RE (one pass in C), but the
+    fields are built straight into the result, the usual rev ID query
+    is split without parse_qsl, most usernames are ruled out as IPs
+    without the socket module, and the summary regexes only run when
+    their markers are present.
+    """
+    match = PARSE_EDIT_RE.match(message)
+    if match is None:
+        return parse_irc_message_re(message, ns_map)  # raises KeyError
+    return _parse_edit_match(match, ns_map.get)
+
+
+def parse_irc_stream(lines, ns_map=DEFAULT_NS_MAP):
+    """Lazily parses an iterable of raw IRC feed lines (bytestrings as
+    received, color codes and all, or already decoded text), yielding a
+    message dict for each edit and skipping anything else, such as
+    blank or undecodable lines.
+    """
+    match_edit = PARSE_EDIT_RE.match
+    get_ns = ns_map.get
+    for line in lines:
+        line = strip_colors(line.rstrip('\r\n'))
+        if not isinstance(line, unicode):
+            try:
+                line = line.decode('utf-8')
+            except UnicodeError:
+                continue
+        match = match_edit(line)
+        if match is not None:
+            yield _parse_edit_match(match, get_ns)
+
+
+def write_ndjson(msg_dicts, f, encoder=None):
+    """Writes each message dict as one line of JSON to the file *f*,
+    returning the number written. Lines are written in batches.
+    """
+    encode = (encoder or _NDJSON_ENCODER).encode
+    count = 0
+    batch = []
+    for msg_dict in msg_dicts:
+        batch.append(encode(msg_dict))
+        if len(batch) >= _NDJSON_BATCH_SIZE:
+            f.write('\n'.join(batch) + '\n')
+            count += len(batch)
+            batch = []
+    if batch:
+        f.write('\n'.join(batch) + '\n')
+        count += len(batch)
+    return count
+
+
+def _parse_edit_match(match, get_ns):
+    page_title, flags, url, user, change_size, summary = match.group(
+        *_EDIT_GROUPS)
+
+    top_level_title, _, _ = page_title.partition('/')
+    ns, _, _ = top_level_title.partition(':')
+    flags_str = flags or ''
+    msg_dict = {'page_title': page_title,
+                'flags': flags,
+                'user': user,
+                'summary': summary,
+                'ns': get_ns(ns, 'Main'),
+                'change_size': int(change_size) if change_size else None,
+                'action': 'edit',
+                'is_new': 'N' in flags_str,
+                'is_bot': 'B' in flags_str,
+                'is_minor': 'M' in flags_str,
+                'is_unpatrolled': '!' in flags_str,
+                'is_anon': is_anon_user(user)}
+
+    _, _, query_str = url.partition('?')
+    if '%' in query_str or '+' in query_str or ';' in query_str:
+        try:
+            revs = parse_revs_from_url(url)
+        except ValueError:
+            revs = None
+    else:
+        revs = _parse_query_revs(query_str)
+        if revs[1] is None:
+            revs = None
+    if revs is None:
+        msg_dict['action'] = url
+    else:
+        msg_dict['url'] = url
+        msg_dict['parent_rev_id'], msg_dict['rev_id'] = revs
+
+    _add_summary_fields(msg_dict, summary)
+    return msg_dict
+
+
+def _add_summary_fields(msg_dict, summary):
+    if summary:
+        if summary.startswith('/*'):
+            section, parsed_summary = parse_section_title(summary)
+        else:
+            section, parsed_summary = '', summary.strip()
+        msg_dict['section'] = section
+        msg_dict['parsed_summary'] = parsed_summary
+        marks = (_HASHTAG_MARKS_U if isinstance(summary, unicode)
+                 else _HASHTAG_MARKS)
+        for mark in marks:
+            if mark in summary:
+                msg_dict['hashtags'] = HASHTAG_RE.findall(summary)
+                break
+        else:
+            msg_dict['hashtags'] = []
+        msg_dict['mentions'] = MENTION_RE.findall(summary)
+    else:
+        msg_dict['section'], msg_dict['parsed_summary'] = '', summary
+        msg_dict['hashtags'] = []
+        msg_dict['mentions'] = []
+
+
+def get_channel_server(channel):
+    """Returns the domain of the wiki announced on IRC as *channel*.
+
+    >>> get_channel_server('en.wikipedia')
+    'en.wikipedia.org'
+    >>> get_channel_server('wikidata.wikipedia')
+    'www.wikidata.org'
+    """
+    if channel == WIKIDATA_CHANNEL:
+        return WIKIDATA_SERVER
+    return channel + '.org'
+
+
+def parse_entity_id(page_title):
+    """Returns the ID of the Wikidata entity a page is, or None if
+    the page is not an entity, e.g. a talk page.
+
+    >>> parse_entity_id(u'Property:P31')
+    u'P31'
+    >>> parse_entity_id(u'Talk:Q42') is None
+    True
+    """
+    match = ENTITY_ID_RE.match(page_title or u'')
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def add_entity_fields(msg_dict):
+    """Adds the ``entity_id`` and ``entity_type`` (``'item'``,
+    ``'property'`` or ``'lexeme'``) of a Wikidata change, both None
+    for pages which aren't entities.
+    """
+    entity_id = parse_entity_id(msg_dict.get('page_title'))
+    msg_dict['entity_id'] = entity_id
+    msg_dict['entity_type'] = entity_id and ENTITY_TYPES[entity_id[0]]
+    return msg_dict
+
+
+def get_recentchange_channel(event):
+    """Returns the IRC channel name of the wiki a recentchange event
+    (from EventStreams) is about, e.g. ``'en.wikipedia'``.
+    """
+    server_name = event.get('server_name') or ''
+    if server_name == WIKIDATA_SERVER:
+        return WIKIDATA_CHANNEL
+    if server_name.endswith('.org'):
+        return server_name[:-4]
+    return server_name
+
+
+def peek_recentchange_channel(data):
+    """Returns the channel :func:`get_recentchange_channel` would for
+    the JSON text of a recentchange event, without decoding it, or
+    None if its ``server_name`` can't be found that way.
+
+    >>> peek_recentchange_channel('{"server_name": "de.wikipedia.org"}')
+    'de.wikipedia'
+    """
+    match = SERVER_NAME_RE.search(data)
+    if match is None:
+        return None
+    return get_recentchange_channel({'server_name': match.group(1)})
+
+
+def parse_recentchange(event, ns_map=DEFAULT_NS_MAP):
+    """Maps a recentchange event, as decoded from the JSON of the
+    EventStreams feed, to the same message dict as
+    :func:`parse_irc_message` builds from the IRC feed, or returns None
+    for changes the IRC feed doesn't carry (categorizations and
+    external changes). Log entries also get ``log_type``,
+    ``log_title`` and ``log_params``, which IRC lines lack.
+    """
+    rc_type = event.get('type')
+    if rc_type not in _RC_TYPES:
+        return None
+    title = event.get('title') or u''
+    user = event.get('user') or u''
+    ns = RC_NAMESPACES.get(event.get('namespace'))
+    if ns is None:
+        top_level_title, _, _ = title.partition('/')
+        ns = ns_map.get(top_level_title.partition(':')[0], 'Main')
+    is_bot = bool(event.get('bot'))
+    msg_dict = {'page_title': title,
+                'user': user,
+                'ns': ns,
+                'is_bot': is_bot,
+                'is_anon': is_anon_user(user)}
+    if rc_type == 'log':
+        # titled like on IRC, with the logged page kept apart
+        log_type = event.get('log_type')
+        msg_dict['page_title'] = u'Special:Log/%s' % (log_type,)
+        msg_dict['ns'] = 'Special'
+        summary = event.get('log_action_comment') or None
+        msg_dict.update({'action': event.get('log_action'),
+                         'flags': None,
+                         'log_title': title,
+                         'change_size': None,
+                         'is_new': False,
+                         'is_minor': False,
+                         'is_unpatrolled': False,
+                         'log_type': log_type,
+                         'log_params': event.get('log_params')})
+    else:
+        summary = event.get('comment') or None
+        is_new = rc_type == 'new'
+        is_minor = bool(event.get('minor'))
+        is_unpatrolled = event.get('patrolled') is False
+        flags = ''.join([flag for flag, is_set
+                         in (('!', is_unpatrolled), ('N', is_new),
+                             ('M', is_minor), ('B', is_bot)) if is_set])
+        length = event.get('length') or {}
+        revision = event.get('revision') or {}
+        new_rev_id, old_rev_id = revision.get('new'), revision.get('old')
+        script_url = u'%s%s/index.php' % (event.get('server_url', u''),
+                                          event.get('server_script_path',
+                                                    u'/w'))
+        # the IRC feed's URLs, from which its rev IDs are parsed
+        if is_new:
+            url = u'%s?oldid=%s&rcid=%s' % (script_url, new_rev_id,
+                                            event.get('id'))
+            parent_rev_id, rev_id = None, new_rev_id
+        else:
+            url = u'%s?diff=%s&oldid=%s' % (script_url, new_rev_id,
+                                            old_rev_id)
+            parent_rev_id, rev_id = new_rev_id, old_rev_id
+        msg_dict.update({'action': 'edit',
+                         'flags': flags or None,
+                         'url': url,
+                         'parent_rev_id': _to_str(parent_rev_id),
+                         'rev_id': _to_str(rev_id),
+                         'change_size': ((length.get('new') or 0)
+                                         - (length.get('old') or 0)),
+                         'is_new': is_new,
+                         'is_minor': is_minor,
+                         'is_unpatrolled': is_unpatrolled})
+    msg_dict['summary'] = summary
+    _add_summary_fields(msg_dict, summary)
+    return msg_dict
+
+
+def _to_str(value):
+    if value is None:
+        return None
+    return str(value)
+
+
+def parse_irc_message_re(message, ns_map=DEFAULT_NS_MAP):
+    """The original, straightforward parser, kept as the reference
+    :func:`parse_irc_message` is tested and benchmarked against.
+    """
     ret = PARSE_EDIT_RE.match(message)
     msg_dict = {'is_new': False,
                 'is_bot': False,
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""The geolocation stage of the message pipeline.
+
+GeoLite2 lookups are taken off the reactor thread and run in a small,
+dedicated thread pool, so a slow lookup (e.g., on cold pages of a
+freshly swapped database) cannot stall the IRC read loop or WebSocket
+writes. Messages are still emitted in the order they were submitted:
+a message waits for those ahead of it, and a lookup which takes longer
+than the deadline lets its message go out without geolocation rather
+than hold up the stream.
+
+Lookups are batched: while every thread is busy, cache misses queue
+up, and go to the next free thread together, in a single hop. A miss
+on an IP which is already queued or being looked up waits for that
+lookup instead of starting another.
+"""
+
+import logging
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from twisted.python.failure import Failure
+
+import logs
+import metrics
+from metrics import timer
+
+
+geo_log = logging.getLogger('geo_log')
+failure_sample = logs.SampledLog(geo_log, logging.ERROR)
+timeout_sample = logs.SampledLog(geo_log, logging.WARNING)
+
+GEO_IP_KEY = 'geo_ip'
+DEFAULT_DEADLINE = 0.5
+DEFAULT_THREADS = 4
+DEFAULT_BATCH_SIZE = 64
+
+
+class _Pending(object):
+    __slots__ = ('msg_dict', 'channel', 'done', 'timeout', 'started')
+
+    def __init__(self, msg_dict, channel):
+        self.msg_dict = msg_dict
+        self.channel = channel
+        self.done = False
+        self.timeout = None
+        self.started = None  # when geolocation started
+
+
+def geolocate_batch(geolocate, geoip_db, ips):
+    """Looks up each of *ips*, returning a ``(success, result)`` pair
+    for each, the result of a failed lookup being its Failure.
+    """
+    results = []
+    for ip in ips:
+        try:
+            results.append((True, geolocate(geoip_db, ip)))
+        except Exception:
+            results.append((False, Failure()))
+    return results
+
+
+class GeolocationStage(object):
+    """Geolocates anonymous edits and passes every message on to
+    *emit(msg_dict, channel)* in submission order.
+
+    *geolocate(geoip_db, ip)* is called in the thread pool on a cache
+    miss, and returns None if the lookup failed; cache hits are served
+    straight away on the reactor thread.
+    """
+    def __init__(self, geoip_db_monitor, geolocate, emit,
+                 deadline=DEFAULT_DEADLINE, threads=DEFAULT_THREADS,
+                 threadpool=None, batch_size=DEFAULT_BATCH_SIZE,
+                 _reactor=reactor):
+        self.geoip_db_monitor = geoip_db_monitor
+        self.geolocate = geolocate
+        self.emit = emit
+        self.deadline = deadline
+        self.threads = threads
+        self.batch_size = batch_size
+        self.reactor = _reactor
+        if threadpool is None:
+            threadpool = ThreadPool(minthreads=1, maxthreads=threads,
+                                    name='geolocation')
+            threadpool.start()
+            _reactor.addSystemEventTrigger('during', 'shutdown',
+                                           threadpool.stop)
+        self.threadpool = threadpool
+        self.pending = deque()
+        self.lookups = {}  # ip -> [entries waiting on it]
+        self.queued = []  # ips to look up once a thread is free
+        self.in_flight = 0
+        self.timeouts = 0
+        self.batch_count = 0
+
+    def submit(self, msg_dict, channel, ip=None):
+        entry = _Pending(msg_dict, channel)
+        self.pending.append(entry)
+        if ip is not None:
+            entry.started = timer()
+            cache = self.geoip_db_monitor.cache
+            geo_loc = cache.get(ip) if cache is not None else None
+            if geo_loc is None:
+                self._start_lookup(entry, ip)
+                return
+            msg_dict[GEO_IP_KEY] = geo_loc
+        entry.done = True
+        self._flush()
+
+    def _start_lookup(self, entry, ip):
+        entry.timeout = self.reactor.callLater(self.deadline,
+                                               self._expire, entry, ip)
+        waiting = self.lookups.get(ip)
+        if waiting is not None:
+            waiting.append(entry)
+            return
+        self.lookups[ip] = [entry]
+        self.queued.append(ip)
+        if self.in_flight < self.threads:
+            self._send_batch()
+
+    def _send_batch(self):
+        ips = self.queued[:self.batch_size]
+        del self.queued[:self.batch_size]
+        self.in_flight += 1
+        self.batch_count += 1
+        d = deferToThreadPool(self.reactor, self.threadpool,
+                              geolocate_batch, self.geolocate,
+                              self.geoip_db_monitor.geoip_db, ips)
+        d.addCallbacks(self._resolve_batch, self._fail_batch,
+                       callbackArgs=(ips,), errbackArgs=(ips,))
+
+    def _resolve_batch(self, results, ips):
+        self.in_flight -= 1
+        cache = self.geoip_db_monitor.cache
+        for ip, (success, result) in zip(ips, results):
+            entries = self.lookups.pop(ip)
+            if success:
+                # None is a failed lookup, which isn't cached
+                if cache is not None and result is not None:
+                    # late results still warm the cache
+                    cache.set(ip, result)
+                self._resolve(entries, result)
+            else:
+                failure_sample.log('geolocation of %r failed: %s',
+                                   ip, result.value)
+                self._resolve(entries, None)
+        if self.queued:
+            self._send_batch()
+        self._flush()
+
+    def _fail_batch(self, failure, ips):
+        self._resolve_batch([(False, failure)] * len(ips), ips)
+
+    def _resolve(self, entries, geo_loc):
+        for entry in entries:
+            if entry.done:
+                continue
+            entry.timeout.cancel()
+            if geo_loc is not None:
+                entry.msg_dict[GEO_IP_KEY] = geo_loc
+            entry.done = True
+
+    def _expire(self, entry, ip):
+        self.timeouts += 1
+        metrics.GEO_TIMEOUTS.inc()
+        timeout_sample.log('geolocation of %r exceeded %ss deadline',
+                           ip, self.deadline)
+        entry.done = True
+        self._flush()
+
+    def _flush(self):
+        pending = self.pending
+        while pending and pending[0].done:
+            entry = pending.popleft()
+            if entry.started is not None:
+                # including any wait for the messages ahead of it
+                metrics.GEO_SECONDS.observe(timer() - entry.started)
+            self.emit(entry.msg_dict, entry.channel)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for irc.wikimedia.org, replaying a recording made
+with ``monitor_websocket.py --record`` (see :mod:`feedlog`).
+
+It speaks just enough IRC for the monitor: registration, JOIN, PING
+and QUIT. Lines are sent to the clients in their recorded channels, at
+the recorded pace (``--speed 1``), N times faster (``--speed N``) or as
+fast as possible (``--speed max``). Replay starts once a client joins a
+channel. Point the monitor at it with::
+
+    python wikimon/replay.py feed.log --port 6667 --speed 10
+    IRC_SERVER_HOST=localhost python wikimon/monitor_websocket.py
+
+or ``--irc-host localhost --irc-port 6667``.
+"""
+
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+from twisted.words.protocols import irc
+
+from feedlog import get_log_paths, read_feed_log
+
+
+replay_log = logging.getLogger('replay_log')
+
+DEFAULT_PORT = 6667
+SERVER_NAME = 'localhost'
+SENDER = 'rc-pmtpa!~rc-pmtpa@special.user'
+MAX_SPEED_BATCH = 500
+
+
+class ReplayServerProtocol(irc.IRC):
+    def connectionMade(self):
+        irc.IRC.connectionMade(self)
+        self.nickname = '*'
+        self.channels = set()
+
+    def connectionLost(self, reason):
+        self.factory.clients.discard(self)
+
+    def irc_NICK(self, prefix, params):
+        self.nickname = params[0]
+
+    def irc_USER(self, prefix, params):
+        self.sendMessage(irc.RPL_WELCOME, self.nickname,
+                         ':Welcome to the wikimon replay server',
+                         prefix=SERVER_NAME)
+
+    def irc_JOIN(self, prefix, params):
+        for channel in params[0].split(','):
+            self.channels.add(channel.lstrip('#'))
+            self.sendMessage('JOIN', channel, prefix=self.nickname)
+        self.factory.clients.add(self)
+        self.factory.start()
+
+    def irc_PING(self, prefix, params):
+        self.sendMessage('PONG', SERVER_NAME, *params[:1],
+                         prefix=SERVER_NAME)
+
+    def irc_QUIT(self, prefix, params):
+        self.transport.loseConnection()
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+
+class ReplayServerFactory(ServerFactory):
+    protocol = ReplayServerProtocol
+
+    def __init__(self, records, speed=1.0, loop=False, _reactor=reactor):
+        """*records* is a callable returning an iterable of (delay,
+        channel, message), as from :func:`feedlog.read_feed_log`. A
+        *speed* of None replays as fast as possible.
+        """
+        self.get_records = records
+        self.speed = speed
+        self.loop = loop
+        self.reactor = _reactor
+        self.clients = set()
+        self.records = None
+        self.started = False
+        self.sent = 0
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self.records = iter(self.get_records())
+        self.next_record = None
+        self.start_time = self.reactor.seconds()
+        self.offset = 0.0  # recorded seconds since the start
+        replay_log.info('replaying at %s speed',
+                        '%sx' % self.speed if self.speed else 'max')
+        self.send_due()
+
+    def send(self, channel, msg):
+        for client in self.clients:
+            if channel in client.channels:
+                client.privmsg(SENDER, '#' + channel, msg)
+        self.sent += 1
+
+    def _next(self):
+        try:
+            return next(self.records)
+        except StopIteration:
+            if not self.loop:
+                return None
+            self.records = iter(self.get_records())
+            return next(self.records, None)
+
+    def send_due(self):
+        """Sends every record which is due, then schedules the next
+        call for when the following record is.
+        """
+        if self.speed is None:
+            for _ in xrange(MAX_SPEED_BATCH):
+                record = self._next()
+                if record is None:
+                    return self.finish()
+                self.send(record[1], record[2])
+            self.reactor.callLater(0, self.send_due)
+            return
+        elapsed = (self.reactor.seconds() - self.start_time) * self.speed
+        while True:
+            record = self.next_record or self._next()
+            if record is None:
+                return self.finish()
+            delay, channel, msg = record
+            if self.offset + delay > elapsed:
+                self.next_record = record
+                wait = (self.offset + delay - elapsed) / self.speed
+                self.reactor.callLater(wait, self.send_due)
+                return
+            self.next_record = None
+            self.offset += delay
+            self.send(channel, msg)
+
+    def finish(self):
+        replay_log.info('replay finished, sent %d messages', self.sent)
+
+
+def get_argparser():
+    from argparse import ArgumentParser
+    prs = ArgumentParser(description='replay a recorded IRC feed to local'
+                         ' monitors')
+    prs.add_argument('path', help='the recording; rotated files next to it'
+                     ' are replayed first')
+    prs.add_argument('--port', default=DEFAULT_PORT, type=int)
+    prs.add_argument('--interface', default='127.0.0.1')
+    prs.add_argument('--speed', default='1',
+                     help='a multiple of the recorded pace, or "max"')
+    prs.add_argument('--loop', action='store_true',
+                     help='start over at the end of the recording')
+    return prs
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s\t%(name)s\t %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    args = get_argparser().parse_args()
+    speed = None if args.speed == 'max' else float(args.speed)
+    paths = get_log_paths(args.path)
+    if not paths:
+        raise SystemExit('no recording at %r' % args.path)
+    factory = ReplayServerFactory(lambda: read_feed_log(paths), speed,
+                                  args.loop)
+    reactor.listenTCP(args.port, factory, interface=args.interface)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
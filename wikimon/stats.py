@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Rolling statistics over each wiki's stream, computed once on the
+server rather than by every client::
+
+    ws://wikimon.hatnote.com/en/stats/
+    curl localhost:9001/stats/en/
+
+Every ``--stats-interval`` seconds, a summary of the last
+``--stats-window`` seconds of edits is broadcast on the wiki's
+``stats/`` path: edits per minute (overall and per namespace), the
+share of them by bots and by anonymous users, and the top hashtags,
+mentions and pages.
+
+Memory is fixed whatever the traffic. The window is split into
+:data:`DEFAULT_SLOTS` slots, which expire as a whole. Counts by
+namespace and kind are plain counters, as there are few keys, while
+hashtags, mentions and pages are counted in a space-saving sketch of
+:data:`DEFAULT_CAPACITY` entries per slot: the heavy hitters are kept
+with an overestimate of their count, and the rest are forgotten.
+"""
+
+import time
+from json import dumps
+from heapq import heappush, heapreplace
+
+from twisted.internet.task import LoopingCall
+
+
+DEFAULT_INTERVAL = 10
+DEFAULT_WINDOW = 300
+DEFAULT_SLOTS = 10
+DEFAULT_CAPACITY = 100
+DEFAULT_TOP = 10
+STATS_SUFFIX = '/stats'
+
+
+def get_stats_channel(channel):
+    """Returns the pseudo-channel *channel*'s summaries are broadcast
+    on.
+
+    >>> get_stats_channel('en.wikipedia')
+    'en.wikipedia/stats'
+    """
+    return channel + STATS_SUFFIX
+
+
+def get_stats_path(channel_path):
+    """
+    >>> get_stats_path('/en/')
+    '/en/stats/'
+    """
+    return channel_path + STATS_SUFFIX.lstrip('/') + '/'
+
+
+class SpaceSaving(object):
+    """Counts the most frequent of an unbounded set of keys in
+    *capacity* counters (Metwally et al., 2005). A key not counted
+    takes over the smallest counter, count and all, so counts are
+    overestimated by at most ``total / capacity``.
+
+    The smallest counter is found with a heap of one ``(count, key)``
+    entry per key. Entries aren't updated as counts go up, so they are
+    only lower bounds: one found out of date on top is pushed back down
+    with its current count, rather than taken.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.total = 0
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1):
+        self.total += count
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+        heap = self._heap
+        if len(counts) < self.capacity:
+            counts[key] = count
+            heappush(heap, (count, key))
+            return
+        while True:
+            floor, min_key = heap[0]
+            current = counts[min_key]
+            if current == floor:
+                break
+            heapreplace(heap, (current, min_key))
+        del counts[min_key]
+        counts[key] = floor + count
+        heapreplace(heap, (floor + count, key))
+
+    def top(self, count=DEFAULT_TOP):
+        """Returns up to *count* ``(key, count)`` pairs, most frequent
+        first.
+        """
+        items = sorted(self.counts.items(), key=lambda item: -item[1])
+        return items[:count]
+
+
+class _Slot(object):
+    __slots__ = ('index', 'edits', 'ns', 'kinds', 'sketches')
+
+    def __init__(self, index, capacity):
+        self.index = index
+        self.edits = 0
+        self.ns = {}
+        self.kinds = {'bot': 0, 'anon': 0}
+        self.sketches = {'hashtags': SpaceSaving(capacity),
+                         'mentions': SpaceSaving(capacity),
+                         'pages': SpaceSaving(capacity)}
+
+
+class RollingStats(object):
+    """The statistics of one wiki's edits over the last *window*
+    seconds, kept in *slots* slots.
+    """
+    def __init__(self, window=DEFAULT_WINDOW, slots=DEFAULT_SLOTS,
+                 capacity=DEFAULT_CAPACITY, _time=time.time):
+        self.window = window
+        self.slot_width = float(window) / slots
+        self.capacity = capacity
+        self._time = _time
+        self.started = _time()
+        self._slots = [None] * slots
+
+    def _get_slot(self, now):
+        index = int(now // self.slot_width)
+        i = index % len(self._slots)
+        slot = self._slots[i]
+        if slot is None or slot.index != index:
+            slot = self._slots[i] = _Slot(index, self.capacity)
+        return slot
+
+    def add(self, msg_dict):
+        if msg_dict.get('action') != 'edit':
+            return
+        slot = self._get_slot(self._time())
+        slot.edits += 1
+        ns = msg_dict.get('ns')
+        slot.ns[ns] = slot.ns.get(ns, 0) + 1
+        if msg_dict.get('is_bot'):
+            slot.kinds['bot'] += 1
+        if msg_dict.get('is_anon'):
+            slot.kinds['anon'] += 1
+        sketches = slot.sketches
+        for hashtag in msg_dict.get('hashtags') or ():
+            sketches['hashtags'].add(hashtag)
+        for mention in msg_dict.get('mentions') or ():
+            sketches['mentions'].add(mention)
+        if msg_dict.get('page_title'):
+            sketches['pages'].add(msg_dict['page_title'])
+
+    def _get_live_slots(self, now):
+        oldest = int(now // self.slot_width) - len(self._slots) + 1
+        return [slot for slot in self._slots
+                if slot is not None and slot.index >= oldest]
+
+    def summary(self, top=DEFAULT_TOP):
+        """Returns the summary broadcast to clients, as a dict."""
+        now = self._time()
+        slots = self._get_live_slots(now)
+        # until a whole window has passed, rates are over the time since
+        # counting started
+        minutes = max(min(self.window, now - self.started), 1.0) / 60
+        edits = sum([s.edits for s in slots])
+        ns_edits = {}
+        kinds = {'bot': 0, 'anon': 0}
+        for slot in slots:
+            for ns, count in slot.ns.items():
+                ns_edits[ns] = ns_edits.get(ns, 0) + count
+            for kind, count in slot.kinds.items():
+                kinds[kind] += count
+        res = {'type': 'stats',
+               'time': now,
+               'window': self.window,
+               'edits': edits,
+               'edits_per_minute': round(edits / minutes, 2),
+               'ns_edits_per_minute': dict(
+                   [(ns, round(count / minutes, 2))
+                    for ns, count in ns_edits.items()]),
+               'bot_share': _share(kinds['bot'], edits),
+               'anon_share': _share(kinds['anon'], edits)}
+        for name in ('hashtags', 'mentions', 'pages'):
+            res['top_' + name] = _merge_top(
+                [s.sketches[name] for s in slots], top)
+        return res
+
+
+def _share(count, total):
+    if not total:
+        return 0.0
+    return round(float(count) / total, 4)
+
+
+def _merge_top(sketches, top):
+    counts = {}
+    for sketch in sketches:
+        for key, count in sketch.counts.iteritems():
+            counts[key] = counts.get(key, 0) + count
+    items = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return [list(item) for item in items[:top]]
+
+
+class StatsEngine(object):
+    """Stands in for the broadcaster: counts each message into its
+    wiki's statistics on the way through to *broadcaster*, and
+    broadcasts every wiki's summary on its stats channel every
+    *interval* seconds.
+    """
+    def __init__(self, broadcaster, channels, interval=DEFAULT_INTERVAL,
+                 window=DEFAULT_WINDOW, top=DEFAULT_TOP,
+                 capacity=DEFAULT_CAPACITY, _time=time.time):
+        self.broadcaster = broadcaster
+        self.interval = interval
+        self.top = top
+        self.stats = dict([(c, RollingStats(window, capacity=capacity,
+                                            _time=_time))
+                           for c in channels])
+        self._call = None
+
+    def broadcast(self, msg, channel, msg_dict=None):
+        channel_stats = self.stats.get(channel)
+        if channel_stats is not None and msg_dict is not None:
+            channel_stats.add(msg_dict)
+        self.broadcaster.broadcast(msg, channel, msg_dict)
+
+    def publish(self):
+        for channel, channel_stats in self.stats.items():
+            summary = channel_stats.summary(self.top)
+            summary['channel'] = channel
+            self.broadcaster.broadcast(dumps(summary, sort_keys=True),
+                                       get_stats_channel(channel), summary)
+
+    def start(self):
+        self._call = LoopingCall(self.publish)
+        self._call.start(self.interval, now=False)
+        return self
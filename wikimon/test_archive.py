@@ -0,0 +1,130 @@
+import gzip
+import os
+from json import dumps, loads
+
+import pytest
+from twisted.internet.defer import maybeDeferred
+from twisted.web.test.requesthelper import DummyRequest
+
+import wikimon.monitor_websocket as MW
+from wikimon.archive import (ArchiveWriter, ArchiveReader, ArchiveResource,
+                             get_query, get_segment_name, SEGMENT_EXT,
+                             INDEX_EXT)
+
+HOUR = 1492000000 - 1492000000 % 3600
+
+
+def _write(writer, ts, n, **msg_dict):
+    msg_dict.setdefault('rev_id', str(n))
+    writer.write(ts, 'en.wikipedia', dumps(msg_dict), msg_dict)
+
+
+def _segment_path(tmpdir, hour, ext=SEGMENT_EXT):
+    return os.path.join(str(tmpdir), 'en.wikipedia',
+                        get_segment_name(hour) + ext)
+
+
+def test_archive_query(tmpdir):
+    writer = ArchiveWriter(str(tmpdir), block_size=2)
+    _write(writer, HOUR + 1, 1, hashtags=[u'1Lib1Ref'], user=u'A')
+    _write(writer, HOUR + 2, 2, hashtags=[], user=u'B')
+    _write(writer, HOUR + 3, 3, hashtags=[], user=u'B')
+    _write(writer, HOUR + 4, 4, hashtags=[], user=u'C')
+    _write(writer, HOUR + 3601, 5, hashtags=[u'1lib1ref'], user=u'B')
+    writer.flush_all()
+    writer.close()
+
+    # segments are plain gzip files
+    with gzip.open(_segment_path(tmpdir, HOUR)) as f:
+        assert [loads(line)['msg']['rev_id'] for line in f] == \
+            ['1', '2', '3', '4']
+
+    reader = ArchiveReader(str(tmpdir))
+    records, truncated = reader.query('en.wikipedia', HOUR, HOUR + 7200,
+                                      'hashtag', u'1LIB1REF')
+    assert [r['msg']['rev_id'] for r in records] == ['1', '5']
+    assert records[0]['ts'] == HOUR + 1
+    assert not truncated
+    # the block of edits 3 and 4 was skipped
+    assert reader.blocks_read == 2
+
+    records, truncated = reader.query('en.wikipedia', HOUR + 2, HOUR + 3601,
+                                      'user', u'B', limit=2)
+    assert [r['msg']['rev_id'] for r in records] == ['2', '3']
+    assert truncated
+
+    records, _ = reader.query('en.wikipedia', HOUR + 3, HOUR + 4)
+    assert [r['msg']['rev_id'] for r in records] == ['3', '4']
+    assert reader.query('de.wikipedia', 0, HOUR * 2) == ([], False)
+
+
+def test_archive_restart_and_prune(tmpdir):
+    writer = ArchiveWriter(str(tmpdir), max_hours=1)
+    _write(writer, HOUR + 1, 1)
+    writer.flush_all()
+    writer.close()
+    # a block which was being written when the process died
+    with open(_segment_path(tmpdir, HOUR), 'ab') as f:
+        f.write('junk')
+
+    # and an index entry
+    with open(_segment_path(tmpdir, HOUR, INDEX_EXT), 'ab') as f:
+        f.write('{"offset": ')
+
+    writer = ArchiveWriter(str(tmpdir), max_hours=1)
+    _write(writer, HOUR + 2, 2)
+    writer.flush_all()
+    _write(writer, HOUR + 3, 3)
+    writer.flush_all()
+    writer.close()
+    # blocks written after a restart survive the next one
+    writer = ArchiveWriter(str(tmpdir), max_hours=1)
+    _write(writer, HOUR + 4, 4)
+    writer.flush_all()
+    records, _ = ArchiveReader(str(tmpdir)).query('en.wikipedia', 0,
+                                                  HOUR * 2)
+    assert [r['msg']['rev_id'] for r in records] == ['1', '2', '3', '4']
+
+    _write(writer, HOUR + 3600 * 2, 5)
+    writer.flush_all()
+    writer.close()
+    assert not os.path.exists(_segment_path(tmpdir, HOUR))
+
+
+def test_archive_thread(tmpdir):
+    writer = ArchiveWriter(str(tmpdir), _time=lambda: HOUR).start()
+    writer.add('{"rev_id": "1"}', 'en.wikipedia', {'rev_id': '1'})
+    writer.stop()
+    records, _ = ArchiveReader(str(tmpdir)).query('en.wikipedia', HOUR,
+                                                  HOUR)
+    assert records == [{'ts': HOUR, 'msg': {'rev_id': '1'}}]
+
+
+@pytest.mark.parametrize('params', [
+    {'since': ['2'], 'until': ['1']},
+    {'since': ['yesterday']},
+    {'limit': ['0']},
+    {'hashtag': ['a'], 'user': ['b']}])
+def test_get_query_invalid(params):
+    with pytest.raises(ValueError):
+        get_query(params, HOUR)
+
+
+def test_archive_resource(tmpdir):
+    writer = ArchiveWriter(str(tmpdir))
+    _write(writer, HOUR + 1, 1, user=u'\xc9')
+    writer.flush_all()
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'])
+    resource = ArchiveResource(factory, str(tmpdir), _defer=maybeDeferred,
+                               _time=lambda: HOUR + 60)
+    request = DummyRequest(['en', ''])
+    request.addArg('user', '\xc3\x89')
+    resource.render(request)
+    res = loads(''.join(request.written))
+    assert [r['msg']['rev_id'] for r in res['messages']] == ['1']
+
+    request = DummyRequest(['en', ''])
+    request.addArg('since', 'x')
+    resource.render(request)
+    assert request.responseCode == 400
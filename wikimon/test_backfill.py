@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import os
+from StringIO import StringIO
+
+from wikimon.backfill import parse_irc_bulk
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'corpus', 'rc_feed.txt')
+
+
+def test_bulk_output_is_ordered():
+    with open(CORPUS_PATH, 'rb') as f:
+        lines = f.readlines()
+    outputs = []
+    for processes in (1, 2):
+        out = StringIO()
+        stats = parse_irc_bulk(lines, out, processes=processes,
+                               chunk_size=150)
+        assert stats['lines'] == stats['records'] == len(lines)
+        outputs.append(out.getvalue())
+    assert outputs[0] == outputs[1]
+    assert outputs[0].count('\n') == len(lines)
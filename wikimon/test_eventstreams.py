@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.test.requesthelper import DummyRequest
+
+from wikimon.eventstreams import EventSourceProtocol, StandInStreamResource
+
+
+def test_event_source_protocol():
+    events = []
+    protocol = EventSourceProtocol(lambda *a: events.append(a))
+    body = (':ok\n\nevent: message\nid: 1\ndata: {"a":\ndata: 1}\n\n'
+            'event: ping\ndata: x\n\r\ndata: 2\r\n\r\n')
+    for i in range(0, len(body), 7):
+        protocol.dataReceived(body[i:i + 7])
+    assert events == [('{"a":\n1}', '1'), ('2', '1')]
+
+
+def test_stand_in_stream():
+    clock = Clock()
+    resource = StandInStreamResource(lambda: ['{"i": 0}', '{"i": 1}'],
+                                     rate=1, _reactor=clock)
+    first = DummyRequest([''])
+    resource.render_GET(first)
+    assert first.written == ['event: message\nid: 0\ndata: {"i": 0}\n\n']
+
+    resumed = DummyRequest([''])
+    resumed.headers['last-event-id'] = '-1'
+    resource.render_GET(resumed)
+    clock.advance(1)
+    assert resumed.written == first.written
+    assert first.written[-1] == 'event: message\nid: 1\ndata: {"i": 1}\n\n'
+    clock.advance(1)
+    assert resource.sent == 2 and not resource._call.running
+
+
+def test_read_timeout():
+    clock = Clock()
+    done = []
+    protocol = EventSourceProtocol(lambda *a: None, done.append,
+                                   read_timeout=60)
+    protocol.callLater = clock.callLater
+    protocol.makeConnection(StringTransport())
+    clock.advance(59)
+    protocol.dataReceived('data: 1\n\n')
+    clock.advance(59)
+    assert protocol.transport.producerState == 'producing'
+    clock.advance(1)
+    assert protocol.transport.producerState == 'stopped'
+    protocol.connectionLost(None)
+    assert done == [None] and not clock.getDelayedCalls()
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from wikimon.feedlog import FeedRecorder, get_log_paths, read_feed_log
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_record_rotate_and_read(tmpdir):
+    path = str(tmpdir.join('feed.log'))
+    clock = FakeClock()
+    recorder = FeedRecorder(path, rotate_length=100, _clock=clock)
+    msgs = ['\x0314[[\x0307Foo\x0314]]\x034 M\x0310 edit %d' % i
+            for i in range(10)]
+    for i, msg in enumerate(msgs):
+        clock.now += 0.25 * i
+        recorder.record('en.wikipedia', msg)
+    recorder.close()
+
+    paths = get_log_paths(path)
+    assert len(paths) > 2
+    assert paths[-1] == path
+    assert paths[0] == path + '.%d' % (len(paths) - 1)
+    records = list(read_feed_log(paths))
+    assert [msg for _, _, msg in records] == msgs
+    assert [channel for _, channel, _ in records] == ['en.wikipedia'] * 10
+    assert [delay for delay, _, _ in records] == [0.25 * i for i in range(10)]
@@ -0,0 +1,32 @@
+import pytest
+
+from wikimon.filters import (MessageFilter, get_filter_key,
+                             get_query_filter_spec)
+
+
+def test_equivalent_specs_share_a_key():
+    from_query = get_filter_key(get_query_filter_spec(
+        {'ns': ['Talk', 'Main'], 'is_bot': ['0'], 'lang': ['en']}))
+    from_json = get_filter_key({'is_bot': False, 'ns': ['Main', 'Talk']})
+    assert from_query == from_json
+    assert get_filter_key({}) is None
+
+
+@pytest.mark.parametrize('spec', [{'is_bot': 'maybe'},
+                                  {'min_change_size': 'big'},
+                                  {'flavor': 'sour'},
+                                  ['is_bot']])
+def test_bad_specs(spec):
+    with pytest.raises(ValueError):
+        get_filter_key(spec)
+
+
+def test_match():
+    mf = MessageFilter(get_filter_key({'is_anon': True,
+                                       'min_change_size': 10}))
+    assert mf.match({'is_anon': True, 'change_size': -20})
+    assert not mf.match({'is_anon': True, 'change_size': 3})
+    assert not mf.match({'is_anon': True, 'change_size': -10})
+    assert not mf.match({'is_anon': True, 'change_size': None})
+    assert not mf.match({'is_anon': False, 'change_size': 200})
+    assert MessageFilter(None).match({})
@@ -0,0 +1,75 @@
+from wikimon.geocache import GeoCache
+from wikimon.monitor_geolite2 import MonitorGeoLite2
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = GeoCache(size=2)
+    cache.set('1.1.1.1', {'city': 'a'})
+    cache.set('2.2.2.2', {'city': 'b'})
+    assert cache.get('1.1.1.1') == {'city': 'a'}
+    cache.set('3.3.3.3', {'city': 'c'})
+    assert cache.get('2.2.2.2') is None
+    assert cache.get('1.1.1.1') == {'city': 'a'}
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (2, 1, 1)
+
+
+def test_ttl():
+    clock = FakeClock()
+    cache = GeoCache(ttl=60, _time=clock)
+    cache.set('1.1.1.1', {})
+    clock.now += 59
+    assert cache.get('1.1.1.1') == {}
+    clock.now += 2
+    assert cache.get('1.1.1.1') is None
+    assert cache.get_stats()['expirations'] == 1
+
+
+def test_ipv6_prefix():
+    cache = GeoCache(ipv6_prefix=True)
+    cache.set('2001:558:6033:77:453b:b384:fef:e2d9', {'city': 'x'})
+    assert cache.get('2001:558:6033:77::1') == {'city': 'x'}
+    assert cache.get('2001:558:6033:78::1') is None
+
+
+def test_swap_invalidates():
+    cache = GeoCache()
+    monitor = MonitorGeoLite2('/nonexistent.mmdb', cache)
+    cache.set('1.1.1.1', {})
+    monitor.store(None)
+    assert len(cache) == 1
+    monitor.store(object())
+    assert len(cache) == 0
+
+
+def test_recent_keys():
+    cache = GeoCache()
+    for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']:
+        cache.set(ip, {})
+    cache.get('1.1.1.1')
+    assert cache.get_recent_keys(2) == ['1.1.1.1', '3.3.3.3']
+
+
+def test_metrics():
+    from wikimon import metrics
+
+    counters = [metrics.GEO_CACHE_HITS, metrics.GEO_CACHE_MISSES,
+                metrics.GEO_CACHE_EVICTIONS]
+    before = [c.labels().value for c in counters]
+    cache = GeoCache(size=1)
+    cache.set('1.1.1.1', {})
+    cache.get('1.1.1.1')
+    cache.set('2.2.2.2', {})
+    cache.get('1.1.1.1')
+    assert [c.labels().value - b
+            for c, b in zip(counters, before)] == [1, 1, 1]
+    assert metrics.GEO_CACHE_SIZE.labels().value == 1
+    assert 'wikimon_geo_cache_size 1' in metrics.REGISTRY.render()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+
+import geoip
+
+from wikimon import geocountry
+
+
+def _encode(value):
+    # just enough of the MaxMind DB data format for the fixture below
+    if isinstance(value, dict):
+        out = chr((7 << 5) | len(value))
+        for key in sorted(value):
+            out += _encode(key) + _encode(value[key])
+        return out
+    if isinstance(value, basestring):
+        value = value.encode('utf-8')
+        return chr((2 << 5) | len(value)) + value
+    packed = struct.pack('>Q', value).lstrip('\x00')
+    return chr(len(packed)) + chr(9 - 7) + packed  # uint64
+
+
+US = {'country': {'iso_code': 'US', 'names': {'en': 'United States'}}}
+DE = {'country': {'iso_code': 'DE', 'names': {'en': 'Germany'}}}
+
+
+def write_mmdb(path, build_epoch=1500000000):
+    """Writes a three node IPv4 database: 0.0.0.0/2 is the US (as two
+    /3s), 64.0.0.0/2 is Germany and 128.0.0.0/1 is unknown.
+    """
+    us_data, de_data = _encode(US), _encode(DE)
+    nodes = 3
+    us = nodes + 16
+    de = us + len(us_data)
+
+    def node(left, right):
+        return struct.pack('>I', left)[1:] + struct.pack('>I', right)[1:]
+
+    tree = node(1, nodes) + node(2, de) + node(us, us)
+    metadata = {'node_count': nodes, 'record_size': 24, 'ip_version': 4,
+                'build_epoch': build_epoch, 'database_type': 'Test-City'}
+    with open(path, 'wb') as f:
+        f.write(tree + '\x00' * 16 + us_data + de_data
+                + geoip.MMDB_METADATA_START + _encode(metadata))
+
+
+def test_country_table(tmpdir):
+    mmdb_path = str(tmpdir.join('test.mmdb'))
+    write_mmdb(mmdb_path)
+    db = geocountry.open_database(mmdb_path)
+    assert os.path.exists(geocountry.get_table_path(mmdb_path))
+    assert db.v4_count == 3  # the two US /3s are merged
+    mmdb = geoip.open_database(mmdb_path)
+    for ip in ['0.0.0.0', '10.1.2.3', '63.255.255.255', '64.0.0.0',
+               '99.1.1.1', '128.0.0.0', '200.0.0.1', '255.255.255.255']:
+        expected = mmdb.lookup(ip)
+        result = db.lookup(ip)
+        if expected is None:
+            assert result is None
+        else:
+            assert (result.get_info_dict()['country']
+                    == expected.get_info_dict()['country'])
+    assert db.lookup('::ffff:64.1.1.1').get_info_dict() == DE
+    # 6to4, for 64.1.1.1
+    assert db.lookup('2002:4001:101::1').get_info_dict() == DE
+    assert db.lookup('2001:db8::1') is None
+    assert db.get_info().date == mmdb.get_info().date
+    db.close()
+    mmdb.close()
+
+
+def test_country_table_rebuilt(tmpdir):
+    mmdb_path = str(tmpdir.join('test.mmdb'))
+    table_path = geocountry.get_table_path(mmdb_path)
+    write_mmdb(mmdb_path)
+    geocountry.open_database(mmdb_path).close()
+    # a newer release, with its upstream file time kept
+    write_mmdb(mmdb_path, build_epoch=1600000000)
+    os.utime(mmdb_path, (0, 0))
+    db = geocountry.open_database(mmdb_path)
+    assert db.build_epoch == 1600000000
+    db.close()
+    # and the table isn't rebuilt while it matches
+    os.utime(table_path, (1, 1))
+    geocountry.open_database(mmdb_path).close()
+    assert os.path.getmtime(table_path) == 1
@@ -0,0 +1,65 @@
+import pytest
+from json import dumps
+
+from wikimon.history import History, get_query_replay
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+def _edit(rev_id):
+    return dumps({'rev_id': str(rev_id)})
+
+
+def test_bounds():
+    history = History(size=3)
+    for rev_id in range(5):
+        history.append(_edit(rev_id))
+    assert history.last(10) == [_edit(2), _edit(3), _edit(4)]
+    assert history.last(1) == [_edit(4)]
+    assert history.last(0) == []
+
+    history = History(max_bytes=len(_edit(1)) * 2)
+    for rev_id in range(1, 4):
+        history.append(_edit(rev_id))
+    assert history.last(10) == [_edit(2), _edit(3)]
+    assert history.byte_count == len(_edit(1)) * 2
+
+
+def test_since():
+    history = History(_time=FakeClock())
+    for rev_id in range(1, 4):
+        history.append(_edit(rev_id))  # at 1001, 1002 and 1003
+    assert history.since(1001.5) == [_edit(2), _edit(3)]
+    assert history.since(1003) == []
+
+
+def test_since_rev_id():
+    history = History()
+    history.append(_edit(10))
+    history.append(dumps({'action': 'block', 'rev_id': None}))
+    history.append(_edit(30), {'rev_id': '30'})
+    history.append(_edit(20))
+    assert history.since_rev_id(30) == [_edit(20)]
+    assert history.since_rev_id(20) == []
+    # no longer buffered: resume from the first newer edit
+    assert history.since_rev_id(5) == history.last(4)
+    assert history.since_rev_id(25) == [_edit(30), _edit(20)]
+    assert history.since_rev_id(99) == []
+
+
+def test_get_query_replay():
+    assert get_query_replay({}) is None
+    assert get_query_replay({'replay': ['5']}) == ('replay', 5)
+    assert get_query_replay({'since': ['1.5']}) == ('since', 1.5)
+    assert get_query_replay({'since_rev_id': ['7']}) == ('since_rev_id', 7)
+    for params in ({'replay': ['x']}, {'replay': ['-1']},
+                   {'replay': ['1'], 'since': ['1']}):
+        with pytest.raises(ValueError):
+            get_query_replay(params)
@@ -0,0 +1,177 @@
+from json import dumps, loads
+
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+import wikimon.monitor_websocket as MW
+from wikimon import metrics
+from wikimon.httpstream import EventStreamResource, LongPollResource
+
+
+class _Transport(object):
+    aborted = False
+
+    def abortConnection(self):
+        self.aborted = True
+
+
+class _Request(DummyRequest):
+    producer = None
+
+    def __init__(self, *a, **kw):
+        DummyRequest.__init__(self, *a, **kw)
+        self.transport = _Transport()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+def _factory(**kw):
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'], **kw)
+    factory.protocol = MW.BroadcastServerProtocol
+    return factory
+
+
+def _request(path, headers=None, **args):
+    request = _Request(path.split('/'))
+    for name, value in args.items():
+        request.addArg(name, value)
+    for name, value in (headers or {}).items():
+        request.headers[name.lower()] = value
+    return request
+
+
+def _broadcast(factory, **msg_dict):
+    factory.broadcast(dumps(msg_dict), 'en.wikipedia', msg_dict)
+
+
+def test_event_stream():
+    factory = _factory()
+    _broadcast(factory, rev_id='1', is_bot=False)
+    resource = EventStreamResource(factory)
+    clients = metrics.CLIENTS.labels('sse')
+    clients_before = clients.value
+    humans = _request('en/', is_bot='false')
+    assert resource.render(humans) == NOT_DONE_YET
+    resuming = _request('en/', {'Last-Event-ID': '0'})
+    resource.render(resuming)
+    assert len(factory.clients['en.wikipedia']) == 2
+    assert clients.value - clients_before == 2
+
+    _broadcast(factory, rev_id='2', is_bot=True)
+    _broadcast(factory, rev_id='3', is_bot=False)
+    event = 'id: 3\ndata: %s\n\n' % dumps({'rev_id': '3', 'is_bot': False})
+    assert ''.join(humans.written) == ':ok\n\n' + event
+    assert ''.join(resuming.written).count('data: ') == 3
+
+    humans.processingFailed(Failure(ConnectionLost()))
+    assert len(factory.clients['en.wikipedia']) == 1
+    assert clients.value - clients_before == 1
+    _broadcast(factory, rev_id='4', is_bot=False)
+    assert ''.join(humans.written) == ':ok\n\n' + event
+
+
+def test_event_stream_slow_client():
+    factory = _factory()
+    resource = EventStreamResource(factory)
+    fast, slow = _request('en/'), _request('en/')
+    for request in (fast, slow):
+        resource.render(request)
+    client = slow.producer
+    client.max_pending = 100
+    client.pauseProducing()  # the transport's buffer is full
+    dropped = metrics.DROPPED_FRAMES.labels()
+    dropped_before = dropped.value
+    for i in range(4):
+        _broadcast(factory, rev_id=str(i), summary='x' * 20)
+    # the second message past the full buffer is over the limit
+    assert slow.transport.aborted
+    assert ''.join(slow.written).count('data: ') == 2
+    assert ''.join(fast.written).count('data: ') == 4
+    assert dropped.value - dropped_before == 2
+
+    slow.processingFailed(Failure(ConnectionLost()))
+    assert len(factory.clients['en.wikipedia']) == 1
+
+
+def test_long_poll():
+    clock = Clock()
+    factory = _factory()
+    resource = LongPollResource(factory, _reactor=clock)
+    seq = factory.seq
+    _broadcast(factory, rev_id='1')
+    _broadcast(factory, rev_id='2')
+
+    behind = _request('en/', cursor=str(seq + 1))
+    resource.render(behind)
+    clock.advance(0)
+    assert loads(''.join(behind.written)) == {'cursor': seq + 2,
+                                              'messages': [{'rev_id': '2'}]}
+    assert behind.finished
+
+    waiting = [_request('en/', cursor=str(seq + 2)) for i in range(2)]
+    for request in waiting:
+        resource.render(request)
+    assert not any([r.written for r in waiting])
+    _broadcast(factory, rev_id='3')
+    clock.advance(0)
+    dropped = metrics.DROPPED_FRAMES.labels()
+    dropped_before = dropped.value
+    # answered, but not yet unregistered
+    _broadcast(factory, rev_id='4')
+    assert dropped.value == dropped_before
+    clock.advance(0)
+    for request in waiting:
+        assert loads(''.join(request.written))['cursor'] == seq + 3
+        assert request.finished and request.producer is None
+    assert not factory.clients['en.wikipedia']
+
+    idle = _request('en/', timeout='5')
+    resource.render(idle)
+    clock.advance(5)
+    assert loads(''.join(idle.written)) == {'cursor': seq + 4,
+                                            'messages': []}
+
+
+def test_long_poll_workers():
+    # two workers, numbered by the relay, the second one lagging
+    clock = Clock()
+    ahead, behind = _factory(), _factory()
+    for factory in (ahead, behind):
+        factory.broadcast(dumps({'rev_id': '1'}), 'en.wikipedia', seq=41)
+    ahead.broadcast(dumps({'rev_id': '2'}), 'en.wikipedia', seq=42)
+    request = _request('en/', cursor='41')
+    LongPollResource(ahead, _reactor=clock).render(request)
+    assert loads(''.join(request.written))['cursor'] == 42
+
+    request = _request('en/', cursor='42')
+    LongPollResource(behind, _reactor=clock).render(request)
+    behind.broadcast(dumps({'rev_id': '2'}), 'en.wikipedia', seq=42)
+    assert not request.written  # already had it
+    behind.broadcast(dumps({'rev_id': '3'}), 'en.wikipedia', seq=43)
+    assert loads(''.join(request.written)) == {'cursor': 43, 'messages': [
+        {'rev_id': '3'}]}
+
+
+def test_errors():
+    factory = _factory(history_size=0)
+    request = _request('fr/')
+    assert 'no wiki' in EventStreamResource(factory).render(request)
+    assert request.responseCode == 404
+    request = _request('en/', cursor='x')
+    LongPollResource(factory).render(request)
+    assert request.responseCode == 501
+    request = _request('en/', ns='Main', is_bot='maybe')
+    EventStreamResource(factory).render(request)
+    assert request.responseCode == 400
+    for param in ('batch', 'replay', 'since_rev_id'):
+        request = _request('en/', **{param: '1'})
+        assert param in LongPollResource(_factory()).render(request)
+        assert request.responseCode == 400
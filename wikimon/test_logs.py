@@ -0,0 +1,64 @@
+import logging
+
+from wikimon.logs import SampledLog, QueueHandler, LogWriter
+
+
+class Recorder(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class Unformattable(object):
+    def __repr__(self):
+        raise AssertionError('formatted')
+
+
+def _logger(name, level=logging.INFO):
+    logger = logging.getLogger('test_logs.' + name)
+    logger.propagate = False
+    logger.setLevel(level)
+    recorder = Recorder()
+    logger.handlers = [recorder]
+    return logger, recorder
+
+
+def test_sampled_log():
+    logger, recorder = _logger('sampled')
+    now = [100.0]
+    sampled = SampledLog(logger, every=2, per_second=2,
+                         _time=lambda: now[0])
+    for i in range(10):
+        sampled.log('event %d', i)
+    assert recorder.messages == ['event 1', 'event 3']
+    assert sampled.suppressed == 3
+
+    now[0] += 1
+    sampled.log('event %d', 10)
+    assert sampled.log('event %d', 11)
+    assert recorder.messages[-1] == 'event 11 (3 similar suppressed)'
+
+
+def test_sampled_log_disabled():
+    logger, recorder = _logger('disabled', logging.WARNING)
+    sampled = SampledLog(logger, per_second=None)
+    assert not sampled.log('%r', Unformattable())
+    assert not recorder.messages and not sampled.suppressed
+
+
+def test_queued_logging():
+    recorder = Recorder()
+    writer = LogWriter([recorder], queue_size=2)
+    handler = QueueHandler(writer.queue)
+    logger, _ = _logger('queued')
+    logger.handlers = [handler]
+    for i in range(3):
+        logger.info('record %d', i)
+    assert handler.dropped == 1 and not recorder.messages
+
+    writer.start()
+    writer.stop()
+    assert recorder.messages == ['record 0', 'record 1']
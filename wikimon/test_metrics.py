@@ -0,0 +1,62 @@
+from wikimon import metrics
+from wikimon.metrics import Registry
+
+
+def test_render():
+    registry = Registry()
+    msgs = registry.counter('msgs_total', 'Messages.', ['channel'])
+    clients = registry.gauge('clients', 'Clients.')
+    latency = registry.histogram('latency_seconds', 'Latency.',
+                                 buckets=(0.1, 1.0))
+    msgs.labels('en.wikipedia').inc()
+    msgs.labels('en.wikipedia').inc(2)
+    msgs.labels('de.wikipedia').inc()
+    clients.inc(3)
+    clients.dec()
+    for value in (0.05, 0.1, 0.5, 2.0):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        '# HELP msgs_total Messages.',
+        '# TYPE msgs_total counter',
+        'msgs_total{channel="de.wikipedia"} 1',
+        'msgs_total{channel="en.wikipedia"} 3',
+        '# HELP clients Clients.',
+        '# TYPE clients gauge',
+        'clients 2',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 2.65',
+        'latency_seconds_count 4']
+
+
+def test_label_escaping():
+    registry = Registry()
+    registry.counter('c_total', 'C.', ['x']).labels('a"b\\c\n').inc()
+    assert 'c_total{x="a\\"b\\\\c\\n"} 1' in registry.render()
+
+
+def test_broadcast_counts_frames():
+    from wikimon.testing import connect
+    import wikimon.monitor_websocket as MW
+
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'])
+    factory.protocol = MW.BroadcastServerProtocol
+    sent = metrics.SENT_FRAMES.labels()
+    dropped = metrics.DROPPED_FRAMES.labels()
+    sent_before, dropped_before = sent.value, dropped.value
+    fanout_count = sum(metrics.FANOUT_SECONDS.counts)
+
+    open_proto, _ = connect(factory, '/en/', 40100)
+    closing_proto, transport = connect(factory, '/en/', 40101)
+    closing_proto.state = MW.WebSocketProtocol.STATE_CLOSING
+    factory.broadcast('{}', 'en.wikipedia')
+
+    assert transport.value() == ''
+    assert sent.value - sent_before == 1
+    assert dropped.value - dropped_before == 1
+    assert sum(metrics.FANOUT_SECONDS.counts) == fanout_count + 1
@@ -0,0 +1,57 @@
+import pytest
+
+from wikimon.monitor_geolite2 import (InvalidDatabase, MonitorGeoLite2,
+                                      validate_database)
+
+
+class FakeDatabase(object):
+    def __init__(self, metadata, found=True, broken=False):
+        self.metadata = metadata
+        self.found = found
+        self.broken = broken
+
+    def get_metadata(self):
+        return self.metadata
+
+    def lookup(self, ip):
+        if self.broken:
+            raise LookupError('Circle in tree detected')
+        return self.found
+
+
+GOOD_METADATA = {'node_count': 100, 'build_epoch': 1400000000}
+
+
+def test_validate_database():
+    validate_database(FakeDatabase(GOOD_METADATA))
+    for bad_db in [FakeDatabase({}),
+                   FakeDatabase(GOOD_METADATA, found=False),
+                   FakeDatabase(GOOD_METADATA, broken=True)]:
+        with pytest.raises(InvalidDatabase):
+            validate_database(bad_db)
+
+
+def test_reload_count():
+    from wikimon import metrics
+
+    reloads = metrics.GEOIP_RELOADS.labels()
+    reloads_before = reloads.value
+    loads_before = sum(metrics.GEOIP_LOAD_SECONDS.labels().counts)
+    monitor = MonitorGeoLite2('/nonexistent.mmdb')
+    monitor.store(object(), {'md5': 'old', 'build_date': None,
+                             'build_epoch': 1300000000,
+                             'load_duration': 0.5})
+    assert monitor.reload_count == 0
+    monitor.store(object(), {'md5': 'abc', 'build_date': None,
+                             'build_epoch': 1400000000,
+                             'load_duration': 0.5})
+    stats = monitor.get_stats()
+    assert stats['reload_count'] == 1
+    assert stats['md5'] == 'abc'
+
+    assert reloads.value - reloads_before == 1
+    assert sum(metrics.GEOIP_LOAD_SECONDS.labels().counts) - loads_before == 2
+    rendered = metrics.REGISTRY.render()
+    assert ('wikimon_geoip_info{md5="abc",build_epoch="1400000000"} 1'
+            in rendered)
+    assert 'md5="old"' not in rendered
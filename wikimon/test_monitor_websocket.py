@@ -1,5 +1,8 @@
 import pytest
+from json import dumps
+
 import wikimon.monitor_websocket as MW
+from wikimon.testing import connect
 
 
 class FakeInfobj(object):
@@ -51,3 +54,270 @@ def test_geolocate_anonymous_user():
 def test_geolocate_anonymouse_irrelevant_messages(parsed_message):
     geoip_db = FakeGeolite2({}, should_raise=True)
     assert not MW.geolocated_anonymous_user(geoip_db, parsed_message)
+
+
+class FakeBroadcaster(object):
+    def __init__(self):
+        self.sent = []
+
+    def broadcast(self, msg, channel=None, msg_dict=None):
+        self.sent.append((channel, msg))
+
+
+EN_EDIT = ('[[Evanescence (Evanescence album)]]  https://en.wikipedia.org/w/'
+           'index.php?diff=775894800&oldid=774995266 * Carsten R D * (-12) '
+           'fixed a typo')
+
+
+def test_get_channel_path():
+    assert MW.get_channel_path('en.wikipedia') == '/en/'
+    assert MW.get_channel_path('de.wikipedia') == '/de/'
+    assert MW.get_channel_path('en.wiktionary') == '/en.wiktionary/'
+    channel = MW.get_channel('wikidata', 'wiktionary')
+    assert MW.get_channel_path(channel) == '/wikidata/'
+
+
+def test_monitor_routes_by_channel():
+    bcaster = FakeBroadcaster()
+    monitor = MW.Monitor(None, bcaster, {}, None)
+    monitor.privmsg('rc-pmtpa', '#de.wikipedia', EN_EDIT)
+    monitor.privmsg('rc-pmtpa', '#en.wikipedia', EN_EDIT)
+    assert [channel for channel, _ in bcaster.sent] == ['de.wikipedia',
+                                                        'en.wikipedia']
+
+
+def test_broadcast_frames_once_per_channel():
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia',
+                                                  'de.wikipedia'])
+    factory.protocol = MW.BroadcastServerProtocol
+    en_clients = [connect(factory, '/en/', 40000 + i) for i in range(3)]
+    _, de_transport = connect(factory, '/de/', 40010)
+
+    factory.broadcast('{"page_title": "Foo"}', 'en.wikipedia')
+
+    frames = set([t.value() for _, t in en_clients])
+    assert frames == set(['\x81\x15{"page_title": "Foo"}'])
+    assert de_transport.value() == ''
+    assert factory.msgcount == 1
+
+
+def test_broadcast_filter_groups():
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'])
+    factory.protocol = MW.BroadcastServerProtocol
+    everything = connect(factory, '/en/', 40020)
+    humans = [connect(factory, '/en/?is_bot=false&ns=Main', 40021 + i)
+              for i in range(2)]
+    big = connect(factory, '/en/', 40030)
+    big[0].onMessage('{"filter": {"min_change_size": 100}}', False)
+
+    assert len(factory.groups['en.wikipedia']) == 3
+    assert len(factory.filters) == 2
+
+    bot_edit = {'is_bot': True, 'ns': 'Main', 'change_size': -500}
+    factory.broadcast(dumps(bot_edit), 'en.wikipedia', bot_edit)
+    human_edit = {'is_bot': False, 'ns': 'Main', 'change_size': 5}
+    factory.broadcast(dumps(human_edit), 'en.wikipedia')
+
+    def count_frames(transport):
+        return transport.value().count('\x81')
+
+    assert count_frames(everything[1]) == 2
+    assert [count_frames(t) for _, t in humans] == [1, 1]
+    assert count_frames(big[1]) == 1
+
+    big[0].connectionLost(None)
+    assert len(factory.filters) == 1
+
+
+def test_filter_errors_are_reported():
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'])
+    factory.protocol = MW.BroadcastServerProtocol
+    proto, transport = connect(factory, '/en/', 40040)
+    proto.onMessage('{"filter": {"colour": "blue"}}', False)
+    assert 'unknown filter field' in transport.value()
+    assert proto.filter_key is None
+
+
+class FakeGeoMonitor(object):
+    def __init__(self, geoip_db, cache):
+        self.geoip_db = geoip_db
+        self.cache = cache
+
+
+def test_monitor_geolocate_is_cached():
+    from wikimon.geocache import GeoCache
+    lookups = []
+
+    class CountingGeolite2(FakeGeolite2):
+        def lookup(self, ip):
+            lookups.append(ip)
+            return FakeGeolite2.lookup(self, ip)
+
+    result = {'country': {'names': {'en': 'Iceland'}}}
+    geo_monitor = FakeGeoMonitor(CountingGeolite2(result), GeoCache())
+    monitor = MW.Monitor(geo_monitor, FakeBroadcaster(), {}, None)
+    first = monitor.geolocate('192.168.1.1')
+    assert monitor.geolocate('192.168.1.1') == first
+    assert first['country_name'] == 'Iceland'
+    assert lookups == ['192.168.1.1']
+
+
+def test_geolocate_failures_are_not_cached():
+    from wikimon.geocache import GeoCache
+    geo_monitor = FakeGeoMonitor(FakeGeolite2({}, should_raise=True),
+                                 GeoCache())
+    assert MW.geolocate_ip(geo_monitor, '192.168.1.1') == {}
+    assert geo_monitor.cache.get('192.168.1.1') is None
+    geo_monitor.geoip_db = FakeGeolite2({'city': {'names': {'en': 'X'}}})
+    assert MW.geolocate_ip(geo_monitor, '192.168.1.1')['city'] == 'X'
+    assert geo_monitor.cache.get('192.168.1.1')['city'] == 'X'
+
+
+class ListRecorder(object):
+    def __init__(self):
+        self.records = []
+
+    def record(self, channel, msg):
+        self.records.append((channel, msg))
+
+
+def test_monitor_records_raw_lines():
+    recorder = ListRecorder()
+    monitor = MW.Monitor(None, FakeBroadcaster(), {}, None,
+                         recorder=recorder)
+    raw = '\x0314' + EN_EDIT + '\x03'
+    monitor.privmsg('rc-pmtpa', '#en.wikipedia', raw)
+    assert recorder.records == [('en.wikipedia', raw)]
+
+
+def test_batches_are_framed_once_per_window():
+    from twisted.internet.task import Clock
+    clock = Clock()
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'],
+                                        batch_window=0.1, batch_size=3,
+                                        _reactor=clock)
+    factory.protocol = MW.BroadcastServerProtocol
+    _, single = connect(factory, '/en/', 40200)
+    batched = [connect(factory, '/en/?batch=true', 40201 + i)
+               for i in range(2)]
+    late, late_transport = connect(factory, '/en/', 40210)
+    late.onMessage('{"batch": true}', False)
+
+    factory.broadcast('{"n": 1}', 'en.wikipedia')
+    factory.broadcast('{"n": 2}', 'en.wikipedia')
+    assert single.value().count('\x81') == 2
+    assert late_transport.value() == ''
+
+    clock.advance(0.1)
+    frames = set([t.value() for _, t in batched] + [late_transport.value()])
+    assert frames == set(['\x81\x13[{"n": 1},{"n": 2}]'])
+
+    # a full batch goes out before its window closes
+    for t in [late_transport] + [t for _, t in batched]:
+        t.clear()
+    for n in range(3):
+        factory.broadcast('{"n": %d}' % n, 'en.wikipedia')
+    assert late_transport.value().count('\x81') == 1
+    assert not clock.getDelayedCalls()
+
+
+def test_binary_formats_are_encoded_once():
+    from wikimon import metrics, wire
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'])
+    factory.protocol = MW.BroadcastServerProtocol
+    _, text = connect(factory, '/en/', 40300)
+    cbor_clients = [connect(factory, '/en/', 40301 + i,
+                            protocols='wikimon.cbor, wikimon.json')
+                    for i in range(2)]
+    encodes = sum(metrics.ENCODE_SECONDS.counts)
+
+    msg_dict = {'page_title': u'Foo', 'is_bot': False}
+    factory.broadcast(dumps(msg_dict), 'en.wikipedia', msg_dict)
+
+    assert text.value() == '\x81' + chr(38) + dumps(msg_dict)
+    payload = wire.encode(msg_dict, wire.CBOR)
+    for proto, transport in cbor_clients:
+        assert proto.wire_format == 'wikimon.cbor'
+        assert transport.value() == '\x82' + chr(len(payload)) + payload
+    assert sum(metrics.ENCODE_SECONDS.counts) == encodes + 1
+
+
+def test_deflate_is_compressed_once():
+    import zlib
+    from wikimon import metrics
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'],
+                                        deflate_min_size=50)
+    factory.protocol = MW.BroadcastServerProtocol
+    _, plain = connect(factory, '/en/', 40400)
+    deflating = [connect(factory, '/en/', 40401 + i,
+                         extensions='permessage-deflate;'
+                         ' client_max_window_bits')
+                 for i in range(2)]
+    assert all([proto.deflate for proto, _ in deflating])
+    compressions = sum(metrics.DEFLATE_SECONDS.counts)
+    saved_before = metrics.DEFLATE_SAVED_BYTES.labels().value
+
+    msg = dumps({'summary': 'fixed a typo ' * 10})
+    factory.broadcast(msg, 'en.wikipedia')
+    factory.broadcast('{"short": 1}', 'en.wikipedia')
+
+    assert plain.value().startswith('\x81\x7e\x00\x91' + msg)
+    frames = set([t.value() for _, t in deflating])
+    assert len(frames) == 1
+    frame = frames.pop()
+    assert frame[0] == '\xc1'  # FIN, RSV1 and text
+    size = ord(frame[1])
+    inflated = zlib.decompressobj(-15).decompress(frame[2:2 + size]
+                                                 + '\x00\x00\xff\xff')
+    assert inflated == msg
+    assert frame[2 + size:] == '\x81\x0c{"short": 1}'
+    assert sum(metrics.DEFLATE_SECONDS.counts) == compressions + 1
+    saved = metrics.DEFLATE_SAVED_BYTES.labels().value - saved_before
+    assert saved == 2 * (len(msg) - size)
+
+
+def test_deflate_client_messages():
+    from wikimon import deflate
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'])
+    factory.protocol = MW.BroadcastServerProtocol
+    proto, transport = connect(factory, '/en/', 40410,
+                               extensions='permessage-deflate')
+    payload = deflate.compress('{"filter": {"is_bot": false}}')
+    # masked, with an all-zero key
+    proto.dataReceived('\xc1' + chr(0x80 | len(payload)) + '\x00' * 4
+                       + payload)
+    assert proto.filter_key == (('is_bot', False),)
+    assert transport.value() == ''
+
+
+def test_replay_onconnect():
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'],
+                                        history_size=3)
+    factory.protocol = MW.BroadcastServerProtocol
+    for rev_id in range(5):
+        msg_dict = {'rev_id': str(rev_id), 'is_bot': rev_id == 3}
+        factory.broadcast(dumps(msg_dict), 'en.wikipedia', msg_dict)
+
+    def replayed(path, port):
+        _, transport = connect(factory, path, port, clear=False)
+        response, _, frames = transport.value().partition('\r\n\r\n')
+        assert response.startswith('HTTP/1.1 101')
+        return frames
+
+    assert replayed('/en/?replay=10', 40500).count('\x81') == 3
+    last_human = dumps({'rev_id': '4', 'is_bot': False})
+    assert (replayed('/en/?since_rev_id=2&is_bot=false', 40501)
+            == '\x81' + chr(len(last_human)) + last_human)
+    assert replayed('/en/?replay=2&batch=true', 40502).count('\x81') == 1
+    assert replayed('/en/', 40503) == ''
+
+    _, bad = connect(factory, '/en/?replay=all', 40504, clear=False)
+    assert bad.value().startswith('HTTP/1.1 400')
@@ -0,0 +1,39 @@
+from twisted.internet.defer import maybeDeferred
+
+from wikimon.nsmaps import NSMapRefresher, load_cache, save_cache
+
+
+def test_cache_roundtrip(tmpdir):
+    path = str(tmpdir.join('ns_maps.json'))
+    assert load_cache(path) == {}
+    save_cache(path, {'de.wikipedia': {'Diskussion': 'Talk'}})
+    assert load_cache(path) == {'de.wikipedia': {'Diskussion': 'Talk'}}
+    tmpdir.join('ns_maps.json').write('{"de.wikip')
+    assert load_cache(path) == {}
+
+
+def test_refresh_swaps_and_caches(tmpdir):
+    path = str(tmpdir.join('ns_maps.json'))
+    fetched = {'de.wikipedia': {'Diskussion': 'Talk', 'Benutzer': 'User'}}
+
+    def fetch(channel):
+        if channel not in fetched:
+            raise IOError('API down')
+        return fetched[channel]
+
+    old_de = {'Diskussion': 'Talk'}
+    ns_maps = {'de.wikipedia': old_de, 'fr.wikipedia': {'Discussion': 'Talk'}}
+    cached = {'ru.wikipedia': {}}
+    refresher = NSMapRefresher(ns_maps, ['de.wikipedia', 'fr.wikipedia'],
+                               path, cached, fetch, _defer=maybeDeferred)
+    refresher.refresh()
+
+    assert ns_maps['de.wikipedia'] == fetched['de.wikipedia']
+    assert ns_maps['fr.wikipedia'] == {'Discussion': 'Talk'}  # kept
+    assert (refresher.refresh_count, refresher.failed_refresh_count) == (1, 1)
+    assert load_cache(path) == {'de.wikipedia': fetched['de.wikipedia'],
+                                'ru.wikipedia': {}}
+
+    tmpdir.join('ns_maps.json').remove()
+    refresher.refresh()  # unchanged, so not rewritten
+    assert not tmpdir.join('ns_maps.json').exists()
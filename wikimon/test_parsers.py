@@ -16,3 +16,196 @@ from parsers import parse_irc_message
 for msg in msgs:
     parsed = parse_irc_message(msg)
     print parsed['ns'], '-', parsed['page_title']
+
+
+import os
+
+import pytest
+
+from twisted.words.protocols import irc
+
+from parsers import parse_irc_message_re, is_anon_user, strip_colors
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'corpus', 'rc_feed.txt')
+
+
+def _parse_both(msg):
+    results = []
+    for parse in (parse_irc_message_re, parse_irc_message):
+        try:
+            results.append(parse(msg))
+        except KeyError:
+            results.append(KeyError)
+    return results
+
+
+def test_fast_parser_matches_original_on_corpus():
+    with open(CORPUS_PATH, 'rb') as f:
+        lines = [strip_colors(line.rstrip('\n')).decode('utf-8')
+                 for line in f]
+    for msg in lines + [m.decode('utf-8') for m in msgs]:
+        original, fast = _parse_both(msg)
+        assert fast == original, msg
+
+
+@pytest.mark.parametrize('msg', [
+    u'not an edit',
+    u'[[Foo]]  https://x.org/w/index.php?title=A%20B&diff=2&oldid=1 * 10.0.0.1 * (+1) ok',
+    u'[[Foo]] MB https://x.org/w/index.php?diff=&oldid=1;diff=3 * Bar * (-0) \xef #tag @ping',
+    u'[[Foo]]  https://x.org/w/index.php?rcid=5 * cafe::1 * /* Sec */ rest',
+    u'[[Special:Log/block]] block  * Admin *  blocked [[User:1.2.3.4]]'])
+def test_fast_parser_edge_cases(msg):
+    original, fast = _parse_both(msg)
+    assert fast == original
+
+
+def test_is_anon_user():
+    assert is_anon_user(u'2001:558:6033:77:453b:b384:fef:e2d9')
+    assert is_anon_user(u'67.98.243.15')
+    assert not is_anon_user(u'DeadBeef')
+    assert not is_anon_user(u'')
+
+
+def _strip_colors_tree(msg):
+    # what strip_colors used to do
+    def _extract(formatted):
+        if not hasattr(formatted, 'children'):
+            return formatted
+        return ''.join(map(_extract, formatted.children))
+    return _extract(irc.parseFormattedText(msg))
+
+
+@pytest.mark.parametrize('msg', [
+    '', 'plain', '\x02bold\x02 \x1funderline\x1f \x16reverse\x16 \x0foff',
+    '\x034red\x03 \x0304,12on blue\x03 \x03,5 \x03123 \x035,',
+    'trailing digits stay \x0312', 'and here too \x034,1',
+    '\x03\x03\x0399x\x0f\x035\x02'])
+def test_strip_colors_matches_parse_formatted_text(msg):
+    assert strip_colors(msg) == _strip_colors_tree(msg)
+    assert strip_colors(msg.decode('utf-8')) == _strip_colors_tree(msg)
+
+
+def test_strip_colors_corpus():
+    with open(CORPUS_PATH, 'rb') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            assert strip_colors(line) == _strip_colors_tree(line)
+
+
+def test_strip_colors_bold_in_color():
+    # parseFormattedText reuses the color attribute here, building a
+    # cyclic tree
+    assert strip_colors('\x0303Foo\x02 bar\x02 baz') == 'Foo bar baz'
+
+
+def test_strip_colors_background_in_color():
+    # another cyclic tree from parseFormattedText, which repeats the
+    # title and URL
+    line = '\x0314[[\x0307,01Foo\x0314]]\x034 M\x0310 \x0302https://x\x03'
+    assert strip_colors(line) == '[[Foo]] M https://x'
+
+
+def test_parse_irc_stream():
+    from json import loads
+    from StringIO import StringIO
+    from parsers import parse_irc_stream, write_ndjson
+
+    with open(CORPUS_PATH, 'rb') as f:
+        raw_lines = f.readlines()
+    raw_lines += ['\n', 'not an edit\r\n', '[[Foo]] \xff * x * broken\n']
+    expected = [parse_irc_message(strip_colors(line.rstrip('\n'))
+                                  .decode('utf-8'))
+                for line in raw_lines[:-3]]
+    assert list(parse_irc_stream(raw_lines)) == expected
+
+    out = StringIO()
+    assert write_ndjson(parse_irc_stream(raw_lines), out) == len(expected)
+    assert [loads(line) for line in out.getvalue().splitlines()] == expected
+
+
+def _recentchange(**kw):
+    event = {'type': 'edit', 'namespace': 0, 'title': u'Foo',
+             'user': u'Bar', 'bot': False, 'minor': True,
+             'patrolled': False, 'comment': u'/* Intro */ fix #tag',
+             'server_name': 'en.wikipedia.org',
+             'server_url': 'https://en.wikipedia.org',
+             'server_script_path': '/w', 'id': 5,
+             'length': {'old': 10, 'new': 4},
+             'revision': {'old': 1, 'new': 2}}
+    event.update(kw)
+    return event
+
+
+def test_parse_recentchange():
+    from parsers import parse_recentchange, get_recentchange_channel
+
+    event = _recentchange()
+    assert get_recentchange_channel(event) == 'en.wikipedia'
+    msg_dict = parse_recentchange(event)
+    irc_msg = parse_irc_message(
+        u'[[Foo]] !M https://en.wikipedia.org/w/index.php?diff=2&oldid=1'
+        u' * Bar * (-6) /* Intro */ fix #tag')
+    assert msg_dict == irc_msg
+
+    new = parse_recentchange(_recentchange(
+        type='new', namespace=1, title=u'Talk:Foo', user=u'10.0.0.1',
+        minor=False, patrolled=None, revision={'new': 3}, length={'new': 7}))
+    assert new['ns'] == 'Talk'
+    assert new['flags'] == 'N' and new['is_new'] and new['is_anon']
+    assert (new['rev_id'], new['parent_rev_id']) == ('3', None)
+    assert new['change_size'] == 7
+
+    custom = parse_recentchange(_recentchange(namespace=100,
+                                              title=u'Portal:Foo'),
+                                {'Portal': 'Portal'})
+    assert custom['ns'] == 'Portal'
+
+    log = parse_recentchange(_recentchange(
+        type='log', title=u'User:1.2.3.4', namespace=2, log_type='block',
+        log_action='block', log_action_comment=u'blocked',
+        log_params={'duration': '1 day'}))
+    assert log['page_title'] == u'Special:Log/block'
+    assert log['ns'] == 'Special' and log['action'] == 'block'
+    assert log['log_title'] == u'User:1.2.3.4'
+    assert log['summary'] == u'blocked'
+
+    assert parse_recentchange(_recentchange(type='categorize')) is None
+
+
+@pytest.mark.parametrize('title, entity_id, entity_type', [
+    (u'Q42', u'Q42', 'item'),
+    (u'Item:Q42', u'Q42', 'item'),
+    (u'Property:P31', u'P31', 'property'),
+    (u'Lexeme:L7', u'L7', 'lexeme'),
+    (u'Talk:Q42', None, None),
+    (u'Q042', None, None),
+    (u'Q42/sub', None, None),
+    (u'Special:Log/block', None, None)])
+def test_add_entity_fields(title, entity_id, entity_type):
+    from parsers import add_entity_fields
+
+    msg_dict = add_entity_fields({'page_title': title})
+    assert msg_dict['entity_id'] == entity_id
+    assert msg_dict['entity_type'] == entity_type
+
+
+def test_wikidata_channel():
+    from parsers import get_recentchange_channel, get_channel_server
+
+    event = _recentchange(server_name='www.wikidata.org')
+    assert get_recentchange_channel(event) == 'wikidata.wikipedia'
+    assert get_channel_server('wikidata.wikipedia') == 'www.wikidata.org'
+
+
+def test_peek_recentchange_channel():
+    from json import dumps
+    from parsers import peek_recentchange_channel, get_recentchange_channel
+
+    for event in (_recentchange(),
+                  _recentchange(server_name='www.wikidata.org'),
+                  _recentchange(comment=u'"server_name": "de.wikipedia.org"',
+                                title=u'server_name\\')):
+        assert (peek_recentchange_channel(dumps(event))
+                == get_recentchange_channel(event))
+    assert peek_recentchange_channel('{"server_name": null}') is None
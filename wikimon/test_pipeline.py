@@ -0,0 +1,112 @@
+from twisted.internet.task import Clock
+
+from wikimon.geocache import GeoCache
+from wikimon.pipeline import GeolocationStage
+
+
+class FakeReactor(Clock):
+    def callFromThread(self, f, *a, **kw):
+        f(*a, **kw)
+
+
+class ManualThreadPool(object):
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, on_result, func, *a, **kw):
+        self.calls.append((on_result, func, a, kw))
+
+    def run(self, index=0):
+        on_result, func, a, kw = self.calls.pop(index)
+        on_result(True, func(*a, **kw))
+
+
+class FakeGeoMonitor(object):
+    geoip_db = 'db'
+
+    def __init__(self):
+        self.cache = GeoCache()
+
+
+def make_stage():
+    emitted = []
+    geo_monitor = FakeGeoMonitor()
+    pool = ManualThreadPool()
+    clock = FakeReactor()
+    stage = GeolocationStage(geo_monitor,
+                             lambda db, ip: {'city': 'x' + ip},
+                             lambda msg, channel: emitted.append(msg['n']),
+                             deadline=1.0, threadpool=pool, _reactor=clock)
+    return stage, pool, clock, emitted
+
+
+def test_order_is_preserved():
+    stage, pool, clock, emitted = make_stage()
+    first, second = {'n': 1}, {'n': 2}
+    stage.submit(first, 'en.wikipedia', '1.1.1.1')
+    stage.submit(second, 'en.wikipedia')
+    assert emitted == []
+    pool.run()
+    assert emitted == [1, 2]
+    assert first['geo_ip'] == {'city': 'x1.1.1.1'}
+
+    # cache hits do not go through the pool
+    third = {'n': 3}
+    stage.submit(third, 'en.wikipedia', '1.1.1.1')
+    assert emitted == [1, 2, 3]
+    assert third['geo_ip'] == first['geo_ip']
+
+
+def test_deadline():
+    stage, pool, clock, emitted = make_stage()
+    slow = {'n': 1}
+    stage.submit(slow, 'en.wikipedia', '2.2.2.2')
+    stage.submit({'n': 2}, 'en.wikipedia')
+    clock.advance(1.5)
+    assert emitted == [1, 2]
+    assert 'geo_ip' not in slow
+    assert stage.timeouts == 1
+
+    pool.run()
+    assert emitted == [1, 2]
+    assert stage.geoip_db_monitor.cache.get('2.2.2.2') == {'city': 'x2.2.2.2'}
+
+
+def test_lookups_are_batched():
+    stage, pool, clock, emitted = make_stage()
+    stage.threads = 1
+    stage.submit({'n': 1}, 'en.wikipedia', '1.1.1.1')
+    stage.submit({'n': 2}, 'en.wikipedia', '2.2.2.2')
+    stage.submit({'n': 3}, 'en.wikipedia', '3.3.3.3')
+    stage.submit({'n': 4}, 'en.wikipedia', '2.2.2.2')
+    assert len(pool.calls) == 1
+
+    pool.run()
+    assert emitted == [1]
+    # the rest went out together, with one lookup of 2.2.2.2
+    assert len(pool.calls) == 1
+    assert pool.calls[0][2][2] == ['2.2.2.2', '3.3.3.3']
+    pool.run()
+    assert emitted == [1, 2, 3, 4]
+    assert stage.batch_count == 2 and not stage.lookups
+
+
+def test_failed_lookup():
+    stage, pool, clock, emitted = make_stage()
+
+    def geolocate(db, ip):
+        raise ValueError(ip)
+    stage.geolocate = geolocate
+    msg = {'n': 1}
+    stage.submit(msg, 'en.wikipedia', '1.1.1.1')
+    pool.run()
+    assert emitted == [1] and 'geo_ip' not in msg
+    assert stage.geoip_db_monitor.cache.get('1.1.1.1') is None
+
+    # failures which geolocate handles itself aren't cached either
+    stage.geolocate = lambda db, ip: None
+    msg = {'n': 2}
+    stage.submit(msg, 'en.wikipedia', '1.1.1.1')
+    pool.run()
+    assert emitted == [1, 2] and 'geo_ip' not in msg
+    assert stage.geoip_db_monitor.cache.get('1.1.1.1') is None
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from wikimon.replay import ReplayServerFactory
+
+
+RECORDS = [(0.0, 'en.wikipedia', 'one'),
+           (1.0, 'de.wikipedia', 'two'),
+           (0.0, 'en.wikipedia', 'three'),
+           (3.0, 'en.wikipedia', 'four')]
+
+
+def _join(factory, channels):
+    proto = factory.buildProtocol(None)
+    transport = StringTransport()
+    proto.makeConnection(transport)
+    proto.dataReceived('NICK wikimon\r\nUSER wikimon 0 * :wikimon\r\n')
+    assert ' 001 wikimon ' in transport.value()
+    transport.clear()
+    proto.dataReceived('JOIN %s\r\n' % channels)
+    return transport
+
+
+def _privmsgs(transport):
+    return [line.rpartition(' :')[2]
+            for line in transport.value().splitlines() if 'PRIVMSG' in line]
+
+
+def test_replay_at_double_speed():
+    clock = Clock()
+    factory = ReplayServerFactory(lambda: RECORDS, speed=2.0,
+                                  _reactor=clock)
+    transport = _join(factory, '#en.wikipedia')
+    assert _privmsgs(transport) == ['one']
+    clock.advance(0.5)
+    assert _privmsgs(transport) == ['one', 'three']
+    clock.advance(1.4)
+    assert _privmsgs(transport) == ['one', 'three']
+    clock.advance(0.1)
+    assert _privmsgs(transport) == ['one', 'three', 'four']
+    assert factory.sent == 4
+
+
+def test_replay_at_max_speed():
+    clock = Clock()
+    factory = ReplayServerFactory(lambda: RECORDS * 300, speed=None,
+                                  _reactor=clock)
+    transport = _join(factory, '#en.wikipedia,#de.wikipedia')
+    while clock.getDelayedCalls():
+        clock.advance(0)
+    assert factory.sent == len(RECORDS) * 300
+    assert len(_privmsgs(transport)) == factory.sent
@@ -0,0 +1,80 @@
+from json import loads
+
+from twisted.web.test.requesthelper import DummyRequest
+
+import wikimon.monitor_websocket as MW
+from wikimon.httpstream import StatsResource
+from wikimon.stats import SpaceSaving, RollingStats, StatsEngine
+
+
+def test_space_saving():
+    sketch = SpaceSaving(3)
+    for key in 'aaaabbbcd' + 'a' * 3 + 'e':
+        sketch.add(key)
+    assert len(sketch) == 3
+    assert sketch.top(2) == [('a', 7), ('b', 3)]
+    # e took over d's counter, which had taken over c's
+    assert sketch.counts['e'] == 3
+    assert sketch.total == 13
+
+
+def _edit(**kw):
+    msg_dict = {'action': 'edit', 'ns': 'Main', 'page_title': u'Foo',
+                'is_bot': False, 'is_anon': False, 'hashtags': [],
+                'mentions': []}
+    msg_dict.update(kw)
+    return msg_dict
+
+
+def test_rolling_stats():
+    now = [1000.0]
+    stats = RollingStats(window=60, slots=6, _time=lambda: now[0])
+    stats.add(_edit(is_bot=True, hashtags=[u'tag']))
+    stats.add(_edit(ns='Talk', page_title=u'Talk:Foo', is_anon=True))
+    stats.add({'action': 'block', 'page_title': u'Special:Log/block'})
+    now[0] += 30
+    stats.add(_edit(hashtags=[u'tag', u'other'], mentions=[u'Bar']))
+    summary = stats.summary()
+    assert summary['edits'] == 3
+    assert summary['edits_per_minute'] == 6.0
+    assert summary['ns_edits_per_minute'] == {'Main': 4.0, 'Talk': 2.0}
+    assert summary['bot_share'] == summary['anon_share'] == 0.3333
+    assert summary['top_hashtags'] == [[u'tag', 2], [u'other', 1]]
+    assert summary['top_mentions'] == [[u'Bar', 1]]
+    assert summary['top_pages'] == [[u'Foo', 2], [u'Talk:Foo', 1]]
+
+    # the first slot has expired
+    now[0] += 35
+    summary = stats.summary()
+    assert summary['edits'] == 1
+    assert summary['edits_per_minute'] == 1.0
+    assert summary['top_pages'] == [[u'Foo', 1]]
+
+
+def test_stats_channel():
+    factory = MW.BroadcastServerFactory('ws://localhost:9000',
+                                        channels=['en.wikipedia'],
+                                        stats=True)
+    assert factory.get_path_channel('/en/stats') == 'en.wikipedia/stats'
+    engine = StatsEngine(factory, ['en.wikipedia'])
+    msg_dict = _edit()
+    engine.broadcast('{}', 'en.wikipedia', msg_dict)
+    assert factory.histories['en.wikipedia'].last(1) == ['{}']
+
+    resource = StatsResource(factory)
+    request = DummyRequest(['en', ''])
+    resource.render(request)
+    assert request.responseCode == 503
+
+    engine.publish()
+    request = DummyRequest(['en', ''])
+    summary = loads(resource.render(request))
+    assert summary['channel'] == 'en.wikipedia'
+    assert summary['edits'] == 1
+    # and the snapshot is only ever the latest summary
+    engine.publish()
+    assert len(factory.histories['en.wikipedia/stats']) == 1
+
+    request = DummyRequest(['en', 'stats', ''])
+    resource.render(request)
+    assert request.responseCode == 404
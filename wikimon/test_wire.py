@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from binascii import unhexlify
+
+from wikimon import wire
+
+
+def test_cbor():
+    # examples from RFC 7049, appendix A
+    examples = [(0, '00'), (23, '17'), (24, '1818'), (100, '1864'),
+                (1000, '1903e8'), (1000000, '1a000f4240'),
+                (1000000000000, '1b000000e8d4a51000'),
+                (-1, '20'), (-100, '3863'), (-1000, '3903e7'),
+                (1.5, 'fb3ff8000000000000'),
+                (False, 'f4'), (True, 'f5'), (None, 'f6'),
+                ('', '60'), ('a', '6161'), ('IETF', '6449455446'),
+                (u'ü', '62c3bc'),
+                ([], '80'), ([1, 2, 3], '83010203'),
+                ({}, 'a0'), ({'a': 1, 'b': [2, 3]}, 'a26161016162820203')]
+    for value, expected in examples:
+        assert wire.encode_cbor(value) == unhexlify(expected), value
+
+
+def test_msgpack():
+    examples = [(0, '00'), (127, '7f'), (128, 'cc80'), (256, 'cd0100'),
+                (70000, 'ce00011170'), (2 ** 32, 'cf0000000100000000'),
+                (-1, 'ff'), (-32, 'e0'), (-33, 'd0df'), (-200, 'd1ff38'),
+                (-40000, 'd2ffff63c0'), (1.5, 'cb3ff8000000000000'),
+                (False, 'c2'), (True, 'c3'), (None, 'c0'),
+                ('a', 'a161'), (u'ü', 'a2c3bc'),
+                ('x' * 40, 'd928' + '78' * 40),
+                ([1, [2]], '920191' + '02'),
+                ({'a': 1, 'b': None}, '82a16101a162c0'),
+                (range(16), 'dc0010' + ''.join(['%02x' % i
+                                                for i in range(16)]))]
+    for value, expected in examples:
+        assert wire.encode_msgpack(value) == unhexlify(expected), value
+
+
+def test_field_ids():
+    msg = {'is_bot': False, 'rev_id': u'123', 'extra': 1,
+           'geo_ip': {'city': u'Reykjavík'}}
+    encoded = wire.encode(msg, wire.MSGPACK_IDS)
+    assert encoded == ('\x84' '\x06\xc2' '\x0f\xa3123'
+                       '\x14\x81\x15\xaaReykjav\xc3\xadk'
+                       '\xa5extra\x01')
+    assert len(encoded) < len(wire.encode(msg, wire.MSGPACK))
+    assert wire.encode(msg, wire.CBOR_IDS).startswith('\xa4\x06\xf4')
+
+
+def test_every_field_has_an_id():
+    from wikimon.parsers import parse_recentchange, add_entity_fields
+
+    msg_dict = parse_recentchange({
+        'type': 'log', 'namespace': 2, 'title': u'User:Q42',
+        'user': u'1.2.3.4', 'bot': False, 'comment': u'#tag @Foo',
+        'server_name': 'www.wikidata.org', 'log_type': 'block',
+        'log_action': 'block', 'log_params': {}})
+    msg_dict = add_entity_fields(msg_dict)
+    assert set(msg_dict) - set(wire.FIELD_IDS) == set()
+    assert len(set(wire.FIELD_IDS.values())) == len(wire.FIELD_IDS)
+
+
+def test_choose_format():
+    assert wire.choose_format([]) is None
+    assert wire.choose_format(['chat', 'wikimon.cbor',
+                               'wikimon.msgpack']) == 'wikimon.cbor'
@@ -0,0 +1,36 @@
+from twisted.test.proto_helpers import StringTransport
+
+import wikimon.workers as W
+
+
+class FakeBroadcaster(object):
+    def __init__(self):
+        self.sent = []
+
+    def broadcast(self, msg, channel=None, seq=None):
+        self.sent.append((channel, msg, seq))
+
+
+def test_relay_roundtrip():
+    publisher = W.RelayPublisherFactory()
+    transports = []
+    for _ in range(3):
+        proto = publisher.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        transports.append(transport)
+
+    publisher.broadcast('{"page_title": "a\\tb"}', 'de.wikipedia')
+    publisher.broadcast(u'{"user": "x"}', 'en.wikipedia')
+    written = set([t.value() for t in transports])
+    assert len(written) == 1
+
+    bcaster = FakeBroadcaster()
+    sub_factory = W.RelaySubscriberFactory(bcaster)
+    sub = sub_factory.buildProtocol(None)
+    sub.makeConnection(StringTransport())
+    sub.dataReceived(written.pop())
+    seq = publisher.seq
+    assert bcaster.sent == [
+        ('de.wikipedia', '{"page_title": "a\\tb"}', seq - 1),
+        ('en.wikipedia', '{"user": "x"}', seq)]
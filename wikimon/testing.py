@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Helpers shared by the tests."""
+
+from twisted.internet.address import IPv4Address
+from twisted.test.proto_helpers import StringTransport
+
+
+class FakeTransport(StringTransport):
+    def setTcpNoDelay(self, enabled):
+        pass
+
+
+def connect(factory, path, port, protocols=None, extensions=None,
+            clear=True):
+    """Connects a WebSocket client of *factory* on *path*, and returns
+    its protocol and transport.
+    """
+    addr = IPv4Address('TCP', '127.0.0.1', port)
+    proto = factory.buildProtocol(addr)
+    transport = FakeTransport(peerAddress=addr)
+    proto.makeConnection(transport)
+    extra = ''
+    if protocols:
+        extra += 'Sec-WebSocket-Protocol: %s\r\n' % protocols
+    if extensions:
+        extra += 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+    proto.dataReceived('GET %s HTTP/1.1\r\n'
+                       'Host: localhost:9000\r\n'
+                       'Upgrade: websocket\r\n'
+                       'Connection: Upgrade\r\n'
+                       'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                       'Sec-WebSocket-Version: 13\r\n%s\r\n'
+                       % (path, extra))
+    if clear:
+        transport.clear()
+    return proto, transport
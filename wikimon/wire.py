@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Wire formats for broadcast messages, negotiated per client as a
+WebSocket subprotocol (``Sec-WebSocket-Protocol``):
+
+- ``wikimon.json`` (the default, also used when a client asks for
+  none): the JSON text frames wikimon has always sent
+- ``wikimon.msgpack``: MessagePack, in binary frames
+- ``wikimon.cbor``: CBOR (RFC 7049), in binary frames
+- ``wikimon.msgpack.ids`` and ``wikimon.cbor.ids``: the same, with
+  the known field names replaced by the integers in :data:`FIELD_IDS`
+
+Messages are encoded at most once per format, however many clients
+receive them, so the encoders here favor having no dependencies over
+raw speed. They handle what messages contain: dicts, lists, text,
+ints, floats, booleans and None. Map keys are written in sorted order.
+"""
+
+import struct
+
+
+# stable: clients hardcode these. add new fields at the end.
+FIELD_IDS = {'action': 1,
+             'change_size': 2,
+             'flags': 3,
+             'hashtags': 4,
+             'is_anon': 5,
+             'is_bot': 6,
+             'is_minor': 7,
+             'is_new': 8,
+             'is_unpatrolled': 9,
+             'mentions': 10,
+             'ns': 11,
+             'page_title': 12,
+             'parent_rev_id': 13,
+             'parsed_summary': 14,
+             'rev_id': 15,
+             'section': 16,
+             'summary': 17,
+             'url': 18,
+             'user': 19,
+             'geo_ip': 20,
+             'city': 21,
+             'country_name': 22,
+             'latitude': 23,
+             'longitude': 24,
+             'region_name': 25,
+             'log_type': 26,
+             'log_title': 27,
+             'log_params': 28,
+             'entity_id': 29,
+             'entity_type': 30}
+
+JSON = 'wikimon.json'
+MSGPACK = 'wikimon.msgpack'
+MSGPACK_IDS = 'wikimon.msgpack.ids'
+CBOR = 'wikimon.cbor'
+CBOR_IDS = 'wikimon.cbor.ids'
+DEFAULT_FORMAT = JSON
+# in order of preference, should a client offer several
+FORMATS = (JSON, MSGPACK, MSGPACK_IDS, CBOR, CBOR_IDS)
+
+
+def choose_format(protocols):
+    """Returns the first of the subprotocols a client offered which is
+    a supported format, or None.
+    """
+    for protocol in protocols:
+        if protocol in FORMATS:
+            return protocol
+    return None
+
+
+def _map_keys(obj, field_ids):
+    items = []
+    for key, value in obj.iteritems():
+        items.append((field_ids.get(key, key), value))
+    # ints sort before strings, so ID'd fields come first
+    items.sort()
+    return items
+
+
+def _to_utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+# MessagePack
+
+def _pack(obj, out, field_ids):
+    if obj is None:
+        out.append('\xc0')
+    elif obj is True:
+        out.append('\xc3')
+    elif obj is False:
+        out.append('\xc2')
+    elif isinstance(obj, (int, long)):
+        if 0 <= obj < 0x80:
+            out.append(chr(obj))
+        elif -32 <= obj < 0:
+            out.append(chr(obj & 0xff))
+        elif 0 <= obj < 0x100:
+            out.append('\xcc' + chr(obj))
+        elif 0 <= obj < 0x10000:
+            out.append(struct.pack('>BH', 0xcd, obj))
+        elif 0 <= obj < 0x100000000:
+            out.append(struct.pack('>BI', 0xce, obj))
+        elif obj >= 0:
+            out.append(struct.pack('>BQ', 0xcf, obj))
+        elif obj >= -0x80:
+            out.append(struct.pack('>Bb', 0xd0, obj))
+        elif obj >= -0x8000:
+            out.append(struct.pack('>Bh', 0xd1, obj))
+        elif obj >= -0x80000000:
+            out.append(struct.pack('>Bi', 0xd2, obj))
+        else:
+            out.append(struct.pack('>Bq', 0xd3, obj))
+    elif isinstance(obj, float):
+        out.append(struct.pack('>Bd', 0xcb, obj))
+    elif isinstance(obj, basestring):
+        data = _to_utf8(obj)
+        size = len(data)
+        if size < 32:
+            out.append(chr(0xa0 | size))
+        elif size < 0x100:
+            out.append('\xd9' + chr(size))
+        elif size < 0x10000:
+            out.append(struct.pack('>BH', 0xda, size))
+        else:
+            out.append(struct.pack('>BI', 0xdb, size))
+        out.append(data)
+    elif isinstance(obj, (list, tuple)):
+        _pack_header(len(obj), 0x90, 0xdc, out)
+        for item in obj:
+            _pack(item, out, field_ids)
+    elif isinstance(obj, dict):
+        _pack_header(len(obj), 0x80, 0xde, out)
+        for key, value in _map_keys(obj, field_ids):
+            _pack(key, out, field_ids)
+            _pack(value, out, field_ids)
+    else:
+        raise TypeError('cannot encode %r' % (obj,))
+
+
+def _pack_header(size, fix, code16, out):
+    if size < 16:
+        out.append(chr(fix | size))
+    elif size < 0x10000:
+        out.append(struct.pack('>BH', code16, size))
+    else:
+        out.append(struct.pack('>BI', code16 + 1, size))
+
+
+def encode_msgpack(obj, field_ids=None):
+    out = []
+    _pack(obj, out, field_ids or {})
+    return ''.join(out)
+
+
+# CBOR
+
+def _cbor_head(major, n, out):
+    major <<= 5
+    if n < 24:
+        out.append(chr(major | n))
+    elif n < 0x100:
+        out.append(chr(major | 24) + chr(n))
+    elif n < 0x10000:
+        out.append(struct.pack('>BH', major | 25, n))
+    elif n < 0x100000000:
+        out.append(struct.pack('>BI', major | 26, n))
+    else:
+        out.append(struct.pack('>BQ', major | 27, n))
+
+
+def _cbor(obj, out, field_ids):
+    if obj is None:
+        out.append('\xf6')
+    elif obj is True:
+        out.append('\xf5')
+    elif obj is False:
+        out.append('\xf4')
+    elif isinstance(obj, (int, long)):
+        if obj >= 0:
+            _cbor_head(0, obj, out)
+        else:
+            _cbor_head(1, -1 - obj, out)
+    elif isinstance(obj, float):
+        out.append(struct.pack('>Bd', 0xfb, obj))
+    elif isinstance(obj, basestring):
+        data = _to_utf8(obj)
+        _cbor_head(3, len(data), out)
+        out.append(data)
+    elif isinstance(obj, (list, tuple)):
+        _cbor_head(4, len(obj), out)
+        for item in obj:
+            _cbor(item, out, field_ids)
+    elif isinstance(obj, dict):
+        _cbor_head(5, len(obj), out)
+        for key, value in _map_keys(obj, field_ids):
+            _cbor(key, out, field_ids)
+            _cbor(value, out, field_ids)
+    else:
+        raise TypeError('cannot encode %r' % (obj,))
+
+
+def encode_cbor(obj, field_ids=None):
+    out = []
+    _cbor(obj, out, field_ids or {})
+    return ''.join(out)
+
+
+_ENCODERS = {MSGPACK: (encode_msgpack, None),
+             MSGPACK_IDS: (encode_msgpack, FIELD_IDS),
+             CBOR: (encode_cbor, None),
+             CBOR_IDS: (encode_cbor, FIELD_IDS)}
+
+
+def encode(obj, wire_format):
+    """Encodes *obj* (a message dict, or a list of them) in one of the
+    binary formats.
+    """
+    encoder, field_ids = _ENCODERS[wire_format]
+    return encoder(obj, field_ids)
+
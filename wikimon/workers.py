@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""Multi-process broadcasting.
+
+One ingest process owns the IRC monitor, parsing and geolocation, and
+publishes each serialized message exactly once over a local unix
+socket. A pool of worker processes subscribes to that socket, each
+accepting WebSocket connections on a listening socket inherited from
+the ingest process (the kernel balances accepts between them) and
+fanning out to its own clients.
+"""
+
+import os
+import sys
+import socket
+import logging
+
+from twisted.internet import reactor, protocol
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.basic import NetstringReceiver
+
+from history import get_initial_seq
+
+
+relay_log = logging.getLogger('relay_log')
+
+DEFAULT_RELAY_SOCKET = '/tmp/wikimon-%d.sock'
+WORKER_LISTEN_FD = 3
+WORKER_HTTP_FD = 4
+RESPAWN_DELAY = 1.0
+# channel names never contain a tab, messages may
+SEP = '\t'
+
+
+def encode_relay_message(msg, channel, seq):
+    data = '%s%s%d%s%s' % (channel, SEP, seq, SEP, msg)
+    return '%d:%s,' % (len(data), data)
+
+
+def decode_relay_message(data):
+    channel, seq, msg = data.split(SEP, 2)
+    return msg, channel, int(seq)
+
+
+class RelayPublisherProtocol(protocol.Protocol):
+    def connectionMade(self):
+        self.factory.workers.add(self)
+        relay_log.info('worker connected (%d total)',
+                       len(self.factory.workers))
+
+    def dataReceived(self, data):
+        pass  # workers do not talk back
+
+    def connectionLost(self, reason):
+        self.factory.workers.discard(self)
+        relay_log.info('worker disconnected (%d total)',
+                       len(self.factory.workers))
+
+
+class RelayPublisherFactory(protocol.ServerFactory):
+    """Stands in for the BroadcastServerFactory in the ingest process:
+    :meth:`broadcast` frames a message once and writes the same bytes
+    to every connected worker. Messages are numbered here, so that all
+    the workers agree on long-polling cursors, respawned ones too.
+    """
+    protocol = RelayPublisherProtocol
+
+    def __init__(self):
+        self.workers = set()
+        self.msgcount = 0
+        self.seq = get_initial_seq()
+
+    def broadcast(self, msg, channel, msg_dict=None):
+        # workers deserialize on their side if their clients filter
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        self.msgcount += 1
+        self.seq += 1
+        data = encode_relay_message(msg, channel, self.seq)
+        for worker in self.workers:
+            worker.transport.write(data)
+
+
+class RelaySubscriberProtocol(NetstringReceiver):
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        relay_log.info('connected to ingest relay')
+
+    def stringReceived(self, data):
+        msg, channel, seq = decode_relay_message(data)
+        self.factory.bsf.broadcast(msg, channel, seq=seq)
+
+
+class RelaySubscriberFactory(ReconnectingClientFactory):
+    protocol = RelaySubscriberProtocol
+    maxDelay = 5
+
+    def __init__(self, bsf):
+        self.bsf = bsf
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+    def processEnded(self, reason):
+        relay_log.error('worker %d exited: %s', self.index, reason.value)
+        if self.pool.running:
+            reactor.callLater(RESPAWN_DELAY, self.pool.spawn, self.index)
+
+
+class WorkerPool(object):
+    """Spawns *size* copies of the current script with
+    ``--worker-fd`` and ``--worker-index`` appended to its arguments,
+    handing each one the shared listening socket as file descriptor
+    ``WORKER_LISTEN_FD``, and the HTTP one, if any, as
+    ``WORKER_HTTP_FD``. Workers that exit are respawned.
+    """
+    def __init__(self, size, listen_sock, argv=None, http_sock=None):
+        self.size = size
+        self.listen_sock = listen_sock
+        self.http_sock = http_sock
+        self.argv = list(argv if argv is not None else sys.argv)
+        self.processes = {}
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for i in range(self.size):
+            self.spawn(i)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        self.running = False
+        for proc in self.processes.values():
+            try:
+                proc.signalProcess('TERM')
+            except Exception:
+                pass  # already gone
+
+    def spawn(self, index):
+        args = ([sys.executable, os.path.abspath(self.argv[0])]
+                + self.argv[1:]
+                + ['--worker-fd', str(WORKER_LISTEN_FD),
+                   '--worker-index', str(index)])
+        child_fds = {0: 0, 1: 1, 2: 2,
+                     WORKER_LISTEN_FD: self.listen_sock.fileno()}
+        if self.http_sock is not None:
+            args += ['--worker-http-fd', str(WORKER_HTTP_FD)]
+            child_fds[WORKER_HTTP_FD] = self.http_sock.fileno()
+        relay_log.info('spawning worker %d', index)
+        proc = reactor.spawnProcess(WorkerProcessProtocol(self, index),
+                                    sys.executable, args, env=os.environ,
+                                    childFDs=child_fds)
+        self.processes[index] = proc
+
+
+def create_listen_socket(port, interface='', backlog=50):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def listen_relay(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    publisher = RelayPublisherFactory()
+    reactor.listenUNIX(path, publisher)
+    return publisher
+
+
+def start_workers(port, size, relay_path, http_port=0):
+    """Called in the ingest process. Returns the publisher to hand to
+    :func:`start_monitor` in place of a broadcast server factory.
+    """
+    publisher = listen_relay(relay_path)
+    sock = create_listen_socket(port)
+    http_sock = None
+    if http_port:
+        http_sock = create_listen_socket(http_port)
+    WorkerPool(size, sock, http_sock=http_sock).start()
+    relay_log.info('started %d workers on port %d', size, port)
+    return publisher
+
+
+def _adopt_port(fd, factory):
+    port = reactor.adoptStreamPort(fd, socket.AF_INET, factory)
+    os.close(fd)  # adoptStreamPort dup()s it
+    # the adopted socket object picks up the process-wide default
+    # timeout (which wapiti sets), making accept() block the reactor
+    port.socket.setblocking(False)
+    return port
+
+
+def run_worker(bsf, listen_fd, relay_path, http_site=None, http_fd=None):
+    """Called in a worker process: serve WebSocket clients of *bsf* on
+    the inherited listening socket (and *http_site* on the HTTP one,
+    if any) and subscribe it to the relay.
+    """
+    _adopt_port(listen_fd, bsf)
+    if http_fd is not None:
+        _adopt_port(http_fd, http_site)
+    reactor.connectUNIX(relay_path, RelaySubscriberFactory(bsf))